@@ -0,0 +1,425 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta, timezone
+
+import db
+import dimension
+
+logger = logging.getLogger("analytics")
+
+SCHEMA = os.getenv("DB_SCHEMA", "sensors")
+ANALYTICS_RETENTION_HOURS = int(os.getenv("ANALYTICS_RETENTION_HOURS", "24"))  # Horas de minutos en memoria
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "5"))  # Mínimo entre lecturas de filas nuevas
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "256"))  # Resultados guardados (LRU)
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "30"))  # Segundos de validez de un resultado
+# Ancho de los intervalos del histograma con que se calculan los percentiles (°C y % de humedad)
+ANALYTICS_RESOLUTION = float(os.getenv("ANALYTICS_RESOLUTION", "0.1"))
+RANGE_GAP_MINUTES = 10  # Minutos sin cambios que se recalculan igual para unir dos rangos en una lectura
+LOW_BATTERY_THRESHOLD = int(os.getenv("LOW_BATTERY_THRESHOLD", "20"))
+
+PERCENTILES = (50, 90, 95, 99)
+WINDOWS = {"5m": 300, "15m": 900, "1h": 3600, "6h": 21600, "1d": 86400}
+
+# Resultados estructurados
+Stats = namedtuple("Stats", "min max avg percentiles")
+SensorStats = namedtuple("SensorStats", "sensor_id count temperature humidity battery_min battery_level last_seen")
+WindowStats = namedtuple("WindowStats", "start end count sensors temperature humidity")
+LowBattery = namedtuple("LowBattery", "sensor_id battery_level last_seen")
+
+_MISSING = object()
+
+class TTLCache:
+    """Caché LRU cuyos valores además vencen ttl segundos después de guardarse"""
+
+    def __init__(self, maxsize=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # clave -> (vencimiento, valor), del menos al más reciente
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            expires, value = item
+            if expires <= time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class _Bucket:
+    """Agregados de un minuto (o de una hora): por sensor y un histograma de la flota para los percentiles"""
+    __slots__ = ("sensors", "temperature", "humidity")
+
+    def __init__(self):
+        # sensor_id -> [count, tsum, tmin, tmax, hsum, hmin, hmax, bmin, batería más reciente, último timestamp]
+        self.sensors = {}
+        self.temperature = Counter()  # intervalo del histograma -> mediciones
+        self.humidity = Counter()
+
+    def merge(self, other):
+        self.temperature.update(other.temperature)
+        self.humidity.update(other.humidity)
+        sensors = self.sensors
+        for sensor_id, values in other.sensors.items():
+            current = sensors.get(sensor_id)
+            if current is None:
+                sensors[sensor_id] = list(values)
+                continue
+            current[0] += values[0]
+            current[1] += values[1]
+            current[2] = min(current[2], values[2])
+            current[3] = max(current[3], values[3])
+            current[4] += values[4]
+            current[5] = min(current[5], values[5])
+            current[6] = max(current[6], values[6])
+            current[7] = min(current[7], values[7])
+            if values[9] > current[9]:
+                current[8], current[9] = values[8], values[9]
+
+def utcnow():
+    """Hora actual en UTC sin zona, como se guardan los timestamps "...Z" en sensor_data"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def floor_minute(value):
+    return value.replace(second=0, microsecond=0)
+
+def floor_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def window_seconds(window):
+    """Acepta un nombre de WINDOWS ("5m", "1h", "1d"...), segundos o un timedelta"""
+    if isinstance(window, timedelta):
+        return int(window.total_seconds())
+    if isinstance(window, str):
+        if window in WINDOWS:
+            return WINDOWS[window]
+        raise ValueError(f"Ventana desconocida: {window} (opciones: {', '.join(WINDOWS)})")
+    return int(window)
+
+def has_timestamp_index(cursor, schema):
+    """Indica si sensor_data tiene algún índice que empiece por timestamp"""
+    cursor.execute("""
+    SELECT EXISTS (
+        SELECT FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = to_regclass(%s) AND a.attname = 'timestamp'
+    )
+    """, (f"{schema}.sensor_data",))
+    return cursor.fetchone()[0]
+
+def ensure_index(cursor, schema):
+    """Crea un índice BRIN sobre timestamp si la tabla no tiene ninguno que empiece por esa columna.
+
+    Los minutos se recalculan por rango de timestamp; en una tabla que crece en orden
+    de llegada un BRIN ocupa unas pocas páginas y evita recorrerla completa. Lo crea
+    el cargador al preparar la tabla: las consultas solo avisan si falta.
+    """
+    if has_timestamp_index(cursor, schema):
+        return False
+    logger.info(f"Creando índice BRIN sobre {schema}.sensor_data (timestamp)...")
+    cursor.execute(f"""
+    CREATE INDEX IF NOT EXISTS sensor_data_timestamp_brin
+    ON {schema}.sensor_data USING brin (timestamp)
+    """)
+    return True
+
+def _percentiles(histogram, count, low, high, resolution):
+    """Percentiles aproximados (centro del intervalo, acotado al mínimo y máximo reales)"""
+    result = {}
+    if not count:
+        return result
+    targets = [(p, p / 100 * (count - 1)) for p in PERCENTILES]
+    seen = 0
+    index = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        while index < len(targets) and targets[index][1] < seen:
+            value = (bucket + 0.5) * resolution
+            result[targets[index][0]] = min(max(value, low), high)
+            index += 1
+        if index == len(targets):
+            break
+    return result
+
+class WindowedAnalytics:
+    """Estadísticas por ventana de tiempo calculadas de forma incremental.
+
+    Guarda en memoria agregados por minuto de las últimas retention_hours horas. Cada
+    refresco lee solo las filas con id mayor que la marca de agua, recalcula los minutos
+    que esas filas tocan (también los de datos que llegan tarde) y descarta los que salen
+    del horizonte. Las ventanas se arman sumando horas completas (combinadas una vez y
+    guardadas hasta que cambia alguno de sus minutos) y los minutos de los extremos, así
+    que sus límites se redondean al minuto. Los resultados se guardan en una TTLCache
+    hasta que cambian los datos.
+
+    La marca de agua solo avanza hasta el mayor id que existía cuando terminaron todas las
+    transacciones abiertas en ese momento (snapshot xmin), para no saltarse filas de un
+    escritor que asignó ids antes que otro pero confirmó después.
+    """
+
+    def __init__(self, schema=SCHEMA, retention_hours=ANALYTICS_RETENTION_HOURS,
+                 refresh_seconds=ANALYTICS_REFRESH_SECONDS, resolution=ANALYTICS_RESOLUTION, cache=None):
+        self.schema = schema
+        self.retention = timedelta(hours=retention_hours)
+        self.refresh_seconds = refresh_seconds
+        self.resolution = resolution
+        self.cache = cache if cache is not None else TTLCache()
+        self.minutes = {}  # minuto -> _Bucket
+        self.hours = {}  # hora -> _Bucket con sus minutos ya combinados
+        self.watermark = 0
+        self.version = 0  # Cambia cada vez que se recalculan minutos; forma parte de la clave de caché
+        self._pending = deque()  # (xmax del snapshot, mayor id visible en ese momento)
+        self._refreshed_at = None
+        self._index_checked = False
+        self._readings = None  # sensor_readings si existe (formato compacto o no), si no sensor_data
+        self._lock = threading.RLock()
+
+    def refresh(self, force=False):
+        """Incorpora las filas nuevas; retorna el número de minutos recalculados"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._refreshed_at is not None and now - self._refreshed_at < self.refresh_seconds:
+                return 0
+            with db.connection() as conn:
+                with conn.cursor() as cursor:
+                    if not self._index_checked:
+                        # Crear el índice aquí tomaría un bloqueo SHARE y el permiso CREATE en la ruta de consulta
+                        if not has_timestamp_index(cursor, self.schema):
+                            logger.warning(f"{self.schema}.sensor_data no tiene índice sobre timestamp: cada refresco "
+                                           f"la recorre completa. Ejecute el cargador para crearlo")
+                        self._readings = dimension.readings_table(cursor, self.schema)
+                        conn.commit()
+                        self._index_checked = True
+                    # Un solo snapshot para todas las consultas del refresco: con READ COMMITTED, un
+                    # minuto confirmado entre los agregados y los histogramas faltaría en los primeros
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    changed = self._refresh(cursor)
+                conn.commit()
+            self._refreshed_at = now
+            return changed
+
+    def _refresh(self, cursor):
+        # Primero el mayor id y después el snapshot: toda fila con id <= max_id la insertó una transacción < xmax
+        cursor.execute(f"SELECT coalesce(max(id), 0) FROM {self.schema}.sensor_data")
+        max_id = cursor.fetchone()[0]
+        cursor.execute("SELECT txid_snapshot_xmin(s), txid_snapshot_xmax(s) FROM txid_current_snapshot() s")
+        xmin, xmax = cursor.fetchone()
+
+        scan_from = self.watermark
+        while self._pending and self._pending[0][0] <= xmin:
+            self.watermark = max(self.watermark, self._pending.popleft()[1])
+        self._pending.append((xmax, max_id))
+
+        horizon = floor_minute(utcnow() - self.retention)
+        expired = [minute for minute in self.minutes if minute < horizon]
+        for minute in expired:
+            del self.minutes[minute]
+            self.hours.pop(floor_hour(minute), None)
+
+        cursor.execute(f"""
+        SELECT DISTINCT date_trunc('minute', timestamp)
+        FROM {self.schema}.sensor_data
+        WHERE id > %s AND timestamp >= %s
+        """, (scan_from, horizon))
+        dirty = sorted(row[0] for row in cursor.fetchall())
+        if dirty:
+            self._recompute(cursor, dirty)
+        if dirty or expired:
+            self.version += 1
+        logger.debug(f"Analítica: {len(dirty)} minutos recalculados, {len(expired)} descartados, "
+                     f"marca de agua {self.watermark}")
+        return len(dirty)
+
+    def _recompute(self, cursor, dirty):
+        """Reemplaza los agregados de los minutos indicados leyendo sus filas de sensor_data.
+
+        Los minutos cercanos se agrupan en rangos para leer cada tramo de la tabla con un
+        solo recorrido del índice; los minutos intermedios también se recalculan.
+        """
+        fresh = {minute: _Bucket() for minute in dirty}
+        starts, ends = [], []
+        gap = timedelta(minutes=RANGE_GAP_MINUTES)
+        for minute in dirty:
+            if ends and minute <= ends[-1] + gap:
+                ends[-1] = minute + timedelta(minutes=1)
+            else:
+                starts.append(minute)
+                ends.append(minute + timedelta(minutes=1))
+        source = f"""
+        FROM unnest(%(starts)s::timestamp[], %(ends)s::timestamp[]) AS r(lo, hi)
+        JOIN {self._readings} d ON d.timestamp >= r.lo AND d.timestamp < r.hi
+        """
+        params = {"starts": starts, "ends": ends, "resolution": self.resolution}
+        cursor.execute(f"""
+        SELECT date_trunc('minute', d.timestamp), d.sensor_id, count(*),
+               sum(d.temperature), min(d.temperature), max(d.temperature),
+               sum(d.humidity), min(d.humidity), max(d.humidity),
+               min(d.battery_level), (array_agg(d.battery_level ORDER BY d.timestamp DESC))[1], max(d.timestamp)
+        {source}
+        GROUP BY 1, 2
+        """, params)
+        for minute, sensor_id, *values in cursor.fetchall():
+            bucket = fresh.get(minute)
+            if bucket is None:
+                bucket = fresh[minute] = _Bucket()
+            bucket.sensors[sensor_id] = values
+        # Un solo recorrido para ambos histogramas: en cada conjunto la otra columna queda en NULL
+        cursor.execute(f"""
+        SELECT date_trunc('minute', d.timestamp), floor(d.temperature / %(resolution)s)::int AS t,
+               floor(d.humidity / %(resolution)s)::int AS h, count(*)
+        {source}
+        GROUP BY GROUPING SETS ((1, 2), (1, 3))
+        """, params)
+        for minute, t_bucket, h_bucket, count in cursor.fetchall():
+            if h_bucket is None:
+                fresh[minute].temperature[t_bucket] = count
+            else:
+                fresh[minute].humidity[h_bucket] = count
+        for minute, bucket in fresh.items():
+            self.hours.pop(floor_hour(minute), None)
+            if bucket.sensors:
+                self.minutes[minute] = bucket
+            else:
+                self.minutes.pop(minute, None)
+
+    def _cached(self, key, compute):
+        self.refresh()
+        key = key + (self.version,)
+        result = self.cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = compute()
+            self.cache.put(key, result)
+        return result
+
+    def window(self, window="5m", end=None):
+        """WindowStats de los minutos en [end - ventana, end); por defecto termina en el minuto actual"""
+        seconds = window_seconds(window)
+        end = floor_minute(end) if end is not None else floor_minute(utcnow()) + timedelta(minutes=1)
+        return self._cached(("window", seconds, end), lambda: self._window(end - timedelta(seconds=seconds), end))
+
+    def series(self, bucket="1h", count=24, end=None):
+        """Lista de WindowStats consecutivas de tamaño bucket alineadas a su duración, la más antigua primero"""
+        seconds = window_seconds(bucket)
+        end = end or utcnow()
+        epoch = datetime(1970, 1, 1)
+        aligned = epoch + timedelta(seconds=((end - epoch) // timedelta(seconds=seconds) + 1) * seconds)
+        step = timedelta(seconds=seconds)
+        return [self.window(seconds, aligned - step * i) for i in range(count - 1, -1, -1)]
+
+    def low_battery(self, threshold=LOW_BATTERY_THRESHOLD, window="1h"):
+        """Sensores cuya última batería reportada en la ventana está por debajo del umbral"""
+        stats = self.window(window)
+        return sorted(
+            (LowBattery(s.sensor_id, s.battery_level, s.last_seen)
+             for s in stats.sensors.values() if s.battery_level < threshold),
+            key=lambda item: (item.battery_level, item.sensor_id)
+        )
+
+    def _hour(self, hour):
+        bucket = self.hours.get(hour)
+        if bucket is None:
+            bucket = _Bucket()
+            for minute in range(60):
+                part = self.minutes.get(hour + timedelta(minutes=minute))
+                if part is not None:
+                    bucket.merge(part)
+            self.hours[hour] = bucket
+        return bucket
+
+    def _window(self, start, end):
+        total = _Bucket()
+        hour = timedelta(hours=1)
+        minute = timedelta(minutes=1)
+        with self._lock:
+            current = floor_minute(max(start, utcnow() - self.retention))
+            while current < end:
+                if current.minute == 0 and current + hour <= end:
+                    total.merge(self._hour(current))
+                    current += hour
+                    continue
+                part = self.minutes.get(current)
+                if part is not None:
+                    total.merge(part)
+                current += minute
+        return self._build(start, end, total)
+
+    def _build(self, start, end, total_bucket):
+        sensors = total_bucket.sensors
+        per_sensor = {}
+        total = tsum = hsum = 0
+        tmin = hmin = float("inf")
+        tmax = hmax = float("-inf")
+        for sensor_id in sorted(sensors):
+            count, s_tsum, s_tmin, s_tmax, s_hsum, s_hmin, s_hmax, bmin, battery, last_seen = sensors[sensor_id]
+            per_sensor[sensor_id] = SensorStats(
+                sensor_id, count,
+                Stats(s_tmin, s_tmax, s_tsum / count, {}),
+                Stats(s_hmin, s_hmax, s_hsum / count, {}),
+                bmin, battery, last_seen
+            )
+            total += count
+            tsum += s_tsum
+            hsum += s_hsum
+            tmin, tmax = min(tmin, s_tmin), max(tmax, s_tmax)
+            hmin, hmax = min(hmin, s_hmin), max(hmax, s_hmax)
+        if not total:
+            return WindowStats(start, end, 0, per_sensor, None, None)
+        return WindowStats(
+            start, end, total, per_sensor,
+            Stats(tmin, tmax, tsum / total,
+                  _percentiles(total_bucket.temperature, total, tmin, tmax, self.resolution)),
+            Stats(hmin, hmax, hsum / total,
+                  _percentiles(total_bucket.humidity, total, hmin, hmax, self.resolution)),
+        )
+
+_default = None
+_default_lock = threading.Lock()
+
+def get_analytics():
+    """Instancia compartida del proceso (los paneles consultan siempre la misma)"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = WindowedAnalytics()
+        return _default
+
+def window_stats(window="5m", end=None):
+    return get_analytics().window(window, end)
+
+def series(bucket="1h", count=24, end=None):
+    return get_analytics().series(bucket, count, end)
+
+def low_battery_sensors(threshold=LOW_BATTERY_THRESHOLD, window="1h"):
+    return get_analytics().low_battery(threshold, window)
+
+def to_dict(result):
+    """Convierte resultados (namedtuples anidadas, listas, fechas) a tipos serializables en JSON"""
+    if hasattr(result, "_asdict"):
+        return {key: to_dict(value) for key, value in result._asdict().items()}
+    if isinstance(result, dict):
+        return {str(key): to_dict(value) for key, value in result.items()}
+    if isinstance(result, (list, tuple)):
+        return [to_dict(value) for value in result]
+    if isinstance(result, datetime):
+        return result.isoformat()
+    return result
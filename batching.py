@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Grupos de commit: los archivos parseados se acumulan y se confirman juntos en una sola
+# transacción al alcanzar cualquiera de estos límites (COMMIT_GROUP_FILES=1 = un commit por archivo)
+COMMIT_GROUP_FILES = int(os.getenv("COMMIT_GROUP_FILES", "1000"))  # Archivos por grupo
+COMMIT_GROUP_ROWS = int(os.getenv("COMMIT_GROUP_ROWS", "50000"))  # Mediciones por grupo
+COMMIT_GROUP_BYTES = int(os.getenv("COMMIT_GROUP_BYTES", str(32 * 1024 * 1024)))  # Bytes descargados por grupo
+COMMIT_GROUP_SECONDS = float(os.getenv("COMMIT_GROUP_SECONDS", "1"))  # Espera máxima de un archivo en un grupo abierto
+
+# Tamaño de cada inserción dentro de un grupo: con ADAPTIVE_BATCH se ajusta según la latencia
+# observada para que cada llamada tarde cerca de BATCH_TARGET_SECONDS
+ADAPTIVE_BATCH = os.getenv("ADAPTIVE_BATCH", "true").lower() == "true"
+INSERT_BATCH_ROWS = int(os.getenv("INSERT_BATCH_ROWS", "10000"))  # Tamaño inicial (o fijo sin ADAPTIVE_BATCH)
+BATCH_MIN_ROWS = int(os.getenv("BATCH_MIN_ROWS", "1000"))
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "200000"))
+BATCH_TARGET_SECONDS = float(os.getenv("BATCH_TARGET_SECONDS", "0.25"))
+
+SMOOTHING = 0.3  # Peso de la última observación en el promedio exponencial
+MAX_STEP = 2.0  # Factor máximo de cambio del tamaño por observación
+
+# Resultado de un archivo ya confirmado o descartado
+FileResult = namedtuple("FileResult", "key rows ok")
+
+class AdaptiveBatchSize:
+    """Filas por inserción ajustadas con el tiempo por fila observado.
+
+    Mantiene un promedio exponencial de segundos por fila y propone el tamaño que
+    tardaría target_seconds, limitado a [min_rows, max_rows] y a duplicar o reducir
+    a la mitad por observación. Se comparte entre los escritores de un cargador.
+    """
+
+    def __init__(self, initial=INSERT_BATCH_ROWS, min_rows=BATCH_MIN_ROWS, max_rows=BATCH_MAX_ROWS,
+                 target_seconds=BATCH_TARGET_SECONDS, adaptive=ADAPTIVE_BATCH):
+        self.min_rows = max(1, min_rows)
+        self.max_rows = max(self.min_rows, max_rows)
+        self.target_seconds = target_seconds
+        self.adaptive = adaptive
+        self.rows = initial if not adaptive else min(self.max_rows, max(self.min_rows, initial))
+        self.seconds_per_row = None
+        self._lock = threading.Lock()
+
+    def observe(self, rows, seconds):
+        """Registra una inserción de rows filas que tardó seconds; retorna el nuevo tamaño"""
+        if not self.adaptive or rows <= 0:
+            return self.rows
+        with self._lock:
+            # Los restos pequeños del final de un grupo pesan más por el costo fijo de cada
+            # llamada; solo cuentan si ya superan la latencia objetivo
+            if rows < self.rows // 2 and seconds < self.target_seconds:
+                return self.rows
+            observed = seconds / rows
+            if self.seconds_per_row is None:
+                self.seconds_per_row = observed
+            else:
+                self.seconds_per_row += SMOOTHING * (observed - self.seconds_per_row)
+            proposed = self.target_seconds / self.seconds_per_row if self.seconds_per_row > 0 else self.max_rows
+            proposed = min(self.rows * MAX_STEP, max(self.rows / MAX_STEP, proposed))
+            self.rows = int(min(self.max_rows, max(self.min_rows, proposed)))
+            return self.rows
+
+    def slices(self, records):
+        """Divide records en trozos del tamaño vigente (se relee en cada trozo)"""
+        offset = 0
+        while offset < len(records):
+            size = self.rows
+            yield records[offset:offset + size]
+            offset += size
+
+class CommitGroup:
+    """Archivos parseados a la espera de confirmarse juntos en una transacción.
+
+    Cada escritor tiene el suyo. El grupo solo guarda los datos: la validación,
+    la inserción y el commit ocurren al vaciarlo, así que entre grupos no queda
+    ninguna transacción abierta.
+    """
+
+    def __init__(self, max_files=None, max_rows=None, max_bytes=None, max_seconds=None):
+        # Los límites se leen al crear el grupo: los escritores de cada ejecución usan los vigentes
+        self.max_files = max(1, COMMIT_GROUP_FILES if max_files is None else max_files)
+        self.max_rows = COMMIT_GROUP_ROWS if max_rows is None else max_rows
+        self.max_bytes = COMMIT_GROUP_BYTES if max_bytes is None else max_bytes
+        self.max_seconds = COMMIT_GROUP_SECONDS if max_seconds is None else max_seconds
+        self.items = []
+        self.rows = 0
+        self.bytes = 0
+        self._opened = None
+
+    def add(self, key, data, size=0):
+        """Agrega un archivo; retorna True si el grupo alcanzó algún límite y hay que confirmarlo"""
+        if not self.items:
+            self._opened = time.monotonic()
+        self.items.append((key, data))
+        self.rows += len(data)
+        self.bytes += size
+        return self.full()
+
+    def full(self):
+        return (len(self.items) >= self.max_files or self.rows >= self.max_rows
+                or self.bytes >= self.max_bytes or self.remaining() == 0)
+
+    def remaining(self):
+        """Segundos hasta que vence el archivo más antiguo; None si el grupo está vacío"""
+        if not self.items:
+            return None
+        return max(0.0, self.max_seconds - (time.monotonic() - self._opened))
+
+    def take(self):
+        """Vacía el grupo y retorna sus archivos [(clave, datos)]"""
+        items = self.items
+        self.items = []
+        self.rows = self.bytes = 0
+        self._opened = None
+        return items
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,656 @@
+import argparse
+import contextlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import psycopg2.extensions
+
+import cli
+
+if __name__ == "__main__":
+    cli.load_environment()  # Antes de importar los módulos que leen su configuración al importarse
+
+import batching
+import codec
+import columnar
+import completion
+import compressed
+import db
+import dimension
+import latest
+import partitions
+import s3_to_postgress
+import validation
+
+# El simulador tiene guiones en el nombre, así que se importa con importlib
+simulator = importlib.import_module("iot-sensor-simulation")
+
+def generate_records(row_count, sensor_count=simulator.SENSOR_COUNT):
+    """Genera registros ya validados (tuplas) con el mismo formato que produce process_file"""
+    base_time = datetime.now()
+    records = []
+    for i in range(row_count):
+        sensor_id = f"THS-{str(random.randint(1, sensor_count)).zfill(3)}"
+        m = simulator.generate_sensor_data(sensor_id, base_time + timedelta(seconds=i))
+        records.append((
+            m["sensor_id"],
+            m["timestamp"],
+            float(m["temperature"]),
+            float(m["humidity"]),
+            float(m["location"]["latitude"]),
+            float(m["location"]["longitude"]),
+            int(m["battery_level"])
+        ))
+    return records
+
+def bench_insert(args):
+    """Compara filas/seg de execute_batch frente a COPY (texto y binario)"""
+    records = generate_records(args.rows)
+    loader = s3_to_postgress.S3ToPostgresLoader()
+    if not loader.connect_db() or not loader.prepare():
+        return
+
+    modes = [("batch", "text"), ("copy", "text"), ("copy", "binary")]
+    print(f"Insertando {len(records)} registros por modo ({args.repeat} repeticiones)")
+    try:
+        for load_mode, copy_format in modes:
+            s3_to_postgress.LOAD_MODE = load_mode
+            s3_to_postgress.COPY_FORMAT = copy_format
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                loader.insert_records(records)
+                elapsed = time.perf_counter() - start
+                # Se deshace la carga para no ensuciar la tabla entre mediciones
+                loader.conn.rollback()
+                best = elapsed if best is None else min(best, elapsed)
+            label = load_mode if load_mode == "batch" else f"{load_mode}-{copy_format}"
+            print(f"{label:12s} {best:8.3f}s  {len(records) / best:12.0f} filas/seg")
+    finally:
+        loader.close_connection()
+
+def bench_validate(args):
+    """Compara la validación registro por registro con la validación vectorizada"""
+    base_time = datetime.now()
+    data = [
+        simulator.generate_sensor_data(f"THS-{str(random.randint(1, simulator.SENSOR_COUNT)).zfill(3)}",
+                                       base_time + timedelta(seconds=i))
+        for i in range(args.rows)
+    ]
+    # Una fracción de registros inválidos para ejercitar las máscaras de rechazo
+    for record in random.sample(data, int(len(data) * args.invalid_ratio)):
+        record["temperature"] = "N/A"
+
+    for name, func in [("python", validation.validate_records_python),
+                       ("vectorized", validation.validate_records_vectorized)]:
+        if name == "vectorized" and validation.np is None:
+            print("NumPy no está instalado; se omite la validación vectorizada")
+            continue
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            records, rejected = func(data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:12s} {best:8.3f}s  {len(data) / best:12.0f} registros/seg  "
+              f"({len(records)} válidos, rechazados: {dict(rejected)})")
+
+def _best_of(repeat, func, *args):
+    """Mejor tiempo de repeat ejecuciones y el resultado de la última"""
+    best = result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_codec(args):
+    """Compara json, orjson y msgspec al codificar, decodificar y decodificar+validar un archivo"""
+    measurements = simulator.generate_measurements_batch(args.rows, datetime.now())
+    # Una fracción fuera de rango para que ambos caminos descarten los mismos registros
+    for record in random.sample(measurements, int(len(measurements) * args.invalid_ratio)):
+        record["location"] = {"latitude": 95.0, "longitude": 0.0}
+    data = {"measurements": measurements}
+    content = json.dumps(data).encode("utf-8")
+    print(f"{len(measurements)} mediciones, {len(content) / 1e6:.1f} MB ({args.repeat} repeticiones)")
+
+    encoders = [("json-indent", lambda obj: json.dumps(obj, indent=2).encode("utf-8")),
+                ("json", lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf-8"))]
+    decoders = [("json", json.loads)]
+    if codec.orjson is not None:
+        encoders.append(("orjson", codec.orjson.dumps))
+        decoders.append(("orjson", codec.orjson.loads))
+    if codec.msgspec is not None:
+        encoders.append(("msgspec", codec.msgspec.json.encode))
+        decoders.append(("msgspec", codec.msgspec.json.decode))
+
+    print("Codificación")
+    for name, func in encoders:
+        best, encoded = _best_of(args.repeat, func, data)
+        print(f"  {name:12s} {best:8.3f}s  {len(measurements) / best:12.0f} registros/seg  "
+              f"{len(encoded) / 1e6:6.1f} MB")
+
+    print("Decodificación")
+    for name, func in decoders:
+        best, _ = _best_of(args.repeat, func, content)
+        print(f"  {name:12s} {best:8.3f}s  {len(measurements) / best:12.0f} registros/seg")
+
+    print("Decodificación + validación")
+    def parse_and_validate(loads):
+        return validation.validate_records(loads(content)["measurements"])
+
+    pipelines = [("json", lambda: parse_and_validate(json.loads))]
+    if codec.orjson is not None:
+        pipelines.append(("orjson", lambda: parse_and_validate(codec.orjson.loads)))
+    if codec.BACKEND == "msgspec":
+        pipelines.append(("msgspec-typed", lambda: codec.decode_measurements(content)))
+    baseline = None
+    for name, func in pipelines:
+        best, result = _best_of(args.repeat, func)
+        records, rejected = (result, result.rejected) if isinstance(result, codec.ValidatedRecords) else result
+        baseline = baseline or best
+        print(f"  {name:14s} {best:8.3f}s  {len(measurements) / best:12.0f} registros/seg  "
+              f"x{baseline / best:5.2f}  ({len(records)} válidos, rechazados: {dict(rejected)})")
+
+def bench_formats(args):
+    """Compara tamaño y tiempo de lectura+validación de JSON (plano o comprimido) frente a Parquet y Arrow IPC"""
+    if not columnar.available():
+        print("pyarrow no está instalado; no hay formatos por columnas que comparar")
+        return
+    names = simulator.sensor_names(args.sensors)
+    columns = simulator.generate_columns(args.rows, datetime.now(), args.sensors)
+    loader = s3_to_postgress.S3ToPostgresLoader()
+    json_body = simulator.encode_columns(columns, names)
+    variants = [("json", None, json_body)]
+    for compression in ("gzip", "zstd"):
+        if compression == "zstd" and compressed.zstandard is None:
+            continue
+        variants.append(("json", compression, compressed.compress(json_body, compression)))
+        # Con un límite de 0 MB el archivo se parsea siempre en streaming
+        variants.append(("json", f"{compression}-stream", variants[-1][2]))
+    for fmt, compression in [("parquet", "zstd"), ("parquet", "gzip"), ("parquet", "none"),
+                             ("arrow", "zstd"), ("arrow", "lz4"), ("arrow", "none")]:
+        variants.append((fmt, compression, simulator.encode_columnar(columns, names, fmt, compression)))
+
+    print(f"{args.rows} mediciones de {args.sensors} sensores ({args.repeat} repeticiones)")
+    json_bytes = len(variants[0][2])
+    baseline = None
+    for fmt, compression, body in variants:
+        if fmt == "json" and compression is not None:
+            def parse(body=body, compression=compression):
+                buffer_mb = compressed.DECOMPRESS_BUFFER_MB
+                if compression.endswith("-stream"):
+                    compression, compressed.DECOMPRESS_BUFFER_MB = compression[:-len("-stream")], 0
+                try:
+                    file_obj = {"Body": BytesIO(body), "ContentLength": len(body)}
+                    return loader.parse_compressed_file("bench", file_obj, compression)
+                finally:
+                    compressed.DECOMPRESS_BUFFER_MB = buffer_mb
+        elif fmt == "json":
+            def parse(body=body):
+                records = codec.decode_measurements(body)
+                return records if records is not None else loader.validate_records(codec.loads(body)["measurements"])
+        else:
+            def parse(body=body, fmt=fmt):
+                return columnar.decode_records(body, fmt)
+        best, records = _best_of(args.repeat, parse)
+        baseline = baseline or best
+        label = fmt if compression is None else f"{fmt}-{compression}"
+        print(f"{label:16s} {len(body) / 1e6:8.2f} MB  ({len(body) / json_bytes:6.1%} del JSON)  "
+              f"{best:8.3f}s  {len(records) / best:12.0f} registros/seg  x{baseline / best:5.2f}")
+
+def _timed_insert(loader, records, load_mode):
+    """Inserta con el modo indicado y retorna (segundos, filas insertadas)"""
+    s3_to_postgress.LOAD_MODE = load_mode
+    start = time.perf_counter()
+    inserted = loader.insert_records(records)
+    return time.perf_counter() - start, inserted
+
+def bench_upsert(args):
+    """Compara el costo del merge idempotente (upsert) frente a COPY simple"""
+    records = generate_records(args.rows)
+    loader = s3_to_postgress.S3ToPostgresLoader()
+    if not loader.connect_db() or not loader.prepare() or not loader.ensure_unique_index():
+        return
+
+    s3_to_postgress.COPY_FORMAT = args.copy_format
+    print(f"Comparando con {len(records)} registros (COPY en formato {args.copy_format})")
+    try:
+        # Cada escenario se ejecuta dentro de una transacción que luego se deshace
+        elapsed, inserted = _timed_insert(loader, records, "copy")
+        loader.conn.rollback()
+        print(f"{'copy':20s} {elapsed:8.3f}s  {len(records) / elapsed:12.0f} filas/seg  ({inserted} insertadas)")
+
+        elapsed, inserted = _timed_insert(loader, records, "upsert")
+        print(f"{'upsert (nuevas)':20s} {elapsed:8.3f}s  {len(records) / elapsed:12.0f} filas/seg  ({inserted} insertadas)")
+        elapsed, inserted = _timed_insert(loader, records, "upsert")
+        print(f"{'upsert (repetidas)':20s} {elapsed:8.3f}s  {len(records) / elapsed:12.0f} filas/seg  ({inserted} insertadas)")
+        loader.conn.rollback()
+    finally:
+        loader.close_connection()
+
+def seed_bucket(s3_client, object_count, rows_per_object, sensor_count=simulator.SENSOR_COUNT):
+    """Crea el bucket y sube objetos JSON con el formato que genera el simulador"""
+    bucket = s3_to_postgress.BUCKET_NAME
+    existing = [b["Name"] for b in s3_client.list_buckets()["Buckets"]]
+    if bucket not in existing:
+        s3_client.create_bucket(Bucket=bucket)
+    base_time = datetime.now()
+    for n in range(object_count):
+        measurements = []
+        for i in range(rows_per_object):
+            sensor_id = f"THS-{str(random.randint(1, sensor_count)).zfill(3)}"
+            # Un segundo distinto por medición en todo el bucket: ninguna clave (sensor_id, timestamp) se repite
+            offset = n * rows_per_object + i
+            measurements.append(simulator.generate_sensor_data(sensor_id, base_time + timedelta(seconds=offset)))
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"bench/sensor_data_{n:06d}.json",
+            Body=json.dumps({"measurements": measurements}).encode("utf-8")
+        )
+
+def _with_latency(s3_client, latency_ms):
+    """Simula la latencia de red de S3 en cada get_object (útil con moto)"""
+    if latency_ms <= 0:
+        return
+    get_object = s3_client.get_object
+
+    def delayed_get_object(**kwargs):
+        time.sleep(latency_ms / 1000)
+        return get_object(**kwargs)
+
+    s3_client.get_object = delayed_get_object
+
+def bench_pipeline(args):
+    """Mide archivos/seg del pipeline de descarga concurrente para distintos números de hilos"""
+    mock = None
+    if not s3_to_postgress.S3_ENDPOINT_URL:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+    try:
+        loader = s3_to_postgress.S3ToPostgresLoader()
+        _with_latency(loader.s3_client, args.latency_ms)
+        seed_bucket(loader.s3_client, args.objects, args.rows)
+        files = [f for f in loader.get_s3_files() if f.startswith("bench/")]
+
+        for workers in args.workers:
+            s3_to_postgress.DOWNLOAD_WORKERS = workers
+            start = time.perf_counter()
+            rows = sum(len(data) for _, data in loader.iter_parsed_files(files))
+            elapsed = time.perf_counter() - start
+            print(f"{workers:3d} hilos  {elapsed:8.3f}s  {len(files) / elapsed:10.1f} archivos/seg  "
+                  f"{rows / elapsed:12.0f} filas/seg")
+
+        if args.with_db:
+            s3_to_postgress.DB_WRITERS = args.db_writers
+            if loader.connect_db() and loader.prepare():
+                # Un commit por archivo frente a grupos de commit de hasta group_files archivos
+                for group_files in args.group_files:
+                    batching.COMMIT_GROUP_FILES = group_files
+                    loader.group = batching.CommitGroup()
+                    loader.batch_size = batching.AdaptiveBatchSize()
+                    start = time.perf_counter()
+                    rows = loader.run_pipeline(files)
+                    elapsed = time.perf_counter() - start
+                    print(f"Carga completa con {args.db_writers} escritores y grupos de {group_files:4d} archivos: "
+                          f"{rows} filas en {elapsed:.3f}s ({rows / elapsed:.0f} filas/seg, "
+                          f"lote final {loader.batch_size.rows} filas)")
+                loader.close_connection()
+    finally:
+        if mock is not None:
+            mock.stop()
+
+class StageTimer:
+    """Acumula segundos por etapa desde varios hilos (la suma puede superar el tiempo total)"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, stage, elapsed):
+        with self._lock:
+            self.seconds[stage] += elapsed
+            self.calls[stage] += 1
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def instrument_s3(self, events):
+        """Mide las llamadas a S3 con los eventos de botocore, incluida la lectura del cuerpo"""
+        stages = {"ListObjectsV2": "list", "GetObject": "download", "CopyObject": "mark",
+                  "DeleteObject": "mark", "DeleteObjects": "mark", "PutObjectTagging": "mark"}
+
+        def before_call(model, **kwargs):
+            self._local.start = time.perf_counter()
+
+        def after_call(model, parsed, **kwargs):
+            stage = stages.get(model.name)
+            if stage is None:
+                return
+            self.add(stage, time.perf_counter() - self._local.start)
+            if stage == "download" and "Body" in parsed:
+                parsed["Body"] = _TimedBody(parsed["Body"], self)
+
+        events.register("before-call.s3", before_call)
+        events.register("after-call.s3", after_call)
+
+    def cursor_factory(self):
+        """Cursor de psycopg2 que acumula el tiempo de cada sentencia en la etapa de inserción"""
+        timer = self
+
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    timer.add("insert", time.perf_counter() - start)
+
+            def copy_expert(self, sql, file, size=8192):
+                start = time.perf_counter()
+                try:
+                    return super().copy_expert(sql, file, size)
+                finally:
+                    timer.add("insert", time.perf_counter() - start)
+
+        return TimedCursor
+
+class _TimedBody:
+    """Envuelve el cuerpo de get_object para sumar el tiempo de lectura a la descarga"""
+
+    def __init__(self, body, timer):
+        self._body = body
+        self._timer = timer
+
+    def read(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._body.read(*args, **kwargs)
+        finally:
+            self._timer.add("download", time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
+
+def _rss_mb():
+    """RSS actual del proceso en MB (Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        return 0.0
+
+def _reset_bench_schema(schema):
+    """Recrea el esquema de benchmark vacío (nunca se usa el esquema de producción)"""
+    with db.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {schema}")
+        conn.commit()
+
+def _e2e_run(target, objects, rows_per_object, schema, log_level):
+    """Ejecuta una carga completa en este proceso y retorna sus métricas.
+
+    Se ejecuta en un proceso nuevo por objetivo para que el pico de RSS y el
+    estado del pool no dependan de ejecuciones anteriores.
+    """
+    from moto import mock_aws
+    import boto3
+
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger("s3_to_postgres").setLevel(log_level)
+    _reset_bench_schema(schema)
+    timer = StageTimer()
+    get_connection = db.get_connection
+
+    def timed_connection():
+        conn = get_connection()
+        conn.cursor_factory = timer.cursor_factory()
+        return conn
+
+    with mock_aws():
+        seed_client = boto3.client("s3", region_name=s3_to_postgress.REGION)
+        seed_bucket(seed_client, objects, rows_per_object)
+        # La tabla se crea fuera de la medición (el script simple no la crea)
+        loader = s3_to_postgress.S3ToPostgresLoader(s3_client=seed_client)
+        if not loader.connect_db() or not loader.check_table_exists():
+            raise RuntimeError("No se pudo preparar la tabla de benchmark")
+        loader.close_connection()
+
+        boto3.setup_default_session()
+        timer.instrument_s3(boto3.DEFAULT_SESSION.events)
+        db.get_connection = timed_connection
+        baseline_rss = _rss_mb()
+        start = time.perf_counter()
+        # Con el esquema tipado la etapa de parseo incluye también la validación
+        codec.loads = timer.wrap("parse", codec.loads)
+        codec.decode_measurements = timer.wrap("parse", codec.decode_measurements)
+        if target == "loader":
+            s3_to_postgress.validation.validate_records = timer.wrap("validate", validation.validate_records)
+            loader = s3_to_postgress.S3ToPostgresLoader(s3_client=boto3.client("s3", region_name=s3_to_postgress.REGION))
+            loader.load_data_from_s3()
+        else:
+            posteasy = importlib.import_module("s3-to-posteasy")
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                posteasy.load_data_from_s3()
+        wall = time.perf_counter() - start
+        db.get_connection = get_connection
+
+    with db.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {schema}.sensor_data")
+        loaded = cursor.fetchone()[0]
+    db.close_pool()
+
+    return {
+        "target": target,
+        "objects": objects,
+        "rows_per_object": rows_per_object,
+        "rows_loaded": loaded,
+        "wall_seconds": round(wall, 3),
+        "rows_per_second": round(loaded / wall, 1) if wall else 0.0,
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in sorted(timer.seconds.items())},
+        "stage_calls": dict(sorted(timer.calls.items())),
+        "baseline_rss_mb": round(baseline_rss, 1),
+        # ru_maxrss está en KB en Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _loader_config():
+    return {
+        "LOAD_MODE": s3_to_postgress.LOAD_MODE,
+        "COPY_FORMAT": s3_to_postgress.COPY_FORMAT,
+        "BATCH_SIZE": s3_to_postgress.BATCH_SIZE,
+        "COMMIT_GROUP_FILES": batching.COMMIT_GROUP_FILES,
+        "COMMIT_GROUP_ROWS": batching.COMMIT_GROUP_ROWS,
+        "ADAPTIVE_BATCH": batching.ADAPTIVE_BATCH,
+        "INSERT_BATCH_ROWS": batching.INSERT_BATCH_ROWS,
+        "DOWNLOAD_WORKERS": s3_to_postgress.DOWNLOAD_WORKERS,
+        "DB_WRITERS": s3_to_postgress.DB_WRITERS,
+        "STREAM_PARSE": s3_to_postgress.STREAM_PARSE,
+        "INCREMENTAL": s3_to_postgress.INCREMENTAL,
+        "MAINTAIN_ROLLUPS": s3_to_postgress.MAINTAIN_ROLLUPS,
+        "MAINTAIN_LATEST": latest.MAINTAIN_LATEST,
+        "SENSOR_DIMENSION": dimension.SENSOR_DIMENSION,
+        "VALIDATION_MODE": validation.VALIDATION_MODE,
+        "CODEC": codec.BACKEND,
+        "COMPLETION_MODE": completion.COMPLETION_MODE,
+        "PARTITION_MODE": partitions.PARTITION_MODE,
+    }
+
+def _print_e2e_run(run, previous=None):
+    stages = "  ".join(f"{stage}={seconds:.3f}s" for stage, seconds in run["stage_seconds"].items())
+    print(f"{run['target']:9s} {run['rows_loaded']:9d} filas  {run['wall_seconds']:8.3f}s  "
+          f"{run['rows_per_second']:10.0f} filas/seg  pico RSS {run['peak_rss_mb']:.0f} MB")
+    print(f"{'':9s} etapas (suma entre hilos): {stages}")
+    if previous:
+        ratio = run["rows_per_second"] / previous["rows_per_second"] if previous["rows_per_second"] else 0
+        print(f"{'':9s} frente a la referencia: {ratio:.2f}x filas/seg, "
+              f"{run['peak_rss_mb'] - previous['peak_rss_mb']:+.0f} MB de pico RSS")
+
+def bench_e2e(args):
+    """Carga completa desde un S3 simulado (moto) a PostgreSQL, con tiempos por etapa"""
+    if args.schema == os.getenv("DB_SCHEMA", "sensors"):
+        print("Use un esquema dedicado para el benchmark: sus tablas se eliminan en cada ejecución")
+        return
+    # Los procesos hijos leen la configuración (incluido el esquema) al importar los módulos
+    os.environ["DB_SCHEMA"] = args.schema
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {run["target"]: run for run in json.load(f)["runs"]}
+
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for target in args.targets:
+        for _ in range(args.repeat):
+            with context.Pool(1) as pool:
+                run = pool.apply(_e2e_run, (target, args.objects, args.rows, args.schema, args.log_level))
+            _print_e2e_run(run, previous.get(target))
+            runs.append(run)
+
+    result = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "config": _loader_config(),
+        "runs": runs,
+    }
+    output = args.output or os.path.join("bench_results", f"e2e_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Resultados guardados en {output}")
+
+# Comandos cuyo arranque se mide: (nombre, argumentos de python)
+STARTUP_COMMANDS = [
+    ("cli --help", ["cli.py", "--help"]),
+    ("query --help", ["cli.py", "query", "--help"]),
+    ("simulate --help", ["cli.py", "simulate", "--help"]),
+    ("load --help", ["cli.py", "load", "--help"]),
+    ("import queries", ["-c", "import queries"]),
+    ("import s3_to_postgress", ["-c", "import s3_to_postgress"]),
+]
+HEAVY_MODULES = ["boto3", "pyarrow", "numpy", "psycopg2"]
+
+def _imported_modules(command, cwd):
+    """Tiempo acumulado (ms) de cada módulo importado, según python -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", *command], cwd=cwd,
+                            capture_output=True, text=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # La sangría indica quién lo importó; interesa solo la primera importación de cada módulo
+        if cumulative.strip().isdigit():
+            modules.setdefault(name.strip(), int(cumulative) / 1000)
+    return modules
+
+def bench_startup(args):
+    """Mide el arranque de los comandos y qué dependencias pesadas importa cada uno"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    print(f"Arranque de cada comando ({args.repeat} repeticiones, mejor y mediana)")
+    for label, command in STARTUP_COMMANDS:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *command], cwd=cwd, capture_output=True)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        modules = _imported_modules(command, cwd)
+        heavy = ", ".join(f"{name} {modules[name]:.0f}ms" for name in HEAVY_MODULES if name in modules) or "ninguna"
+        print(f"{label:24s} {timings[0] * 1000:8.1f}ms  {timings[len(timings) // 2] * 1000:8.1f}ms  "
+              f"dependencias pesadas: {heavy}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del pipeline S3 a PostgreSQL")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    insert_parser = subparsers.add_parser("insert", help="Compara los modos de carga a PostgreSQL")
+    insert_parser.add_argument("--rows", type=int, default=100000)
+    insert_parser.add_argument("--repeat", type=int, default=3)
+    insert_parser.set_defaults(func=bench_insert)
+
+    validate_parser = subparsers.add_parser("validate", help="Compara los modos de validación")
+    validate_parser.add_argument("--rows", type=int, default=500000)
+    validate_parser.add_argument("--invalid-ratio", type=float, default=0.01)
+    validate_parser.add_argument("--repeat", type=int, default=3)
+    validate_parser.set_defaults(func=bench_validate)
+
+    codec_parser = subparsers.add_parser("codec", help="Compara los codecs JSON disponibles")
+    codec_parser.add_argument("--rows", type=int, default=200000)
+    codec_parser.add_argument("--invalid-ratio", type=float, default=0.01)
+    codec_parser.add_argument("--repeat", type=int, default=3)
+    codec_parser.set_defaults(func=bench_codec)
+
+    formats_parser = subparsers.add_parser("formats", help="Compara JSON con Parquet y Arrow IPC")
+    formats_parser.add_argument("--rows", type=int, default=200000)
+    formats_parser.add_argument("--sensors", type=int, default=1000)
+    formats_parser.add_argument("--repeat", type=int, default=3)
+    formats_parser.set_defaults(func=bench_formats)
+
+    upsert_parser = subparsers.add_parser("upsert", help="Mide el merge idempotente frente a inserts simples")
+    upsert_parser.add_argument("--rows", type=int, default=1000000)
+    upsert_parser.add_argument("--copy-format", choices=["text", "binary"], default="text")
+    upsert_parser.set_defaults(func=bench_upsert)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Mide el pipeline de descarga concurrente")
+    pipeline_parser.add_argument("--objects", type=int, default=500)
+    pipeline_parser.add_argument("--rows", type=int, default=10, help="Mediciones por objeto")
+    pipeline_parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    pipeline_parser.add_argument("--latency-ms", type=float, default=0, help="Latencia simulada por descarga")
+    pipeline_parser.add_argument("--with-db", action="store_true", help="Además inserta en PostgreSQL")
+    pipeline_parser.add_argument("--db-writers", type=int, default=2)
+    pipeline_parser.add_argument("--group-files", type=int, nargs="+", default=[1, batching.COMMIT_GROUP_FILES],
+                                 help="Archivos por grupo de commit a comparar (con --with-db)")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    e2e_parser = subparsers.add_parser("e2e", help="Carga completa S3 (moto) a PostgreSQL con tiempos por etapa")
+    e2e_parser.add_argument("--objects", type=int, default=200)
+    e2e_parser.add_argument("--rows", type=int, default=1000, help="Mediciones por objeto")
+    e2e_parser.add_argument("--targets", nargs="+", choices=["loader", "posteasy"], default=["loader", "posteasy"])
+    e2e_parser.add_argument("--repeat", type=int, default=1)
+    e2e_parser.add_argument("--schema", default="bench", help="Esquema dedicado (se recrea en cada ejecución)")
+    e2e_parser.add_argument("--output", help="Archivo JSON de resultados (por defecto bench_results/e2e_<fecha>.json)")
+    e2e_parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    e2e_parser.add_argument("--log-level", default="WARNING", help="Nivel de logging del cargador durante la medición")
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    startup_parser = subparsers.add_parser("startup", help="Mide el arranque de la CLI y de los módulos")
+    startup_parser.add_argument("--repeat", type=int, default=10)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    cli.configure_logging(log_file=False)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
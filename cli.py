@@ -0,0 +1,77 @@
+import argparse
+import importlib
+import logging
+import os
+import sys
+from datetime import datetime
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def load_environment():
+    """Carga .env en el entorno.
+
+    Debe llamarse antes de importar los módulos del cargador: leen su configuración
+    de las variables de entorno al importarse.
+    """
+    from dotenv import load_dotenv
+    return load_dotenv()
+
+def configure_logging(log_file=True, level="INFO"):
+    """Configura el logging en consola y, con log_file, en s3_to_postgres_<fecha>.log.
+
+    LOG_FILE=false y LOG_LEVEL (que reemplaza a level) se leen aquí y no al
+    importar, para que también se tomen del .env.
+    """
+    handlers = [logging.StreamHandler()]
+    if log_file and os.getenv("LOG_FILE", "true").lower() == "true":
+        handlers.insert(0, logging.FileHandler(f"s3_to_postgres_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", level).upper(), format=LOG_FORMAT, handlers=handlers)
+
+def run_simulate(args, extra):
+    simulator = importlib.import_module("iot-sensor-simulation")
+    simulator.main(extra)
+
+def run_load(args, extra):
+    if args.daemon:
+        import ingest_daemon
+        ingest_daemon.main()
+    elif args.sharded:
+        import sharded_loader
+        sharded_loader.main()
+    else:
+        import s3_to_postgress
+        s3_to_postgress.main()
+
+def run_query(args, extra):
+    import queries
+    queries.main(extra)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Simulador, cargador S3 a PostgreSQL y consultas de sensores IoT",
+        epilog="Las opciones de simulate y query son las de iot-sensor-simulation.py y queries.py "
+               "(p. ej. cli.py query --help)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    # simulate y query pasan sus opciones al analizador de su módulo, que se importa solo al usarlo
+    subparsers.add_parser("simulate", add_help=False, help="Generar mediciones y subirlas a S3")
+    load_parser = subparsers.add_parser("load", help="Cargar los objetos de S3 en PostgreSQL")
+    mode = load_parser.add_mutually_exclusive_group()
+    mode.add_argument("--daemon", action="store_true", help="Carga continua hasta recibir SIGTERM/SIGINT")
+    mode.add_argument("--sharded", action="store_true", help="Repartir los objetos entre SHARD_PROCESSES procesos")
+    subparsers.add_parser("query", add_help=False, help="Reportes y consultas sobre los datos cargados")
+    return parser
+
+COMMANDS = {"simulate": run_simulate, "load": run_load, "query": run_query}
+
+def main(argv=None):
+    """Punto de entrada único: las dependencias pesadas se importan solo en el subcomando que las usa"""
+    args, extra = build_parser().parse_known_args(argv)
+    if args.command == "load" and extra:
+        build_parser().error(f"argumentos no reconocidos: {' '.join(extra)}")
+    load_environment()
+    # Solo la carga escribe su archivo de log; en las consultas el log no se mezcla con el reporte
+    configure_logging(log_file=args.command == "load", level="WARNING" if args.command == "query" else "INFO")
+    COMMANDS[args.command](args, extra)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
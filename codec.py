@@ -0,0 +1,111 @@
+import json
+import os
+from collections import Counter
+
+try:
+    import msgspec  # Opcional: decodificación tipada del esquema de mediciones
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson  # Opcional: codificación y decodificación genérica rápida
+except ImportError:
+    orjson = None
+
+from validation import INT_MIN, INT_MAX
+
+# "auto" usa msgspec, luego orjson y por último la biblioteca estándar
+CODEC = os.getenv("CODEC", "auto")
+
+def _select_backend(name):
+    if name in ("auto", "msgspec") and msgspec is not None:
+        return "msgspec"
+    if name in ("auto", "msgspec", "orjson") and orjson is not None:
+        return "orjson"
+    return "json"
+
+BACKEND = _select_backend(CODEC)
+
+if msgspec is not None:
+    class Location(msgspec.Struct, gc=False):
+        latitude: float
+        longitude: float
+
+    class Measurement(msgspec.Struct, gc=False):
+        sensor_id: str
+        timestamp: str
+        temperature: float
+        humidity: float
+        location: Location
+        battery_level: int
+
+    class MeasurementFile(msgspec.Struct, gc=False):
+        measurements: list[Measurement]
+
+    _json_decoder = msgspec.json.Decoder()
+    _json_encoder = msgspec.json.Encoder()
+    _file_decoder = msgspec.json.Decoder(MeasurementFile)
+
+class ValidatedRecords(list):
+    """Registros ya convertidos a tuplas de la tabla.
+
+    rejected cuenta los descartados por motivo y rejects guarda los pares
+    (motivo, medición original) para la cuarentena.
+    """
+
+    def __init__(self, records, rejected, rejects=None):
+        super().__init__(records)
+        self.rejected = rejected
+        self.rejects = [] if rejects is None else rejects
+
+def loads(data):
+    """Decodifica JSON (bytes o str) con el backend más rápido disponible"""
+    if BACKEND == "msgspec":
+        return _json_decoder.decode(data)
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj):
+    """Codifica en JSON compacto; siempre retorna bytes"""
+    if BACKEND == "msgspec":
+        return _json_encoder.encode(obj)
+    if BACKEND == "orjson":
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def decode_measurements(data):
+    """Decodifica y valida un archivo {"measurements": [...]} en un solo recorrido.
+
+    Con msgspec el esquema tipado ya garantiza campos y tipos, así que solo quedan
+    los rangos de coordenadas y de battery_level. Retorna ValidatedRecords, o None
+    si el archivo no cumple el esquema estricto (campos faltantes, strings numéricos,
+    otro formato...): en ese caso hay que usar loads y validation.validate_records,
+    que aplican la conversión registro por registro.
+    """
+    if BACKEND != "msgspec":
+        return None
+    try:
+        measurements = _file_decoder.decode(data).measurements
+    except msgspec.DecodeError:
+        # ValidationError es subclase: cubre tanto JSON inválido como esquema distinto
+        return None
+
+    records = []
+    append = records.append
+    rejects = []
+    for m in measurements:
+        location = m.location
+        latitude = location.latitude
+        longitude = location.longitude
+        # Mismo orden de motivos que validation.validate_records_python
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            rejects.append(("coordinates_out_of_range", msgspec.to_builtins(m)))
+            continue
+        battery_level = m.battery_level
+        if not INT_MIN <= battery_level <= INT_MAX:
+            rejects.append(("invalid_battery_level", msgspec.to_builtins(m)))
+            continue
+        append((m.sensor_id, m.timestamp, m.temperature, m.humidity, latitude, longitude, battery_level))
+
+    return ValidatedRecords(records, Counter(reason for reason, _ in rejects), rejects)
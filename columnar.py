@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import Counter
+from io import BytesIO
+
+import codec
+import validation
+
+# Compresión de los lotes generados: "zstd", "lz4", "none" o, solo en Parquet, "gzip" y "snappy"
+COLUMNAR_COMPRESSION = os.getenv("COLUMNAR_COMPRESSION", "zstd")
+
+# Extensión de la clave y valor del metadato "format" de cada formato por columnas
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+CONTENT_TYPES = {"parquet": "application/vnd.apache.parquet", "arrow": "application/vnd.apache.arrow.stream"}
+FORMAT_METADATA_KEY = "format"
+
+# Opcional: pyarrow (lotes por columnas en Parquet o Arrow IPC). Se importa al primer uso
+# porque tarda más que el resto del cargador y la mayoría de los objetos son JSON.
+pa = pq = None
+SCHEMA = None
+_arrow_checked = False
+_arrow_lock = threading.Lock()
+
+def available():
+    """True si pyarrow está instalado; la primera llamada lo importa y define SCHEMA"""
+    global pa, pq, SCHEMA, _arrow_checked
+    if _arrow_checked:
+        return pa is not None
+    with _arrow_lock:
+        if not _arrow_checked:
+            try:
+                import pyarrow
+                import pyarrow.ipc
+                import pyarrow.parquet
+            except ImportError:
+                pyarrow = None
+            if pyarrow is not None:
+                # Columnas planas: la ubicación se guarda como dos columnas en lugar de un objeto anidado
+                SCHEMA = pyarrow.schema([
+                    ("sensor_id", pyarrow.string()),
+                    ("timestamp", pyarrow.string()),
+                    ("temperature", pyarrow.float64()),
+                    ("humidity", pyarrow.float64()),
+                    ("latitude", pyarrow.float64()),
+                    ("longitude", pyarrow.float64()),
+                    ("battery_level", pyarrow.int32()),
+                ])
+                pa, pq = pyarrow, pyarrow.parquet
+            _arrow_checked = True
+    return pa is not None
+
+def detect_format(key, metadata=None):
+    """Formato por columnas de un objeto según su metadato "format" o su extensión; None si es JSON"""
+    declared = (metadata or {}).get(FORMAT_METADATA_KEY)
+    if declared in EXTENSIONS:
+        return declared
+    for fmt, extension in EXTENSIONS.items():
+        if key.endswith(extension):
+            return fmt
+    return None
+
+def encode_table(table, fmt, compression=COLUMNAR_COMPRESSION):
+    """Serializa una tabla de Arrow en Parquet o en Arrow IPC (formato stream); retorna bytes"""
+    available()
+    compression = None if compression == "none" else compression
+    sink = BytesIO()
+    if fmt == "parquet":
+        pq.write_table(table, sink, compression=compression or "none")
+    elif fmt == "arrow":
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Formato por columnas desconocido: {fmt}")
+    return sink.getvalue()
+
+def encode_columns(columns, fmt, compression=COLUMNAR_COMPRESSION):
+    """Serializa un diccionario de columnas (nombres de SCHEMA) en el formato indicado"""
+    available()
+    return encode_table(pa.table(columns, schema=SCHEMA), fmt, compression)
+
+def _column_values(column):
+    """Convierte una columna de Arrow a lo que espera validation.validate_columns.
+
+    Las columnas numéricas sin nulos pasan a NumPy sin crear objetos Python; con
+    nulos se usan listas para que None se rechace igual que en los archivos JSON.
+    """
+    if column.null_count == 0 and (pa.types.is_floating(column.type) or pa.types.is_integer(column.type)):
+        return column.to_numpy()
+    return column.to_pylist()
+
+def _validate_batch(batch):
+    """Valida un lote (RecordBatch o Table) y retorna codec.ValidatedRecords"""
+    names = set(batch.schema.names)
+    missing = [name for name in SCHEMA.names if name not in names]
+    if missing:
+        raise ValueError(f"Faltan columnas en el lote: {', '.join(missing)}")
+    if batch.num_rows == 0:
+        return codec.ValidatedRecords([], Counter())
+    columns = {name: _column_values(batch.column(name)) for name in SCHEMA.names}
+    rejects = []
+    if validation.np is not None:
+        records, rejected = validation.validate_columns(columns, rejects=rejects)
+    else:
+        # Sin NumPy se reconstruyen las mediciones y se validan registro por registro
+        measurements = [
+            {"sensor_id": sensor_id, "timestamp": timestamp, "temperature": temperature,
+             "humidity": humidity, "location": {"latitude": latitude, "longitude": longitude},
+             "battery_level": battery_level}
+            for sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level
+            in zip(*(columns[name] for name in SCHEMA.names))
+        ]
+        records, rejected = validation.validate_records_python(measurements, rejects)
+    return codec.ValidatedRecords(records, rejected, rejects)
+
+def decode_records(data, fmt):
+    """Lee un objeto Parquet o Arrow completo y lo valida por columnas"""
+    available()
+    if fmt == "parquet":
+        table = pq.read_table(BytesIO(data))
+    else:
+        table = pa.ipc.open_stream(data).read_all()
+    return _validate_batch(table)
+
+def iter_record_chunks(body, fmt, chunk_rows):
+    """Produce bloques validados de hasta chunk_rows registros.
+
+    Arrow IPC se lee directamente del cuerpo de S3 lote a lote. Parquet necesita
+    el pie del archivo, así que se lee el cuerpo completo y se recorre por lotes.
+    """
+    available()
+    if fmt == "parquet":
+        parquet_file = pq.ParquetFile(BytesIO(body.read()))
+        batches = parquet_file.iter_batches(batch_size=chunk_rows)
+    else:
+        batches = pa.ipc.open_stream(body)
+    for batch in batches:
+        # Los lotes de Arrow IPC tienen el tamaño con que se escribieron
+        for offset in range(0, batch.num_rows, chunk_rows):
+            yield _validate_batch(batch.slice(offset, chunk_rows))
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Qué hacer con un objeto de S3 después de confirmar su carga:
+#   "copy"     copia el objeto a processed/ y deja el original (comportamiento histórico)
+#   "delete"   borra los originales en lotes de hasta 1000 claves por llamada
+#   "tag"      etiqueta el objeto (p. ej. para una regla de ciclo de vida), sin copiarlo
+#   "manifest" no escribe en S3: el manifiesto de la base de datos es el único registro
+COMPLETION_MODE = os.getenv("COMPLETION_MODE", "copy")
+COMPLETION_BATCH_SIZE = int(os.getenv("COMPLETION_BATCH_SIZE", "1000"))  # Claves por delete_objects
+COMPLETION_FLUSH_SECONDS = float(os.getenv("COMPLETION_FLUSH_SECONDS", "5"))  # Espera máxima de un lote (daemon)
+PROCESSED_TAG_KEY = os.getenv("PROCESSED_TAG_KEY", "ingest-status")
+PROCESSED_TAG_VALUE = os.getenv("PROCESSED_TAG_VALUE", "processed")
+
+MAX_DELETE_KEYS = 1000  # Límite de la API DeleteObjects
+
+# En estos modos el objeto sigue en el listado, así que solo el manifiesto evita cargarlo otra vez
+MANIFEST_MODES = frozenset(["tag", "manifest"])
+
+class CompletionMarker:
+    """Marca como procesados los objetos cuya carga ya se confirmó.
+
+    Una instancia se comparte entre los escritores de un cargador; los borrados se
+    acumulan y se envían en lotes, así que hay que llamar a flush al terminar.
+    """
+
+    def __init__(self, s3_client, bucket, mode=COMPLETION_MODE, batch_size=COMPLETION_BATCH_SIZE,
+                 processed_prefix="processed/"):
+        if mode not in ("copy", "delete", "tag", "manifest"):
+            raise ValueError(f"COMPLETION_MODE desconocido: {mode}")
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.mode = mode
+        self.batch_size = max(1, min(batch_size, MAX_DELETE_KEYS))
+        self.processed_prefix = processed_prefix
+        self._lock = threading.Lock()
+        self._pending = []
+        self._oldest = None  # Momento en que entró la clave más antigua del lote en curso
+
+    def mark(self, key):
+        """Marca un objeto; en modo delete solo lo agrega al lote"""
+        if self.mode == "manifest":
+            return
+        if self.mode == "copy":
+            self._copy(key)
+        elif self.mode == "tag":
+            self._tag(key)
+        else:
+            batch = None
+            with self._lock:
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                self._pending.append(key)
+                if len(self._pending) >= self.batch_size:
+                    batch = self._take()
+            if batch:
+                self._delete(batch)
+
+    def flush(self):
+        """Envía los borrados pendientes"""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._delete(batch)
+
+    def flush_if_stale(self, max_age=COMPLETION_FLUSH_SECONDS):
+        """Envía el lote en curso si su clave más antigua lleva más de max_age segundos esperando"""
+        with self._lock:
+            if not self._pending or time.monotonic() - self._oldest < max_age:
+                return
+            batch = self._take()
+        self._delete(batch)
+
+    def _take(self):
+        batch, self._pending, self._oldest = self._pending, [], None
+        return batch
+
+    def _copy(self, key):
+        try:
+            with metrics.track("mark"):
+                self.s3_client.copy_object(
+                    Bucket=self.bucket,
+                    CopySource={'Bucket': self.bucket, 'Key': key},
+                    Key=f"{self.processed_prefix}{key.split('/')[-1]}"
+                )
+            logger.info(f"Archivo {key} marcado como procesado")
+        except Exception as e:
+            logger.warning(f"No se pudo marcar el archivo como procesado: {e}")
+
+    def _tag(self, key):
+        try:
+            with metrics.track("mark"):
+                self.s3_client.put_object_tagging(
+                    Bucket=self.bucket, Key=key,
+                    Tagging={"TagSet": [{"Key": PROCESSED_TAG_KEY, "Value": PROCESSED_TAG_VALUE}]}
+                )
+            logger.info(f"Archivo {key} etiquetado como procesado")
+        except Exception as e:
+            logger.warning(f"No se pudo etiquetar el archivo como procesado: {e}")
+
+    def _delete(self, keys):
+        try:
+            with metrics.track("mark"):
+                response = self.s3_client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+                )
+        except Exception as e:
+            # Los objetos siguen en el bucket; el manifiesto o el upsert evitan duplicarlos al reintentar
+            logger.warning(f"No se pudieron borrar {len(keys)} archivos procesados: {e}")
+            return
+        errors = response.get("Errors", [])
+        if errors:
+            logger.warning(f"No se pudieron borrar {len(errors)} de {len(keys)} archivos procesados: "
+                           f"{errors[0].get('Key')}: {errors[0].get('Message')}")
+        logger.info(f"Se borraron {len(keys) - len(errors)} archivos procesados")
@@ -0,0 +1,76 @@
+import gzip
+import os
+
+try:
+    import zstandard  # Opcional: objetos .json.zst
+except ImportError:
+    zstandard = None
+
+# Compresión de los archivos JSON del simulador: "none", "gzip" o "zstd"
+OBJECT_COMPRESSION = os.getenv("OBJECT_COMPRESSION", "none")
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+# Los objetos que descomprimidos ocupan hasta este tamaño se parsean de una vez (más rápido);
+# los mayores se parsean en streaming sin guardar nunca más de este tamaño descomprimido
+DECOMPRESS_BUFFER_MB = int(os.getenv("DECOMPRESS_BUFFER_MB", "64"))
+
+# Sufijo de la clave y valor de ContentEncoding de cada compresión
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+CONTENT_ENCODINGS = {"gzip": "gzip", "x-gzip": "gzip", "zstd": "zstd"}
+
+def detect_compression(key, content_encoding=None):
+    """Compresión de un objeto según su ContentEncoding o el sufijo de la clave; None si no está comprimido"""
+    for encoding in (content_encoding or "").lower().split(","):
+        compression = CONTENT_ENCODINGS.get(encoding.strip())
+        if compression is not None:
+            return compression
+    for compression, suffix in SUFFIXES.items():
+        if key.endswith(suffix):
+            return compression
+    return None
+
+def _require(compression):
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("el objeto está comprimido con zstd y zstandard no está instalado")
+    if compression not in SUFFIXES:
+        raise ValueError(f"Compresión desconocida: {compression}")
+
+def open_stream(stream, compression):
+    """Envuelve un stream binario comprimido en uno que se descomprime a medida que se lee.
+
+    Solo se mantiene en memoria el bloque que se está leyendo, nunca el contenido
+    descomprimido completo.
+    """
+    _require(compression)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    # read_across_frames: los productores pueden concatenar varios frames en un objeto
+    return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+def read_prefix(stream, size):
+    """Lee hasta size bytes (menos solo si el stream termina antes)"""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+def compress(data, compression):
+    """Comprime bytes con la compresión indicada ("none" los retorna tal cual)"""
+    if compression in (None, "none"):
+        return data
+    _require(compression)
+    if compression == "gzip":
+        # mtime fijo: el mismo contenido produce los mismos bytes (y el mismo ETag)
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+def upload_args(compression):
+    """ExtraArgs de S3 para subir un objeto JSON con la compresión indicada"""
+    if compression in (None, "none"):
+        return {"ContentType": "application/json"}
+    return {"ContentType": "application/json", "ContentEncoding": compression}
@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions
+
+logger = logging.getLogger("db")
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = None  # Semáforo para esperar conexión libre en lugar de fallar al llegar al máximo
+_last_used = {}  # id(conexión) -> momento en que se devolvió al pool
+_health_check_interval = 30.0
+_acquire_timeout = 30.0
+_max_connections = None  # Tamaño máximo del pool creado
+_reserved = 0  # Conexiones simultáneas que pidió el proceso con reserve()
+_schema_ready = False
+
+def settings():
+    """Lee la configuración de conexión de las variables de entorno (al crear el pool)"""
+    return {
+        "host": os.getenv("DB_HOST", "34.207.143.199"),
+        "dbname": os.getenv("DB_NAME", "postgres"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD", "YourNewPassword"),
+        "schema": os.getenv("DB_SCHEMA", "sensors"),
+        "min_connections": int(os.getenv("DB_POOL_MIN", "1")),
+        "max_connections": int(os.getenv("DB_POOL_MAX", "10")),
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "10")),
+        # Segundos sin uso tras los cuales una conexión se verifica con SELECT 1 antes de entregarla
+        "health_check_interval": float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30")),
+        # Segundos máximos de espera por una conexión libre cuando el pool está lleno
+        "acquire_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    }
+
+def get_pool():
+    """Retorna el pool compartido, creándolo la primera vez (y de nuevo tras un fork)"""
+    global _pool, _pool_pid, _slots, _schema_ready, _health_check_interval, _acquire_timeout, _max_connections
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            config = settings()
+            if config["max_connections"] < _reserved:
+                logger.info(f"DB_POOL_MAX={config['max_connections']} ampliado a {_reserved} conexiones")
+                config["max_connections"] = _reserved
+            # Las conexiones heredadas de otro proceso no se pueden reutilizar
+            _pool = pg_pool.ThreadedConnectionPool(
+                config["min_connections"],
+                config["max_connections"],
+                host=config["host"],
+                dbname=config["dbname"],
+                user=config["user"],
+                password=config["password"],
+                connect_timeout=config["connect_timeout"]
+            )
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(config["max_connections"])
+            _max_connections = config["max_connections"]
+            _health_check_interval = config["health_check_interval"]
+            _acquire_timeout = config["acquire_timeout"]
+            _last_used.clear()
+            _schema_ready = False
+            logger.info(f"Pool de conexiones creado ({config['min_connections']}-{config['max_connections']}) "
+                        f"hacia {config['host']}/{config['dbname']}")
+    return _pool
+
+def reserve(count):
+    """Pide que el pool admita al menos count conexiones simultáneas.
+
+    Se aplica al crear el pool (también tras un fork). Retorna False si el pool de
+    este proceso ya existe con menos conexiones: esperar por una conexión libre
+    podría bloquear a todos los hilos que ya tienen otra.
+    """
+    global _reserved
+    with _lock:
+        _reserved = max(_reserved, count)
+        return _pool is None or _pool_pid != os.getpid() or _max_connections >= count
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    # Una conexión recién creada o usada hace poco no necesita verificación
+    if last_used is None or time.monotonic() - last_used < _health_check_interval:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def ensure_schema(conn):
+    """Crea el esquema una sola vez por proceso"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    schema = settings()["schema"]
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    conn.commit()
+    _schema_ready = True
+    logger.info(f"Esquema {schema} verificado.")
+
+def get_connection():
+    """Toma una conexión sana del pool; espera si todas están en uso"""
+    connection_pool = get_pool()
+    if not _slots.acquire(timeout=_acquire_timeout):
+        raise pg_pool.PoolError(f"No hay conexiones libres en el pool tras {_acquire_timeout:.0f}s")
+    try:
+        while True:
+            conn = connection_pool.getconn()
+            if _is_healthy(conn):
+                break
+            logger.warning("Conexión inválida descartada del pool")
+            connection_pool.putconn(conn, close=True)
+        ensure_schema(conn)
+        return conn
+    except Exception:
+        _slots.release()
+        raise
+
+def release_connection(conn, close=False):
+    """Devuelve la conexión al pool, deshaciendo cualquier transacción abierta"""
+    if conn is None:
+        return
+    try:
+        if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        close = True
+    _last_used[id(conn)] = time.monotonic()
+    if _pool is None or _pool_pid != os.getpid():
+        # El pool ya se cerró (o es de otro proceso): solo cerrar la conexión
+        conn.close()
+        return
+    try:
+        _pool.putconn(conn, close=close or bool(conn.closed))
+    finally:
+        _slots.release()
+
+@contextmanager
+def connection():
+    """Context manager que presta una conexión del pool"""
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+def close_pool():
+    """Cierra todas las conexiones del pool"""
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _last_used.clear()
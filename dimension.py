@@ -0,0 +1,283 @@
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from math import cos, radians
+
+from psycopg2.extras import execute_values
+
+import db
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Crear sensor_data compacta: una clave entera de sensor en lugar de sensor_id, latitud y longitud
+# en cada fila (solo aplica al crear la tabla; las tablas existentes conservan su formato)
+SENSOR_DIMENSION = os.getenv("SENSOR_DIMENSION", "false").lower() == "true"
+SENSOR_CACHE_SIZE = int(os.getenv("SENSOR_CACHE_SIZE", "100000"))  # Sensores que recuerda cada cargador (LRU)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32  # Kilómetros por grado de latitud (y de longitud en el ecuador)
+
+# Columnas de la tabla compacta en el orden en que se construyen sus registros
+COMPACT_COLUMNS = ("sensor_key", "timestamp", "temperature", "humidity", "battery_level")
+
+SensorLocation = namedtuple("SensorLocation", "sensor_id latitude longitude distance_km")
+
+_lock = threading.Lock()
+_compact = {}  # Esquema -> True si sensor_data guarda sensor_key en lugar de sensor_id y ubicación
+
+def create_tables(cursor, schema):
+    """Crea la dimensión sensors con su índice espacial.
+
+    Si se crea en esta llamada y sensor_data ya tiene datos con ubicación, se llena
+    con la ubicación más reciente de cada sensor. Retorna True si se creó.
+    """
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.sensors",))
+    if cursor.fetchone()[0]:
+        return False
+    # located_at es el timestamp de la lectura que fijó la ubicación: una lectura anterior no la reemplaza
+    cursor.execute(f"""
+    CREATE TABLE {schema}.sensors (
+        sensor_key SERIAL PRIMARY KEY,
+        sensor_id VARCHAR(50) NOT NULL UNIQUE,
+        latitude DECIMAL(9,6) NOT NULL,
+        longitude DECIMAL(9,6) NOT NULL,
+        located_at TIMESTAMP NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    # GiST sobre el punto (x = longitud, y = latitud): responde consultas por rectángulo sin PostGIS
+    cursor.execute(f"""
+    CREATE INDEX sensors_location_gist
+    ON {schema}.sensors USING gist (point(longitude::float8, latitude::float8))
+    """)
+    if not has_sensor_key(cursor, schema):
+        cursor.execute(f"""
+        INSERT INTO {schema}.sensors (sensor_id, latitude, longitude, located_at)
+        SELECT DISTINCT ON (sensor_id) sensor_id, latitude, longitude, timestamp
+        FROM {schema}.sensor_data
+        ORDER BY sensor_id, timestamp DESC, id
+        """)
+    return True
+
+def has_sensor_key(cursor, schema):
+    """True si sensor_data tiene el formato compacto (columna sensor_key)"""
+    cursor.execute("""
+    SELECT EXISTS (
+        SELECT FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = 'sensor_data' AND column_name = 'sensor_key'
+    )
+    """, (schema,))
+    return cursor.fetchone()[0]
+
+def table_columns_sql(compact):
+    """Columnas de datos de sensor_data (sin id ni restricciones) para CREATE TABLE"""
+    if compact:
+        return """
+        sensor_key INT NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        temperature FLOAT NOT NULL,
+        humidity FLOAT NOT NULL,
+        battery_level INT NOT NULL"""
+    return """
+        sensor_id VARCHAR(50) NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        temperature FLOAT NOT NULL,
+        humidity FLOAT NOT NULL,
+        latitude DECIMAL(9,6) NOT NULL,
+        longitude DECIMAL(9,6) NOT NULL,
+        battery_level INT NOT NULL"""
+
+def register(cursor, schema):
+    """Detecta el formato de sensor_data y crea la vista sensor_readings con el formato completo.
+
+    La vista tiene siempre las columnas históricas (id, sensor_id, timestamp, ...,
+    latitude, longitude, battery_level), así que las consultas y los resúmenes leen
+    igual ambos formatos. Retorna True si la tabla es compacta.
+    """
+    compact = has_sensor_key(cursor, schema)
+    if compact:
+        source = f"""
+        SELECT d.id, s.sensor_id, d.timestamp, d.temperature, d.humidity, s.latitude, s.longitude, d.battery_level
+        FROM {schema}.sensor_data d
+        JOIN {schema}.sensors s ON s.sensor_key = d.sensor_key
+        """
+    else:
+        source = f"""
+        SELECT id, sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level
+        FROM {schema}.sensor_data
+        """
+    cursor.execute("SELECT pg_get_viewdef(to_regclass(%s))", (f"{schema}.sensor_readings",))
+    definition = cursor.fetchone()[0]
+    # Solo se redefine si cambió el formato: CREATE OR REPLACE bloquea la vista frente a los lectores
+    if definition is None or ("sensor_key" in definition) != compact:
+        cursor.execute(f"DROP VIEW IF EXISTS {schema}.sensor_readings")
+        cursor.execute(f"CREATE VIEW {schema}.sensor_readings AS {source}")
+    with _lock:
+        _compact[schema] = compact
+    return compact
+
+def is_compact(schema):
+    return _compact.get(schema, False)
+
+def readings_table(cursor, schema):
+    """Relación con el formato completo de las mediciones: la vista si existe, si no sensor_data"""
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.sensor_readings",))
+    return f"{schema}.sensor_readings" if cursor.fetchone()[0] else f"{schema}.sensor_data"
+
+class SensorCache:
+    """Caché LRU acotada sensor_id -> (sensor_key, latitud, longitud, located_at) de la dimensión sensors.
+
+    Los sensores son fijos, así que casi todos los lotes se resuelven en memoria; solo
+    los sensores nuevos, los que cambiaron de ubicación o los que salieron de la caché
+    se consultan y escriben en sensors. Se comparte entre los escritores de un cargador.
+    """
+
+    def __init__(self, schema, maxsize=SENSOR_CACHE_SIZE):
+        self.schema = schema
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, records):
+        """Retorna {sensor_id: sensor_key} de los sensores del lote, registrando los nuevos o movidos"""
+        # Un solo recorrido: queda el último registro de cada sensor, que en un archivo ordenado
+        # por tiempo tiene la ubicación más reciente
+        last = {record[0]: record for record in records}
+        keys = {}
+        changed = {}
+        with self._lock:
+            for sensor_id, record in last.items():
+                entry = self._entries.get(sensor_id)
+                if entry is not None and entry[1:3] == _location(record):
+                    self._entries.move_to_end(sensor_id)
+                    keys[sensor_id] = entry[0]
+                else:
+                    changed[sensor_id] = entry
+        if not changed:
+            return keys
+        # Solo para los sensores sin caché o con otra ubicación se busca la lectura más reciente
+        import validation  # Al usarse: importa numpy y las consultas no lo necesitan
+        observed = {}
+        for record in records:
+            if record[0] in changed:
+                timestamp = validation.parse_timestamp(record[1])
+                current = observed.get(record[0])
+                if current is None or timestamp > current[2]:
+                    observed[record[0]] = (*_location(record), timestamp)
+        pending = {}
+        for sensor_id, entry in changed.items():
+            # Una lectura anterior a la que fijó la ubicación conocida (archivo atrasado o de
+            # otro escritor) no la reemplaza
+            if entry is not None and observed[sensor_id][2] <= entry[3]:
+                keys[sensor_id] = entry[0]
+            else:
+                pending[sensor_id] = observed[sensor_id]
+        if pending:
+            stored = self._store(pending)
+            with self._lock:
+                for sensor_id, entry in stored.items():
+                    self._entries[sensor_id] = entry
+                    self._entries.move_to_end(sensor_id)
+                    keys[sensor_id] = entry[0]
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return keys
+
+    def compact_records(self, records):
+        """Convierte registros validados al formato compacto (sensor_key, timestamp, temperature, humidity, battery_level)"""
+        keys = self.resolve(records)
+        return [(keys[sensor_id], timestamp, temperature, humidity, battery_level)
+                for sensor_id, timestamp, temperature, humidity, _, _, battery_level in records]
+
+    def _select(self, cursor, sensor_ids):
+        cursor.execute(f"""
+        SELECT sensor_key, sensor_id, latitude, longitude, located_at
+        FROM {self.schema}.sensors WHERE sensor_id = ANY(%s)
+        """, (list(sensor_ids),))
+        return {sensor_id: (sensor_key, float(latitude), float(longitude), located_at)
+                for sensor_key, sensor_id, latitude, longitude, located_at in cursor.fetchall()}
+
+    def _store(self, pending):
+        """Lee y, si hace falta, inserta o actualiza los sensores en una transacción propia.
+
+        pending es {sensor_id: (latitud, longitud, located_at)}. La ubicación solo se
+        reemplaza con una lectura posterior a la que la fijó, así que el resultado no
+        depende del orden en que los escritores procesan los archivos. Se confirma
+        enseguida, fuera de la transacción del archivo: así la clave es visible para
+        todos los escritores y no se bloquean entre sí en la fila del sensor. Si la
+        carga del archivo se deshace, el sensor registrado no estorba.
+        """
+        with db.connection() as conn:
+            with conn.cursor() as cursor:
+                stored = self._select(cursor, pending)
+                changes = {}
+                for sensor_id, (latitude, longitude, located_at) in pending.items():
+                    entry = stored.get(sensor_id)
+                    if entry is None or (entry[1:3] != (latitude, longitude) and located_at > entry[3]):
+                        changes[sensor_id] = (latitude, longitude, located_at)
+                if changes:
+                    # Orden estable de claves: dos escritores con los mismos sensores no se bloquean en ciclo
+                    execute_values(cursor, f"""
+                    INSERT INTO {self.schema}.sensors AS s (sensor_id, latitude, longitude, located_at) VALUES %s
+                    ON CONFLICT (sensor_id) DO UPDATE
+                    SET latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+                        located_at = EXCLUDED.located_at, updated_at = now()
+                    WHERE EXCLUDED.located_at > s.located_at
+                    """, [(sensor_id, *changes[sensor_id]) for sensor_id in sorted(changes)],
+                        page_size=len(changes))
+                    # Otro escritor pudo registrar una ubicación posterior entre la lectura y la escritura
+                    for sensor_id, entry in self._select(cursor, changes).items():
+                        if sensor_id in stored and stored[sensor_id][1:3] != entry[1:3]:
+                            logger.info(f"El sensor {sensor_id} cambió de ubicación: "
+                                        f"{stored[sensor_id][1:3]} -> {entry[1:3]}")
+                        stored[sensor_id] = entry
+            conn.commit()
+        return stored
+
+    def __len__(self):
+        return len(self._entries)
+
+def _location(record):
+    """Ubicación de un registro validado redondeada a la precisión de DECIMAL(9,6)"""
+    return round(float(record[4]), 6), round(float(record[5]), 6)
+
+def sensors_in_bbox(cursor, schema, min_lat, min_lon, max_lat, max_lon):
+    """Sensores dentro del rectángulo (bordes incluidos), resuelto con el índice GiST"""
+    cursor.execute(f"""
+    SELECT sensor_id, latitude, longitude
+    FROM {schema}.sensors
+    WHERE point(longitude::float8, latitude::float8) <@ box(point(%s, %s), point(%s, %s))
+    ORDER BY sensor_id
+    """, (min_lon, min_lat, max_lon, max_lat))
+    return [SensorLocation(sensor_id, float(latitude), float(longitude), None)
+            for sensor_id, latitude, longitude in cursor.fetchall()]
+
+def sensors_within(cursor, schema, latitude, longitude, radius_km):
+    """Sensores a menos de radius_km del punto, del más cercano al más lejano.
+
+    El índice GiST filtra por el rectángulo que contiene al círculo y la distancia
+    exacta (haversine) se calcula solo para esos candidatos.
+    """
+    lat_delta = radius_km / KM_PER_DEGREE
+    cos_lat = cos(radians(min(89.9, abs(latitude) + lat_delta)))
+    lon_delta = min(180.0, radius_km / (KM_PER_DEGREE * cos_lat))
+    cursor.execute(f"""
+    SELECT sensor_id, latitude, longitude, distance_km FROM (
+        SELECT sensor_id, latitude, longitude,
+               2 * %(radius)s * asin(least(1.0, sqrt(
+                   power(sin(radians(latitude::float8 - %(lat)s) / 2), 2) +
+                   cos(radians(%(lat)s)) * cos(radians(latitude::float8)) *
+                   power(sin(radians(longitude::float8 - %(lon)s) / 2), 2)
+               ))) AS distance_km
+        FROM {schema}.sensors
+        WHERE point(longitude::float8, latitude::float8)
+              <@ box(point(%(lon)s - %(lon_delta)s, %(lat)s - %(lat_delta)s),
+                     point(%(lon)s + %(lon_delta)s, %(lat)s + %(lat_delta)s))
+    ) candidates
+    WHERE distance_km <= %(km)s
+    ORDER BY distance_km, sensor_id
+    """, {"radius": EARTH_RADIUS_KM, "lat": latitude, "lon": longitude, "km": radius_km,
+          "lat_delta": lat_delta, "lon_delta": lon_delta})
+    return [SensorLocation(sensor_id, float(lat), float(lon), distance)
+            for sensor_id, lat, lon, distance in cursor.fetchall()]
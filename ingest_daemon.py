@@ -0,0 +1,429 @@
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+if __name__ == "__main__":
+    # El .env debe estar cargado antes de importar el cargador y sus módulos
+    import cli
+    cli.load_environment()
+
+import db
+import latest
+import metrics
+import s3_to_postgress
+from s3_to_postgress import S3ToPostgresLoader
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Origen de objetos nuevos: "poll" lista el bucket periódicamente; "sqs" consume notificaciones de S3
+EVENT_SOURCE = os.getenv("EVENT_SOURCE", "poll")
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "2"))  # Segundos entre listados en modo poll
+SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
+SQS_ENDPOINT_URL = os.getenv("SQS_ENDPOINT_URL") or None  # Opcional: SQS local (ElasticMQ, moto server)
+SQS_WAIT_SECONDS = int(os.getenv("SQS_WAIT_SECONDS", "10"))  # Long polling de receive_message
+MAX_PENDING_OBJECTS = int(os.getenv("MAX_PENDING_OBJECTS", "1000"))  # Claves en espera antes de dejar de recibir
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))  # Particiones y retención
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))  # Espera máxima para vaciar las colas al detenerse
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "300"))  # Espera máxima antes de reintentar un archivo
+
+def parse_s3_event(body):
+    """Extrae los objetos creados de una notificación de S3 (directa o a través de SNS).
+
+    Retorna una lista de diccionarios con Key, ETag, Size y LastModified.
+    """
+    try:
+        event = json.loads(body)
+    except (TypeError, ValueError):
+        return []
+    if isinstance(event, dict) and "Message" in event and "Records" not in event:
+        # Notificación reenviada por SNS
+        return parse_s3_event(event["Message"])
+    objects = []
+    for record in event.get("Records", []) if isinstance(event, dict) else []:
+        if not str(record.get("eventName", "")).startswith("ObjectCreated"):
+            continue
+        s3_object = record.get("s3", {}).get("object", {})
+        if "key" not in s3_object:
+            continue
+        try:
+            event_time = datetime.fromisoformat(record["eventTime"].replace("Z", "+00:00"))
+        except (KeyError, ValueError):
+            event_time = None
+        objects.append({
+            "Key": unquote_plus(s3_object["key"]),
+            "ETag": str(s3_object.get("eTag", "")).strip('"'),
+            "Size": s3_object.get("size", 0),
+            "LastModified": event_time,
+        })
+    return objects
+
+class IngestDaemon:
+    """Carga continua: un origen de claves, DOWNLOAD_WORKERS descargadores y DB_WRITERS escritores.
+
+    Las colas acotadas propagan la contrapresión hacia el origen: si PostgreSQL no da
+    abasto, se deja de listar o de recibir mensajes hasta que haya espacio.
+    """
+
+    def __init__(self, s3_client=None, sqs_client=None, source=EVENT_SOURCE, queue_url=SQS_QUEUE_URL):
+        self.loader = S3ToPostgresLoader(s3_client=s3_client)
+        self.loader.incremental = True
+        self.source = source
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client
+        if source == "sqs" and sqs_client is None:
+            import boto3
+            self.sqs_client = boto3.client("sqs", region_name=s3_to_postgress.REGION, endpoint_url=SQS_ENDPOINT_URL)
+        self.stop_event = threading.Event()
+        self.key_queue = queue.Queue(maxsize=MAX_PENDING_OBJECTS)
+        self.result_queue = queue.Queue(maxsize=s3_to_postgress.PREFETCH_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self.in_flight = set()  # Claves encoladas o en proceso
+        self.retry_at = {}  # Clave -> (fallos, momento del próximo intento)
+        self.messages = {}  # MessageId de SQS -> {"receipt": ..., "keys": claves pendientes}
+        self.key_messages = {}  # Clave -> MessageIds que la incluyen
+        self.writers = []
+        self.stats = {"files": 0, "rows": 0, "failed": 0}
+
+    def start(self):
+        """Prepara la base de datos y lanza todos los hilos; retorna False si no se pudo preparar"""
+        if self.source == "sqs" and not self.queue_url:
+            logger.error("EVENT_SOURCE=sqs requiere SQS_QUEUE_URL")
+            return False
+        if not self.loader.connect_db():
+            return False
+        if not self.loader.prepare():
+            self.loader.close_connection()
+            return False
+        if latest.MAINTAIN_LATEST:
+            metrics.serve_latest(self.loader.latest)
+        self.last_maintenance = time.monotonic()
+
+        for i in range(max(1, s3_to_postgress.DB_WRITERS)):
+            writer = S3ToPostgresLoader(s3_client=self.loader.s3_client)
+            writer.object_meta = self.loader.object_meta
+            writer.completed_keys = self.loader.completed_keys
+            writer.incremental = True
+            writer.completion = self.loader.completion
+            writer.latest = self.loader.latest
+            writer.sensor_cache = self.loader.sensor_cache
+            writer.batch_size = self.loader.batch_size
+            if not writer.connect_db():
+                continue
+            self.writers.append(writer)
+        if not self.writers:
+            logger.error("No se pudo iniciar ningún escritor de base de datos")
+            self.loader.close_connection()
+            return False
+
+        source_target = self._sqs_loop if self.source == "sqs" else self._poll_loop
+        self.source_thread = threading.Thread(target=source_target, name=f"source-{self.source}")
+        self.download_threads = [
+            threading.Thread(target=self._download_loop, name=f"s3-download-{i}")
+            for i in range(max(1, s3_to_postgress.DOWNLOAD_WORKERS))
+        ]
+        self.writer_threads = [
+            threading.Thread(target=self._writer_loop, args=(writer,), name=f"db-writer-{i}")
+            for i, writer in enumerate(self.writers)
+        ]
+        for thread in [self.source_thread, *self.download_threads, *self.writer_threads]:
+            thread.start()
+        logger.info(f"Daemon iniciado (origen {self.source}, {len(self.download_threads)} descargadores, "
+                    f"{len(self.writers)} escritores)")
+        return True
+
+    def _put(self, target_queue, item):
+        """put bloqueante que se puede abandonar al detener el daemon"""
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def submit(self, key, message_id=None, etag=None):
+        """Encola una clave si no está ya en proceso, esperando un reintento o ya cargada.
+
+        Una clave confirmada por un escritor después del listado (o de leer el manifiesto)
+        se omite si el manifiesto ya tiene el ETag visto por el origen. Sin ETag (los
+        metadatos se descartaron al confirmarla) también se omite: si el objeto cambió, el
+        siguiente listado lo volverá a encontrar.
+        """
+        with self._lock:
+            if message_id is not None:
+                self.key_messages.setdefault(key, set()).add(message_id)
+            if key in self.in_flight:
+                return False
+            failures = self.retry_at.get(key)
+            if failures and failures[1] > time.monotonic():
+                return False
+            # _finish saca la clave de in_flight después de que el escritor la agregó a
+            # completed_keys, así que una carga ya confirmada siempre se ve aquí
+            completed = key in self.loader.completed_keys
+        if completed and (etag is None or self._manifest_etags([key]).get(key) == etag):
+            with self._lock:
+                self.loader.object_meta.pop(key, None)
+                to_delete = self._release_messages(key)
+            for receipt in to_delete:
+                self._delete_message(receipt)
+            return False
+        with self._lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+        if not self._put(self.key_queue, key):
+            with self._lock:
+                self.in_flight.discard(key)
+            return False
+        return True
+
+    def _finish(self, key, ok):
+        """Registra el resultado de un archivo: borra sus mensajes de SQS o programa el reintento"""
+        with self._lock:
+            self.in_flight.discard(key)
+            message_ids = self.key_messages.pop(key, set())
+            if not ok:
+                failures = self.retry_at.get(key, (0, 0))[0] + 1
+                delay = min(RETRY_BACKOFF_MAX, POLL_INTERVAL * 2 ** failures)
+                self.retry_at[key] = (failures, time.monotonic() + delay)
+                return
+            self.retry_at.pop(key, None)
+            meta = self.loader.object_meta.pop(key, None)
+            to_delete = self._release_messages(key, message_ids)
+        for receipt in to_delete:
+            self._delete_message(receipt)
+        last_modified = meta.get("LastModified") if meta else None
+        if last_modified is not None:
+            metrics.observe("s3_loader_object_latency_seconds",
+                            (datetime.now(timezone.utc) - last_modified).total_seconds())
+
+    def _release_messages(self, key, message_ids=None):
+        """Quita la clave de sus mensajes de SQS; retorna los recibos de los que quedaron completos.
+
+        Se llama con self._lock tomado.
+        """
+        if message_ids is None:
+            message_ids = self.key_messages.pop(key, set())
+        to_delete = []
+        for message_id in message_ids:
+            message = self.messages.get(message_id)
+            if message is None:
+                continue
+            message["keys"].discard(key)
+            if not message["keys"]:
+                to_delete.append(self.messages.pop(message_id)["receipt"])
+        return to_delete
+
+    def _delete_message(self, receipt):
+        try:
+            self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+        except Exception as e:
+            # El mensaje volverá a la cola y el manifiesto evitará cargarlo dos veces
+            logger.warning(f"No se pudo borrar el mensaje de SQS: {e}")
+
+    def _maintenance_due(self):
+        now = time.monotonic()
+        if now - self.last_maintenance >= MAINTENANCE_INTERVAL:
+            self.last_maintenance = now
+            return True
+        return False
+
+    def _poll_loop(self):
+        """Lista periódicamente los objetos pendientes según el manifiesto y el cursor"""
+        loader = self.loader
+        while not self.stop_event.is_set():
+            if self._maintenance_due():
+                loader.manage_partitions()
+            pending = loader.get_pending_files()
+            pending_set = set(pending)
+            # Solo se conservan los metadatos de objetos que aún se van a cargar
+            for key in getattr(loader, "listed_keys", []):
+                if key not in pending_set:
+                    loader.object_meta.pop(key, None)
+            for key in pending:
+                if self.stop_event.is_set():
+                    break
+                self.submit(key, etag=(loader.object_meta.get(key) or {}).get("ETag"))
+            last_key = loader.advance_cursor()
+            with self._lock:
+                # Las claves anteriores al cursor ya no se vuelven a listar (sin cursor, ninguna hace
+                # falta). Las que siguen en proceso se conservan: su escritor aún debe comprobarlas.
+                if last_key is not None or not s3_to_postgress.S3_KEYS_ORDERED:
+                    loader.completed_keys.difference_update([
+                        key for key in list(loader.completed_keys)
+                        if key not in self.in_flight and (last_key is None or key <= last_key)
+                    ])
+            self.stop_event.wait(POLL_INTERVAL)
+
+    def _sqs_loop(self):
+        """Recibe notificaciones de S3 desde SQS; solo pide tantos mensajes como espacio haya"""
+        loader = self.loader
+        while not self.stop_event.is_set():
+            if self._maintenance_due():
+                loader.manage_partitions()
+            free = self.key_queue.maxsize - self.key_queue.qsize()
+            if free <= 0:
+                self.stop_event.wait(0.5)
+                continue
+            try:
+                response = self.sqs_client.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=max(1, min(10, free)),
+                    WaitTimeSeconds=SQS_WAIT_SECONDS,
+                )
+            except Exception as e:
+                logger.error(f"Error recibiendo mensajes de SQS: {e}")
+                self.stop_event.wait(POLL_INTERVAL)
+                continue
+
+            messages = response.get("Messages", [])
+            events = [(message, parse_s3_event(message.get("Body"))) for message in messages]
+            keys = [obj["Key"] for _, objects in events for obj in objects]
+            known = self._manifest_etags(keys)
+            for message, objects in events:
+                # Igual que el listado: se ignoran las copias de procesados (su copia también genera eventos)
+                pending = [
+                    obj for obj in objects
+                    if obj["Key"].startswith(s3_to_postgress.S3_PREFIX)
+                    and not obj["Key"].startswith(s3_to_postgress.PROCESSED_PREFIX)
+                    and known.get(obj["Key"]) != obj["ETag"]
+                ]
+                if not pending:
+                    # Eventos de prueba, de otro tipo u objetos ya cargados
+                    self._delete_message(message["ReceiptHandle"])
+                    continue
+                with self._lock:
+                    self.messages[message["MessageId"]] = {
+                        "receipt": message["ReceiptHandle"],
+                        "keys": {obj["Key"] for obj in pending},
+                    }
+                for obj in pending:
+                    loader.object_meta[obj["Key"]] = obj
+                    self.submit(obj["Key"], message["MessageId"], obj["ETag"])
+
+    def _manifest_etags(self, keys):
+        """ETag registrado en el manifiesto para cada clave ya cargada"""
+        if not keys:
+            return {}
+        loader = self.loader
+        try:
+            loader.cursor.execute(
+                f"SELECT object_key, etag FROM {s3_to_postgress.DB_SCHEMA}.ingest_manifest WHERE object_key = ANY(%s)",
+                (keys,)
+            )
+            known = dict(loader.cursor.fetchall())
+            loader.conn.commit()
+            return known
+        except Exception as e:
+            loader.conn.rollback()
+            logger.warning(f"No se pudo consultar el manifiesto: {e}")
+            return {}
+
+    def _download_loop(self):
+        """Descarga y parsea claves de la cola hasta que el daemon se detenga"""
+        while not self.stop_event.is_set():
+            try:
+                key = self.key_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            data = None if s3_to_postgress.STREAM_PARSE else self.loader.download_and_parse_file(key)
+            if not self._put(self.result_queue, (key, data)):
+                self._finish(key, False)
+
+    def _writer_loop(self, writer):
+        """Inserta archivos parseados en grupos de commit; al detenerse termina los que ya estaban descargados"""
+        while True:
+            remaining = writer.group.remaining()
+            try:
+                item = self.result_queue.get(timeout=1 if remaining is None else min(1, remaining))
+            except queue.Empty:
+                if writer.group.remaining() == 0:
+                    self._finish_results(writer.flush_group())
+                if self.stop_event.is_set() and not any(t.is_alive() for t in self.download_threads):
+                    self._finish_results(writer.flush_group())
+                    return
+                continue
+            key, data = item
+            try:
+                if writer.conn is None or writer.conn.closed:
+                    # La conexión se perdió (p. ej. reinicio de PostgreSQL): pedir otra al pool.
+                    # El grupo abierto solo guarda datos parseados, así que no se pierde nada.
+                    writer.close_connection()
+                    writer.connect_db()
+                results = writer.add_file(key, data)
+            except Exception as e:
+                logger.error(f"Error procesando archivo {key}: {e}")
+                results = [(key, 0, False)]
+            self._finish_results(results)
+
+    def _finish_results(self, results):
+        """Actualiza las estadísticas y libera las claves de archivos ya confirmados o fallidos"""
+        for key, rows, ok in results:
+            with self._lock:
+                self.stats["files" if ok else "failed"] += 1
+                self.stats["rows"] += rows if ok else 0
+            self._finish(key, ok)
+
+    def run(self):
+        """Ejecuta hasta recibir SIGTERM/SIGINT o hasta que falle el origen"""
+        if not self.start():
+            return False
+        try:
+            while not self.stop_event.wait(1):
+                metrics.set_gauge("s3_loader_queue_depth", self.key_queue.qsize(), queue="pending")
+                metrics.set_gauge("s3_loader_queue_depth", self.result_queue.qsize(), queue="parsed")
+                # Los borrados en lote no esperan indefinidamente a que se llene el lote
+                self.loader.completion.flush_if_stale()
+                if not self.source_thread.is_alive():
+                    logger.error("El hilo de origen terminó inesperadamente; deteniendo el daemon")
+                    self.stop_event.set()
+        finally:
+            self.shutdown()
+        return True
+
+    def shutdown(self):
+        """Deja de aceptar claves, termina los archivos ya descargados y libera las conexiones"""
+        self.stop_event.set()
+        logger.info("Deteniendo daemon: terminando archivos en curso...")
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for thread in [self.source_thread, *self.download_threads, *self.writer_threads]:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        alive = [thread.name for thread in self.writer_threads if thread.is_alive()]
+        if alive:
+            # Sus transacciones se deshacen al cerrar; los archivos se reintentarán en el próximo arranque
+            logger.warning(f"Escritores sin terminar tras {SHUTDOWN_TIMEOUT:.0f}s: {', '.join(alive)}")
+        else:
+            for writer in self.writers:
+                writer.close_connection()
+        self.loader.completion.flush()
+        self.loader.close_connection()
+        logger.info(f"Daemon detenido. Archivos cargados: {self.stats['files']}, "
+                    f"registros: {self.stats['rows']}, fallidos: {self.stats['failed']}")
+
+def main():
+    """Ejecuta el daemon de carga continua hasta recibir SIGTERM o SIGINT"""
+    daemon = IngestDaemon()
+
+    def handle_signal(signum, frame):
+        logger.info(f"Señal {signal.Signals(signum).name} recibida")
+        daemon.stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    try:
+        metrics.start()
+        daemon.run()
+    finally:
+        metrics.stop()
+        db.close_pool()
+
+if __name__ == "__main__":
+    import sys
+    import cli
+    cli.main(["load", "--daemon", *sys.argv[1:]])
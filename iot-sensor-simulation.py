@@ -1,21 +1,47 @@
-import boto3
+import argparse
 import json
 import random
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
+from io import BytesIO
+
+if __name__ == "__main__":
+    # Como script, el .env se carga antes de leer la configuración de este módulo y de sus importaciones
+    import cli
+    cli.load_environment()
+
+try:
+    import numpy as np  # Opcional: generación por lotes en el modo de carga
+except ImportError:
+    np = None
+
+import codec
+import columnar
+import compressed
 
 # Configuración de sensores
 SENSOR_COUNT = 5  # Número de sensores a simular
 MEASUREMENTS_PER_FILE = 10  # Mediciones por archivo JSON
 FILES_TO_GENERATE = 5  # Número de archivos JSON a generar
 TIME_INTERVAL = 60  # Intervalo máximo entre mediciones (segundos)
-FILE_INTERVAL = 2  # Intervalo entre archivos JSON (segundos) - reducido para pruebas locales
 
 # Configuración de AWS S3 (solo se usará si decides subir a S3)
 BUCKET_NAME = "awssensorsbucket"  # Reemplazar con tu nombre de bucket
 REGION = "us-east-1"  # Reemplazar con tu región
 UPLOAD_TO_S3 = True  # Cambiar a True cuando quieras subir a S3
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None  # Opcional: S3 local (MinIO, moto server)
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "16"))  # Subidas simultáneas en el modo de carga
+# Formato de los objetos en el modo de carga: "json", "parquet" o "arrow" (requieren pyarrow)
+OBJECT_FORMAT = os.getenv("OBJECT_FORMAT", "json")
+
+# Multipart solo para objetos grandes; las partes de cada objeto también se suben en paralelo
+MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD_MB", "16")) * 1024 * 1024
+MULTIPART_CHUNKSIZE = int(os.getenv("MULTIPART_CHUNKSIZE_MB", "8")) * 1024 * 1024
+MULTIPART_CONCURRENCY = int(os.getenv("MULTIPART_CONCURRENCY", "4"))
+
+_transfer_config = None
 
 # Directorio para guardar los archivos JSON
 OUTPUT_DIR = "sensor_data"
@@ -34,12 +60,27 @@ LOCATIONS = [
     {"latitude": 37.8029, "longitude": -122.4408}   # Golden Gate Park
 ]
 
-def initialize_s3_client():
+def transfer_config():
+    """TransferConfig de las subidas; boto3 se importa solo cuando se sube algo a S3"""
+    global _transfer_config
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                          multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                          max_concurrency=MULTIPART_CONCURRENCY)
+    return _transfer_config
+
+def initialize_s3_client(upload_workers=UPLOAD_WORKERS):
     """Inicializa y retorna un cliente S3."""
     print("Inicializando cliente S3...")
     try:
+        import boto3
+        from botocore.config import Config
         # Intenta usar credenciales configuradas (archivo ~/.aws/credentials o variables de entorno)
-        s3_client = boto3.client('s3', region_name=REGION)
+        # Un pool de conexiones HTTP suficiente para todas las subidas simultáneas
+        pool_size = max(10, upload_workers * MULTIPART_CONCURRENCY)
+        s3_client = boto3.client('s3', region_name=REGION, endpoint_url=S3_ENDPOINT_URL,
+                                 config=Config(max_pool_connections=pool_size))
         return s3_client
     except Exception as e:
         print(f"Error al inicializar cliente S3: {e}")
@@ -87,15 +128,9 @@ def generate_sensor_data(sensor_id, current_time):
         "battery_level": battery_level
     }
 
-def generate_measurements_file(file_number):
-    """Genera un archivo JSON con múltiples mediciones de diferentes sensores."""
-    # Crear directorio de salida si no existe
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
-        print(f"Directorio {OUTPUT_DIR} creado.")
-    
+def generate_measurements(base_time):
+    """Genera las mediciones de un archivo, de diferentes sensores, a partir de base_time."""
     measurements = []
-    base_time = datetime.now()
     
     # Generar mediciones para diferentes sensores
     for i in range(MEASUREMENTS_PER_FILE):
@@ -109,81 +144,315 @@ def generate_measurements_file(file_number):
         measurement = generate_sensor_data(sensor_id, measurement_time)
         measurements.append(measurement)
     
-    # Crear objeto JSON con todas las mediciones
-    data = {"measurements": measurements}
-    
-    # Escribir a archivo en el directorio de salida
-    filename = os.path.join(OUTPUT_DIR, f"sensor_data_{file_number}.json")
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
-    
-    print(f"Archivo {filename} generado con {len(measurements)} mediciones.")
-    return filename
+    return measurements
 
-def upload_file_to_s3(s3_client, filename):
-    """Sube un archivo al bucket S3."""
-    if s3_client is None:
-        print("Cliente S3 no inicializado. No se puede subir el archivo.")
-        return False
+def sensor_names(sensor_count):
+    """Identificadores THS-001 ... para sensor_count sensores"""
+    return [f"THS-{str(n).zfill(3)}" for n in range(1, sensor_count + 1)]
+
+def _timestamp_strings(base_time, offsets):
+    """Formatea base_time + offsets (segundos) en ISO 8601 sin llamar a strftime por registro"""
+    if np is not None:
+        base = np.datetime64(base_time.replace(microsecond=0), "s")
+        stamps = np.datetime_as_string(base + np.asarray(offsets, dtype="timedelta64[s]"), unit="s")
+        return [stamp + "Z" for stamp in stamps.tolist()]
+    cache = {}
+    result = []
+    for offset in offsets:
+        stamp = cache.get(offset)
+        if stamp is None:
+            stamp = cache[offset] = (base_time + timedelta(seconds=offset)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        result.append(stamp)
+    return result
+
+def file_span(count, sensor_count=SENSOR_COUNT, interval=TIME_INTERVAL):
+    """Segundos que cubre un archivo de count mediciones: al menos interval, y al menos uno
+    por cada lectura de un mismo sensor para que (sensor_id, timestamp) no se repita"""
+    return max(interval, -(-count // max(sensor_count, 1)))
+
+def generate_columns(count, base_time, sensor_count=SENSOR_COUNT, interval=TIME_INTERVAL):
+    """Genera count mediciones a partir de base_time, por columnas.
+
+    Los sensores se turnan (la medición i es del sensor i % sensor_count) y las lecturas
+    de cada sensor se reparten en file_span segundos, así que ninguna clave
+    (sensor_id, timestamp) se repite; el archivo siguiente debe empezar file_span
+    segundos después. Usa NumPy para generar cada campo de una vez; sin NumPy usa
+    random en un solo recorrido por campo. Retorna (índices de sensor, timestamps,
+    temperaturas, humedades, niveles de batería) como listas.
+    """
+    sensor_count = max(sensor_count, 1)
+    span = file_span(count, sensor_count, interval)
+    per_sensor = max(-(-count // sensor_count), 1)
+    if np is not None:
+        rng = np.random.default_rng()
+        positions = np.arange(count)
+        sensor_idx = (positions % sensor_count).tolist()
+        temperatures = np.round(rng.uniform(TEMP_MIN, TEMP_MAX, size=count), 1).tolist()
+        humidities = np.round(rng.uniform(HUMIDITY_MIN, HUMIDITY_MAX, size=count), 1).tolist()
+        batteries = rng.integers(BATTERY_MIN, BATTERY_MAX + 1, size=count).tolist()
+        offsets = (positions // sensor_count * span // per_sensor).tolist()
+    else:
+        sensor_idx = [i % sensor_count for i in range(count)]
+        temperatures = [round(random.uniform(TEMP_MIN, TEMP_MAX), 1) for _ in range(count)]
+        humidities = [round(random.uniform(HUMIDITY_MIN, HUMIDITY_MAX), 1) for _ in range(count)]
+        batteries = [random.randint(BATTERY_MIN, BATTERY_MAX) for _ in range(count)]
+        offsets = [i // sensor_count * span // per_sensor for i in range(count)]
+    return sensor_idx, _timestamp_strings(base_time, offsets), temperatures, humidities, batteries
+
+def sensor_location(index):
+    """Ubicación del sensor con índice base 0 (la misma que usa generate_sensor_data)"""
+    return LOCATIONS[(index + 1) % len(LOCATIONS)]
+
+def generate_measurements_batch(count, base_time, sensor_count=SENSOR_COUNT, interval=TIME_INTERVAL, names=None):
+    """Genera count mediciones con el mismo formato que generate_sensor_data"""
+    names = names or sensor_names(sensor_count)
+    sensor_idx, timestamps, temperatures, humidities, batteries = generate_columns(count, base_time, sensor_count, interval)
+    locations = [sensor_location(i) for i in range(sensor_count)]
+    return [
+        {
+            "sensor_id": names[idx],
+            "timestamp": timestamp,
+            "temperature": temperature,
+            "humidity": humidity,
+            "location": locations[idx],
+            "battery_level": battery_level
+        }
+        for idx, timestamp, temperature, humidity, battery_level
+        in zip(sensor_idx, timestamps, temperatures, humidities, batteries)
+    ]
+
+def encode_columns(columns, names):
+    """Serializa columnas de generate_columns en JSON compacto sin crear un dict por medición.
+
+    Las partes fijas de cada sensor (id y ubicación) se formatean una sola vez.
+    """
+    heads = [f'{{"sensor_id":{json.dumps(name)},"timestamp":"' for name in names]
+    tails = [
+        f',"location":{json.dumps(sensor_location(i), separators=(",", ":"))},"battery_level":'
+        for i in range(len(names))
+    ]
+    sensor_idx, timestamps, temperatures, humidities, batteries = columns
+    body = ",".join([
+        f'{heads[idx]}{timestamp}","temperature":{temperature!r},"humidity":{humidity!r}{tails[idx]}{battery_level}}}'
+        for idx, timestamp, temperature, humidity, battery_level
+        in zip(sensor_idx, timestamps, temperatures, humidities, batteries)
+    ])
+    return f'{{"measurements":[{body}]}}'.encode("utf-8")
+
+def encode_columnar(columns, names, object_format, compression=columnar.COLUMNAR_COMPRESSION):
+    """Serializa columnas de generate_columns en Parquet o Arrow IPC con la ubicación en dos columnas"""
+    sensor_idx, timestamps, temperatures, humidities, batteries = columns
+    latitudes = [sensor_location(i)["latitude"] for i in range(len(names))]
+    longitudes = [sensor_location(i)["longitude"] for i in range(len(names))]
+    return columnar.encode_columns({
+        "sensor_id": [names[idx] for idx in sensor_idx],
+        "timestamp": timestamps,
+        "temperature": temperatures,
+        "humidity": humidities,
+        "latitude": [latitudes[idx] for idx in sensor_idx],
+        "longitude": [longitudes[idx] for idx in sensor_idx],
+        "battery_level": batteries,
+    }, object_format, compression)
+
+def run_load_generator(sensor_count, rows_per_file, file_count, rate, output_dir=None, s3_client=None,
+                       upload_workers=UPLOAD_WORKERS, object_format=OBJECT_FORMAT, compression=None):
+    """Genera archivos tan rápido como sea posible (o a rate mediciones/s) y reporta el rendimiento.
+
+    Con s3_client los archivos se suben desde memoria en un pool de hilos mientras se
+    generan los siguientes; con output_dir además se escriben en disco. object_format
+    elige JSON compacto o lotes por columnas (Parquet/Arrow IPC). compression se aplica
+    al objeto JSON completo (gzip/zstd) o dentro del formato por columnas; por defecto
+    OBJECT_COMPRESSION o COLUMNAR_COMPRESSION respectivamente.
+    Retorna un diccionario con filas, archivos, bytes, segundos y filas por segundo.
+    """
+    if object_format != "json" and not columnar.available():
+        raise RuntimeError(f"El formato {object_format} requiere pyarrow")
+    if object_format == "json":
+        compression = compression or compressed.OBJECT_COMPRESSION
+        extension = ".json" + compressed.SUFFIXES.get(compression, "")
+        extra_args = compressed.upload_args(compression)
+    else:
+        compression = compression or columnar.COLUMNAR_COMPRESSION
+        extension = columnar.EXTENSIONS[object_format]
+        # El formato también se declara en los metadatos por si la clave se renombra
+        extra_args = {"Metadata": {columnar.FORMAT_METADATA_KEY: object_format},
+                      "ContentType": columnar.CONTENT_TYPES[object_format]}
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    names = sensor_names(sensor_count)
+    base_time = datetime.now()
+    run_id = base_time.strftime("%Y%m%d%H%M%S")
+    rows = total_bytes = failed = 0
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=upload_workers) if s3_client is not None else None
+    start = time.perf_counter()
+    try:
+        for n in range(1, file_count + 1):
+            columns = generate_columns(rows_per_file, base_time, sensor_count, interval=TIME_INTERVAL)
+            base_time += timedelta(seconds=file_span(rows_per_file, sensor_count))
+            if object_format == "json":
+                body = compressed.compress(encode_columns(columns, names), compression)
+            else:
+                body = encode_columnar(columns, names, object_format, compression)
+            # Claves únicas por ejecución y en orden, para no sobrescribir cargas anteriores
+            object_name = f"sensor_data_{run_id}_{n:06d}{extension}"
+            if output_dir:
+                with open(os.path.join(output_dir, object_name), "wb") as f:
+                    f.write(body)
+            if executor is not None:
+                # Limitar las subidas en curso acota la memoria ocupada por cuerpos pendientes
+                while len(pending) >= upload_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    failed += sum(1 for future in done if not future.result())
+                pending.add(executor.submit(upload_bytes_to_s3, s3_client, body, object_name, extra_args))
+            rows += rows_per_file
+            total_bytes += len(body)
+            
+            # Solo se espera si se va por delante de la tasa objetivo
+            if rate > 0:
+                ahead = rows / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        failed += sum(1 for future in pending if not future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
     
+    elapsed = time.perf_counter() - start
+    stats = {
+        "rows": rows,
+        "files": file_count,
+        "failed_uploads": failed,
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1) if elapsed else 0.0,
+        "files_per_second": round(file_count / elapsed, 1) if elapsed else 0.0,
+    }
+    destination = f" y subidas a '{BUCKET_NAME}'" if s3_client is not None else ""
+    print(f"Generadas{destination} {rows} mediciones de {sensor_count} sensores en {file_count} archivos {object_format} "
+          f"({total_bytes / 1e6:.1f} MB) en {elapsed:.2f}s: {stats['rows_per_second']:.0f} mediciones/s, "
+          f"{stats['files_per_second']:.1f} archivos/s")
+    if failed:
+        print(f"Fallaron {failed} subidas.")
+    return stats
+
+def upload_bytes_to_s3(s3_client, body, object_name, extra_args=None):
+    """Sube un objeto a S3 desde memoria, sin pasar por disco."""
     try:
-        object_name = os.path.basename(filename)
-        print(f"Subiendo {filename} a S3...")
-        s3_client.upload_file(filename, BUCKET_NAME, object_name)
-        print(f"Archivo {filename} subido exitosamente a '{BUCKET_NAME}/{object_name}'")
+        s3_client.upload_fileobj(BytesIO(body), BUCKET_NAME, object_name, ExtraArgs=extra_args,
+                                 Config=transfer_config())
         return True
     except Exception as e:
-        print(f"Error al subir archivo a S3: {e}")
+        print(f"Error al subir {object_name} a S3: {e}")
         return False
 
-def main():
-    """Función principal que ejecuta la simulación y opcionalmente carga de datos."""
+def run_simulation(output_dir=None, upload_workers=UPLOAD_WORKERS, compression=compressed.OBJECT_COMPRESSION):
+    """Ejecuta la simulación y opcionalmente carga de datos.
+
+    Cada archivo se genera en memoria y se sube a S3 desde el mismo pool de hilos que
+    el modo de carga, sin pausas entre archivos; cada archivo cubre los TIME_INTERVAL
+    segundos siguientes al anterior. Con output_dir (o si no se sube a S3) los
+    archivos también se escriben en disco.
+    """
     # Usar la variable global UPLOAD_TO_S3, no crear una nueva variable local
     global UPLOAD_TO_S3
     
     # Inicializar cliente S3 solo si vamos a subir archivos
-    s3_client = initialize_s3_client() if UPLOAD_TO_S3 else None
+    s3_client = initialize_s3_client(upload_workers) if UPLOAD_TO_S3 else None
     
     # Crear bucket si no existe (solo si vamos a subir archivos)
     if UPLOAD_TO_S3 and s3_client is not None:
         if not create_bucket_if_not_exists(s3_client):
             print("No se pudo crear/verificar el bucket. Continuando sin subir a S3.")
             UPLOAD_TO_S3 = False  # Aquí es donde necesitamos la declaración global
+    if not UPLOAD_TO_S3 or s3_client is None:
+        s3_client = None
+        # Sin S3 el disco es el único destino
+        output_dir = output_dir or OUTPUT_DIR
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"Directorio {output_dir} creado.")
     
-    # Lista para almacenar nombres de archivos generados
-    generated_files = []
-    
-    # Generar archivos y opcionalmente subirlos
-    for i in range(1, FILES_TO_GENERATE + 1):
-        # Generar archivo con mediciones
-        filename = generate_measurements_file(i)
-        generated_files.append(filename)
-        
-        # Subir archivo a S3 si está habilitado
-        if UPLOAD_TO_S3:
-            uploaded = upload_file_to_s3(s3_client, filename)
-            if not uploaded:
-                print("Ocurrió un error al subir el archivo. Continuando con el siguiente...")
-        
-        # Esperar antes de generar el siguiente archivo (excepto el último)
-        if i < FILES_TO_GENERATE:
-            print(f"Esperando {FILE_INTERVAL} segundos antes de generar el siguiente archivo...")
-            time.sleep(FILE_INTERVAL)
+    suffix = compressed.SUFFIXES.get(compression, "")
+    extra_args = compressed.upload_args(compression)
+    base_time = datetime.now()
+    first_measurements = None
+    failed = 0
+    pending = []
+    executor = ThreadPoolExecutor(max_workers=upload_workers) if s3_client is not None else None
+    try:
+        for i in range(1, FILES_TO_GENERATE + 1):
+            # Generar archivo con mediciones
+            measurements = generate_measurements(base_time)
+            base_time += timedelta(seconds=TIME_INTERVAL)
+            if first_measurements is None:
+                first_measurements = measurements
+            body = compressed.compress(codec.dumps({"measurements": measurements}), compression)
+            object_name = f"sensor_data_{i}.json{suffix}"
+            if output_dir:
+                with open(os.path.join(output_dir, object_name), 'wb') as f:
+                    f.write(body)
+            if executor is not None:
+                pending.append(executor.submit(upload_bytes_to_s3, s3_client, body, object_name, extra_args))
+            print(f"Archivo {object_name} generado con {len(measurements)} mediciones.")
+        failed = sum(1 for future in pending if not future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
     
     print("\nResumen:")
-    print(f"Se generaron {FILES_TO_GENERATE} archivos JSON en el directorio '{OUTPUT_DIR}'")
-    if UPLOAD_TO_S3:
-        print(f"Los archivos fueron subidos al bucket S3 '{BUCKET_NAME}'")
+    print(f"Se generaron {FILES_TO_GENERATE} archivos JSON")
+    if output_dir:
+        print(f"Los archivos se escribieron en el directorio '{output_dir}'")
+    if s3_client is not None:
+        print(f"Se subieron {len(pending) - failed} archivos al bucket S3 '{BUCKET_NAME}'")
+        if failed:
+            print(f"Fallaron {failed} subidas.")
     print("Proceso completado exitosamente.")
     
     # Mostrar estructura de un archivo para verificación
     print("\nEstructura de ejemplo (primer archivo):")
-    if generated_files:
-        with open(generated_files[0], 'r') as f:
-            data = json.load(f)
-            # Mostrar solo la primera medición para no saturar la salida
-            print(json.dumps({"measurements": [data["measurements"][0], "..."]}, indent=2))
-            print(f"El archivo contiene {len(data['measurements'])} mediciones en total.")
+    if first_measurements:
+        # Mostrar solo la primera medición para no saturar la salida
+        print(json.dumps({"measurements": [first_measurements[0], "..."]}, indent=2))
+        print(f"El archivo contiene {len(first_measurements)} mediciones en total.")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulador de sensores IoT")
+    parser.add_argument("--load", action="store_true",
+                        help="Modo generador de carga: lotes grandes, JSON compacto y sin pausas")
+    parser.add_argument("--sensors", type=int, default=1000, help="Número de sensores (modo carga)")
+    parser.add_argument("--rows-per-file", type=int, default=100000, help="Mediciones por archivo (modo carga)")
+    parser.add_argument("--files", type=int, default=10, help="Número de archivos (modo carga)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Mediciones por segundo objetivo (0 = sin límite)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="Directorio de salida")
+    parser.add_argument("--upload", action="store_true",
+                        help="Subir los archivos generados a S3 desde memoria (modo carga)")
+    parser.add_argument("--keep-files", action="store_true",
+                        help="Escribir también los archivos en --output-dir cuando se suben a S3")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS, help="Subidas simultáneas")
+    parser.add_argument("--format", choices=["json", "parquet", "arrow"], default=OBJECT_FORMAT,
+                        help="Formato de los objetos (modo carga)")
+    parser.add_argument("--compression",
+                        help="Compresión: gzip, zstd o none para JSON; zstd, lz4, gzip, snappy o none "
+                             "para Parquet/Arrow (por defecto OBJECT_COMPRESSION o COLUMNAR_COMPRESSION)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Función principal: simulación por defecto o generador de carga con --load"""
+    args = parse_args(argv)
+    if args.load:
+        client = initialize_s3_client(args.upload_workers) if args.upload else None
+        if client is not None and not create_bucket_if_not_exists(client):
+            client = None
+        # Al subir a S3 el disco solo se usa si se pide explícitamente
+        output_dir = args.output_dir if client is None or args.keep_files else None
+        run_load_generator(args.sensors, args.rows_per_file, args.files, args.rate, output_dir, client,
+                           upload_workers=args.upload_workers, object_format=args.format,
+                           compression=args.compression)
+    else:
+        run_simulation(args.output_dir if args.keep_files else None, upload_workers=args.upload_workers)
 
 if __name__ == "__main__":
     main()
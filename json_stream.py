@@ -0,0 +1,145 @@
+import codecs
+import json
+from itertools import islice
+
+try:
+    import ijson  # Opcional: parser incremental en C
+except ImportError:
+    ijson = None
+
+CHUNK_SIZE = 64 * 1024  # Bytes leídos del stream en cada lectura
+
+class PrefixedStream:
+    """Stream que primero devuelve bytes ya leídos y luego continúa con el original"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.prefix:
+            if size is None or size < 0:
+                data, self.prefix = self.prefix + self.stream.read(), b""
+                return data
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        return self.stream.read(size)
+
+class _IncrementalReader:
+    """Lee JSON de un stream por partes usando JSONDecoder.raw_decode sobre un buffer"""
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Agrega un bloque del stream al buffer; retorna False al llegar al final"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b"", final=True)
+            return False
+        # Descartar lo ya consumido para que la memoria no crezca con el archivo
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += self.text_decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """Retorna el siguiente carácter que no es espacio (o '' al final)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSON inválido: se esperaba '{char}' en la posición {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        """Decodifica el siguiente valor completo, leyendo más datos si está cortado"""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # Un número al final del buffer podría continuar en el siguiente bloque
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+    def array_items(self):
+        """Itera los elementos del arreglo que empieza en la posición actual"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"JSON inválido: se esperaba ',' o ']' en la posición {self.pos - 1}")
+
+    def measurements(self):
+        """Itera los registros de {"measurements": [...]} o de una lista simple"""
+        first = self.peek()
+        if first == "[":
+            yield from self.array_items()
+            return
+        if first != "{":
+            raise ValueError("Formato de archivo no reconocido: se esperaba un objeto o una lista")
+        self.pos += 1
+        while self.peek() != "}":
+            key = self.value()
+            self.expect(":")
+            if key == "measurements" and self.peek() == "[":
+                yield from self.array_items()
+                return
+            self.value()  # Otras claves se decodifican y se descartan
+            if self.peek() == ",":
+                self.pos += 1
+        raise ValueError("Formato de archivo no reconocido: no contiene una lista 'measurements'")
+
+def _ijson_measurements(stream):
+    prefix = stream.read(CHUNK_SIZE)
+    first = prefix.lstrip()[:1]
+    path = "item" if first == b"[" else "measurements.item"
+    return ijson.items(PrefixedStream(prefix, stream), path, use_float=True)
+
+def iter_measurements(stream):
+    """Itera registros de medición de un stream binario sin cargar el archivo completo.
+
+    Acepta tanto {"measurements": [...]} como una lista de registros. Usa ijson si
+    está instalado y, si no, un parser incremental sobre json.JSONDecoder.
+    """
+    if ijson is not None:
+        return _ijson_measurements(stream)
+    return _IncrementalReader(stream).measurements()
+
+def iter_chunks(iterable, size):
+    """Agrupa un iterable en listas de hasta ``size`` elementos"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+
+from psycopg2.extras import execute_values
+
+import dimension
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Mantener sensor_latest (última lectura de cada sensor) en la misma transacción que cada inserción
+MAINTAIN_LATEST = os.getenv("MAINTAIN_LATEST", "true").lower() == "true"
+
+LATEST_COLUMNS = ("sensor_id", "timestamp", "temperature", "humidity", "latitude", "longitude", "battery_level")
+
+class SensorState:
+    """Última lectura conocida de un sensor"""
+    __slots__ = LATEST_COLUMNS
+
+    def __init__(self, sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level):
+        self.sensor_id = sensor_id
+        self.timestamp = timestamp
+        self.temperature = temperature
+        self.humidity = humidity
+        self.latitude = latitude
+        self.longitude = longitude
+        self.battery_level = battery_level
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in LATEST_COLUMNS}
+
+    def __repr__(self):
+        return f"SensorState({self.sensor_id!r}, {self.timestamp}, {self.temperature}, {self.battery_level})"
+
+def reduce_records(records):
+    """Última lectura de cada sensor de un lote validado: {sensor_id: tupla con timestamp datetime}.
+
+    Con timestamps iguales gana el primero, igual que al fusionar con la tabla.
+    """
+    import validation  # Al usarse: importa numpy y las consultas no lo necesitan
+    latest = {}
+    for sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level in records:
+        timestamp = validation.parse_timestamp(timestamp)
+        current = latest.get(sensor_id)
+        if current is None or timestamp > current[1]:
+            latest[sensor_id] = (sensor_id, timestamp, temperature, humidity,
+                                 float(latitude), float(longitude), battery_level)
+    return latest
+
+def merge_latest(target, rows):
+    """Combina lecturas {sensor_id: tupla} en target conservando el timestamp mayor"""
+    for sensor_id, row in rows.items():
+        current = target.get(sensor_id)
+        if current is None or row[1] > current[1]:
+            target[sensor_id] = row
+
+def create_table(cursor, schema):
+    """Crea sensor_latest; si se creó en esta llamada la llena desde sensor_data y retorna True"""
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.sensor_latest",))
+    if cursor.fetchone()[0]:
+        return False
+    cursor.execute(f"""
+    CREATE TABLE {schema}.sensor_latest (
+        sensor_id VARCHAR(50) PRIMARY KEY,
+        timestamp TIMESTAMP NOT NULL,
+        temperature FLOAT NOT NULL,
+        humidity FLOAT NOT NULL,
+        latitude DECIMAL(9,6) NOT NULL,
+        longitude DECIMAL(9,6) NOT NULL,
+        battery_level INT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    cursor.execute(f"""
+    INSERT INTO {schema}.sensor_latest ({", ".join(LATEST_COLUMNS)})
+    SELECT DISTINCT ON (sensor_id) {", ".join(LATEST_COLUMNS)}
+    FROM {dimension.readings_table(cursor, schema)}
+    ORDER BY sensor_id, timestamp DESC, id
+    """)
+    return True
+
+def apply(cursor, schema, rows):
+    """Fusiona lecturas {sensor_id: tupla} en sensor_latest (en la transacción actual).
+
+    Solo reemplaza una fila si la lectura nueva es posterior: los lotes que llegan
+    tarde o fuera de orden no retroceden el estado.
+    """
+    if not rows:
+        return
+    columns = ", ".join(LATEST_COLUMNS)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in LATEST_COLUMNS[1:])
+    # Orden estable de claves: dos escritores que tocan los mismos sensores no se bloquean en ciclo
+    execute_values(cursor, f"""
+    INSERT INTO {schema}.sensor_latest AS l ({columns}) VALUES %s
+    ON CONFLICT (sensor_id) DO UPDATE SET {updates}, updated_at = now()
+    WHERE EXCLUDED.timestamp > l.timestamp
+    """, [rows[sensor_id] for sensor_id in sorted(rows)], page_size=len(rows))
+
+def state_from_row(row):
+    """SensorState desde una fila con LATEST_COLUMNS (las coordenadas DECIMAL pasan a float)"""
+    sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level = row
+    return SensorState(sensor_id, timestamp, temperature, humidity, float(latitude), float(longitude), battery_level)
+
+def fetch(cursor, schema, sensor_ids=None):
+    """Lee sensor_latest completo o solo los sensores indicados; retorna [SensorState]"""
+    columns = ", ".join(LATEST_COLUMNS)
+    if sensor_ids is None:
+        cursor.execute(f"SELECT {columns} FROM {schema}.sensor_latest ORDER BY sensor_id")
+    else:
+        cursor.execute(f"SELECT {columns} FROM {schema}.sensor_latest WHERE sensor_id = ANY(%s) ORDER BY sensor_id",
+                       (list(sensor_ids),))
+    return [state_from_row(row) for row in cursor.fetchall()]
+
+class LatestStore:
+    """Mapa en memoria sensor_id -> SensorState con la última lectura de cada sensor.
+
+    Se comparte entre los escritores de un cargador y solo recibe lecturas de
+    transacciones ya confirmadas, así que coincide con sensor_latest. El daemon
+    la publica en /latest del endpoint de métricas (metrics.serve_latest).
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def load(self, cursor, schema):
+        """Carga el estado desde sensor_latest (al iniciar el proceso)"""
+        states = {state.sensor_id: state for state in fetch(cursor, schema)}
+        with self._lock:
+            self._states = states
+        return len(states)
+
+    def merge(self, rows):
+        """Aplica lecturas {sensor_id: tupla} confirmadas; retorna cuántos sensores cambiaron"""
+        changed = 0
+        with self._lock:
+            states = self._states
+            for sensor_id, row in rows.items():
+                state = states.get(sensor_id)
+                if state is None:
+                    states[sensor_id] = SensorState(*row)
+                elif row[1] > state.timestamp:
+                    (_, state.timestamp, state.temperature, state.humidity,
+                     state.latitude, state.longitude, state.battery_level) = row
+                else:
+                    continue
+                changed += 1
+        return changed
+
+    def get(self, sensor_id):
+        """Última lectura de un sensor o None"""
+        state = self._states.get(sensor_id)
+        if state is None:
+            return None
+        with self._lock:
+            return SensorState(*(getattr(state, name) for name in LATEST_COLUMNS))
+
+    def snapshot(self):
+        """Copia de la última lectura de todos los sensores, ordenada por sensor_id"""
+        with self._lock:
+            return [SensorState(*(getattr(state, name) for name in LATEST_COLUMNS))
+                    for _, state in sorted(self._states.items())]
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self._states
@@ -0,0 +1,290 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Desactivadas por defecto: cada llamada retorna de inmediato sin tomar locks
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+# Puerto del endpoint /metrics, y de /latest en el daemon (0 = sin servidor HTTP)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH")  # Archivo JSON que se reescribe periódicamente
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "15"))
+
+# Límites superiores (segundos) de los histogramas de latencia
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_CONTEXT = nullcontext()
+
+class _Metric:
+    def __init__(self, name, kind, help_text, label_names=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.values = {}  # Tupla de valores de etiquetas -> valor (o [conteos por bucket, suma, total])
+
+class Registry:
+    """Contadores, gauges e histogramas con etiquetas, seguros entre hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, name, kind, help_text, label_names=(), buckets=None):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = _Metric(name, kind, help_text, label_names, buckets)
+            return self._metrics[name]
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def _key(self, metric, labels):
+        return tuple(str(labels.get(label, "")) for label in metric.label_names)
+
+    def inc(self, name, value=1, **labels):
+        metric = self._metrics[name]
+        self.add_to(metric, self._key(metric, labels), value)
+
+    def add_to(self, metric, key, value):
+        with self._lock:
+            metric.values[key] = metric.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        metric = self._metrics[name]
+        key = self._key(metric, labels)
+        with self._lock:
+            metric.values[key] = value
+
+    def observe(self, name, value, **labels):
+        metric = self._metrics[name]
+        self.observe_at(metric, self._key(metric, labels), value)
+
+    def observe_at(self, metric, key, value):
+        index = bisect.bisect_left(metric.buckets, value)
+        with self._lock:
+            state = metric.values.get(key)
+            if state is None:
+                state = metric.values[key] = [[0] * (len(metric.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        """Copia de todos los valores como diccionario serializable a JSON"""
+        result = {}
+        with self._lock:
+            for metric in self._metrics.values():
+                series = []
+                for key, value in sorted(metric.values.items()):
+                    labels = dict(zip(metric.label_names, key))
+                    if metric.kind == "histogram":
+                        counts, total, count = value
+                        cumulative, buckets = 0, {}
+                        for bound, bucket_count in zip(list(metric.buckets) + ["+Inf"], counts):
+                            cumulative += bucket_count
+                            buckets[str(bound)] = cumulative
+                        series.append({"labels": labels, "buckets": buckets, "sum": total, "count": count})
+                    else:
+                        series.append({"labels": labels, "value": value})
+                result[metric.name] = {"type": metric.kind, "help": metric.help, "series": series}
+        return result
+
+    def render_prometheus(self):
+        """Formato de texto de exposición de Prometheus"""
+        lines = []
+        for name, metric in self.snapshot().items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for series in metric["series"]:
+                labels = series["labels"]
+                if metric["type"] == "histogram":
+                    for bound, count in series["buckets"].items():
+                        lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {series['sum']}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {series['count']}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {series['value']}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REGISTRY = Registry()
+REGISTRY.register("s3_loader_stage_duration_seconds", "histogram", "Duración de cada etapa de la carga",
+                  ["stage"], LATENCY_BUCKETS)
+REGISTRY.register("s3_loader_stage_in_flight", "gauge", "Operaciones en curso por etapa", ["stage"])
+REGISTRY.register("s3_loader_bytes_downloaded_total", "counter", "Bytes descargados de S3")
+REGISTRY.register("s3_loader_rows_total", "counter", "Registros por resultado (received, valid, inserted)",
+                  ["result"])
+REGISTRY.register("s3_loader_rows_rejected_total", "counter", "Registros descartados por motivo", ["reason"])
+REGISTRY.register("s3_loader_files_total", "counter", "Archivos procesados por estado", ["status"])
+REGISTRY.register("s3_loader_queue_depth", "gauge", "Elementos en espera por cola del daemon", ["queue"])
+REGISTRY.register("s3_loader_object_latency_seconds", "histogram",
+                  "Tiempo desde que el objeto llega a S3 hasta que sus filas son consultables",
+                  buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0))
+
+def inc(name, value=1, **labels):
+    if METRICS_ENABLED:
+        REGISTRY.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    if METRICS_ENABLED:
+        REGISTRY.set(name, value, **labels)
+
+def observe(name, value, **labels):
+    if METRICS_ENABLED:
+        REGISTRY.observe(name, value, **labels)
+
+def add_rejected(rejected):
+    """Suma un Counter de motivos de rechazo de validation.validate_records"""
+    if METRICS_ENABLED:
+        for reason, count in rejected.items():
+            REGISTRY.inc("s3_loader_rows_rejected_total", count, reason=reason)
+
+class _StageTracker:
+    """Mide una etapa; se reutiliza una instancia por etapa para no crear objetos por llamada"""
+
+    def __init__(self, stage):
+        self.key = (stage,)
+        self.local = threading.local()
+        self.in_flight = REGISTRY.get("s3_loader_stage_in_flight")
+        self.duration = REGISTRY.get("s3_loader_stage_duration_seconds")
+
+    def __enter__(self):
+        REGISTRY.add_to(self.in_flight, self.key, 1)
+        # Pila por hilo: permite anidar la misma etapa y usarla desde varios hilos
+        starts = self.local.__dict__.setdefault("starts", [])
+        starts.append(time.perf_counter())
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.local.starts.pop()
+        REGISTRY.observe_at(self.duration, self.key, elapsed)
+        REGISTRY.add_to(self.in_flight, self.key, -1)
+        return False
+
+_trackers = {}
+
+def track(stage):
+    """Context manager que mide la latencia de una etapa y la cuenta como en curso"""
+    if not METRICS_ENABLED:
+        return _NULL_CONTEXT
+    tracker = _trackers.get(stage)
+    if tracker is None:
+        tracker = _trackers.setdefault(stage, _StageTracker(stage))
+    return tracker
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/metrics", "/"):
+            self._send(REGISTRY.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+        elif _latest_store is not None and (path == "/latest" or path.startswith("/latest/")):
+            self._send_latest(unquote(path[len("/latest/"):]))
+        else:
+            self.send_error(404)
+
+    def _send_latest(self, sensor_id):
+        """Última lectura de un sensor (/latest/<sensor_id>) o de todos (/latest), desde memoria"""
+        if sensor_id:
+            state = _latest_store.get(sensor_id)
+            if state is None:
+                self.send_error(404)
+                return
+            data = state._asdict()
+        else:
+            data = [state._asdict() for state in _latest_store.snapshot()]
+        self._send(json.dumps(data, default=_json_value), "application/json")
+
+    def _send(self, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_dump_thread = None
+_stop_event = threading.Event()
+_latest_store = None  # latest.LatestStore que responde /latest
+
+def serve_latest(store):
+    """Publica la última lectura de cada sensor de store en /latest del endpoint HTTP.
+
+    Un proceso de larga duración (el daemon) ya mantiene ese estado en memoria al
+    confirmar cada lote; servirlo desde ahí evita consultar sensor_latest.
+    """
+    global _latest_store
+    _latest_store = store
+
+def dump(path=None):
+    """Escribe el estado actual de las métricas en JSON (de forma atómica)"""
+    path = path or METRICS_DUMP_PATH
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"timestamp": time.time(), "metrics": REGISTRY.snapshot()}, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _dump_loop():
+    while not _stop_event.wait(METRICS_DUMP_INTERVAL):
+        try:
+            dump()
+        except OSError as e:
+            logger.warning(f"No se pudo escribir el archivo de métricas: {e}")
+
+def start():
+    """Inicia el endpoint HTTP y/o el volcado periódico según la configuración"""
+    global _server, _dump_thread
+    if not METRICS_ENABLED:
+        return
+    if METRICS_PORT and _server is None:
+        _server = ThreadingHTTPServer(("", METRICS_PORT), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Métricas disponibles en http://0.0.0.0:{METRICS_PORT}/metrics")
+    if METRICS_DUMP_PATH and _dump_thread is None:
+        _stop_event.clear()
+        _dump_thread = threading.Thread(target=_dump_loop, name="metrics-dump", daemon=True)
+        _dump_thread.start()
+        logger.info(f"Métricas volcadas cada {METRICS_DUMP_INTERVAL:.0f}s en {METRICS_DUMP_PATH}")
+
+def stop():
+    """Detiene el endpoint y escribe un último volcado"""
+    global _server, _dump_thread
+    if not METRICS_ENABLED:
+        return
+    _stop_event.set()
+    if _dump_thread is not None:
+        _dump_thread.join()
+        _dump_thread = None
+    if METRICS_DUMP_PATH:
+        try:
+            dump()
+        except OSError as e:
+            logger.warning(f"No se pudo escribir el archivo de métricas: {e}")
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
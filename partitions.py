@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import db
+import dimension
+import rollups
+
+logger = logging.getLogger("s3_to_postgres")
+
+# "none" crea sensor_data como tabla simple; "daily" o "monthly" la particionan por timestamp
+PARTITION_MODE = os.getenv("PARTITION_MODE", "none")
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", "3"))  # Periodos futuros creados por adelantado
+PARTITION_RETENTION = int(os.getenv("PARTITION_RETENTION", "0"))  # Periodos a conservar (0 = sin límite)
+PARTITION_RETENTION_ACTION = os.getenv("PARTITION_RETENTION_ACTION", "detach")  # "detach" o "drop"
+
+_lock = threading.Lock()
+_modes = {}  # Esquema -> granularidad de la tabla particionada ("daily"/"monthly")
+_known = {}  # Esquema -> inicios de periodo con partición adjunta
+
+def period_start(value, mode):
+    """Inicio del periodo (fecha) que contiene un timestamp o una fecha ISO"""
+    day = value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+    if isinstance(day, datetime):
+        day = day.date()
+    return day if mode == "daily" else day.replace(day=1)
+
+def next_period(start, mode):
+    if mode == "daily":
+        return start + timedelta(days=1)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def shift_periods(start, mode, count):
+    """Desplaza un inicio de periodo count periodos (negativo hacia atrás)"""
+    if mode == "daily":
+        return start + timedelta(days=count)
+    month = start.year * 12 + start.month - 1 + count
+    return date(month // 12, month % 12 + 1, 1)
+
+def partition_name(start, mode):
+    return f"sensor_data_p{start:%Y%m%d}" if mode == "daily" else f"sensor_data_p{start:%Y%m}"
+
+def create_parent_table(cursor, schema, mode, compact=False):
+    """Crea sensor_data particionada por rango de timestamp con índice (sensor_id, timestamp).
+
+    Con compact=True la tabla usa sensor_key (ver dimension.py) y el índice es (sensor_key, timestamp).
+    El índice se define en la tabla padre, así que PostgreSQL lo crea en cada partición.
+    """
+    key = "sensor_key" if compact else "sensor_id"
+    cursor.execute(f"""
+    CREATE TABLE {schema}.sensor_data (
+        id SERIAL,{dimension.table_columns_sql(compact)},
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+    """)
+    cursor.execute(f"CREATE INDEX sensor_data_{key}_timestamp_idx ON {schema}.sensor_data ({key}, timestamp)")
+    # La granularidad queda registrada en la tabla para que no dependa de la configuración de cada proceso
+    cursor.execute(f"COMMENT ON TABLE {schema}.sensor_data IS 'partition_mode={mode}'")
+
+def attached_partitions(cursor, schema):
+    """Retorna {inicio de periodo: nombre} de las particiones adjuntas a sensor_data"""
+    cursor.execute("""
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    """, (f"{schema}.sensor_data",))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        suffix = name[len("sensor_data_p"):]
+        if not name.startswith("sensor_data_p") or not suffix.isdigit():
+            continue
+        start = date(int(suffix[:4]), int(suffix[4:6]), int(suffix[6:8]) if len(suffix) == 8 else 1)
+        partitions[start] = name
+    return partitions
+
+def register(cursor, schema):
+    """Detecta si sensor_data está particionada y carga las particiones existentes.
+
+    Retorna la granularidad ("daily"/"monthly") o None si la tabla no está particionada.
+    """
+    cursor.execute("""
+    SELECT obj_description(c.oid, 'pg_class')
+    FROM pg_partitioned_table p
+    JOIN pg_class c ON c.oid = p.partrelid
+    WHERE c.oid = to_regclass(%s)
+    """, (f"{schema}.sensor_data",))
+    row = cursor.fetchone()
+    if row is None:
+        with _lock:
+            _modes.pop(schema, None)
+            _known.pop(schema, None)
+        return None
+    comment = row[0] or ""
+    mode = comment.split("=", 1)[1] if comment.startswith("partition_mode=") else PARTITION_MODE
+    known = set(attached_partitions(cursor, schema))
+    with _lock:
+        _modes[schema] = mode
+        _known[schema] = known
+    return mode
+
+def _create_partitions(schema, starts):
+    """Crea y adjunta las particiones que falten en una transacción propia.
+
+    CREATE TABLE + ATTACH PARTITION solo toma SHARE UPDATE EXCLUSIVE en la tabla padre,
+    así que no espera a los escritores con transacciones abiertas sobre sensor_data. El
+    bloqueo advisory serializa la creación entre hilos y procesos.
+    """
+    mode = _modes[schema]
+    with db.connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{schema}.sensor_data",))
+                existing = attached_partitions(cursor, schema)
+                for start in sorted(set(starts) - set(existing)):
+                    name = partition_name(start, mode)
+                    end = next_period(start, mode)
+                    cursor.execute(f"""
+                    CREATE TABLE {schema}.{name}
+                    (LIKE {schema}.sensor_data INCLUDING DEFAULTS)
+                    """)
+                    cursor.execute(f"""
+                    ALTER TABLE {schema}.sensor_data ATTACH PARTITION {schema}.{name}
+                    FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+                    """)
+                    existing[start] = name
+                    logger.info(f"Partición {schema}.{name} creada [{start}, {end})")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    with _lock:
+        _known[schema].update(existing)
+
+def ensure_periods(schema, starts):
+    """Garantiza que existan las particiones para los inicios de periodo dados"""
+    with _lock:
+        missing = set(starts) - _known.get(schema, set())
+    if missing:
+        _create_partitions(schema, missing)
+
+def ensure_for_records(schema, records):
+    """Crea por adelantado las particiones que necesitan los registros de un lote.
+
+    No hace nada si sensor_data no está particionada.
+    """
+    mode = _modes.get(schema)
+    if mode is None or not records:
+        return
+    # Agrupar por día como texto antes de convertir evita procesar cada timestamp
+    days = {str(record[1])[:10] for record in records}
+    ensure_periods(schema, {period_start(day, mode) for day in days})
+
+def ensure_window(schema, today=None):
+    """Crea la partición del periodo actual y PARTITION_PREMAKE periodos siguientes"""
+    mode = _modes.get(schema)
+    if mode is None:
+        return
+    current = period_start(today or date.today(), mode)
+    ensure_periods(schema, [shift_periods(current, mode, i) for i in range(PARTITION_PREMAKE + 1)])
+
+def apply_retention(cursor, schema, today=None):
+    """Separa o elimina las particiones más antiguas que PARTITION_RETENTION periodos.
+
+    Los resúmenes por hora de esos periodos se descartan para que sigan coincidiendo
+    con la tabla base. Retorna los nombres de las particiones retiradas.
+    """
+    mode = _modes.get(schema)
+    if mode is None or PARTITION_RETENTION <= 0:
+        return []
+    cutoff = shift_periods(period_start(today or date.today(), mode), mode, -PARTITION_RETENTION + 1)
+    retired = []
+    for start, name in sorted(attached_partitions(cursor, schema).items()):
+        if next_period(start, mode) > cutoff:
+            continue
+        cursor.execute(f"ALTER TABLE {schema}.sensor_data DETACH PARTITION {schema}.{name}")
+        if PARTITION_RETENTION_ACTION == "drop":
+            cursor.execute(f"DROP TABLE {schema}.{name}")
+        else:
+            # Renombrar libera el nombre por si llegan datos atrasados de ese periodo
+            cursor.execute(f"ALTER TABLE {schema}.{name} RENAME TO {name}_detached_{date.today():%Y%m%d}")
+        retired.append(name)
+    if retired:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.sensor_rollup",))
+        if cursor.fetchone()[0]:
+            rollups.prune_before(cursor, schema, cutoff)
+        with _lock:
+            _known[schema] = {start for start in _known.get(schema, set()) if next_period(start, mode) > cutoff}
+    return retired
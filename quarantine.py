@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+from psycopg2.extras import execute_values
+
+if __name__ == "__main__":
+    # DEAD_LETTER y el resto de la configuración se leen al importar: primero el .env
+    import cli
+    cli.load_environment()
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Guardar registros rechazados y archivos fallidos en tablas de cuarentena en lugar de descartarlos
+DEAD_LETTER = os.getenv("DEAD_LETTER", "true").lower() == "true"
+DEAD_LETTER_MAX_ERROR = 1000  # Caracteres del mensaje de error que se guardan
+REPLAY_BATCH_SIZE = int(os.getenv("REPLAY_BATCH_SIZE", "5000"))  # Registros por transacción al reinyectar
+
+class FailedFile(list):
+    """Resultado vacío de un archivo que no se pudo descargar o parsear, con la etapa y el error"""
+
+    def __init__(self, stage, error):
+        super().__init__()
+        self.stage = stage
+        self.error = error
+
+def create_tables(cursor, schema):
+    """Crea las tablas de registros rechazados y de archivos fallidos"""
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.dead_letter_records (
+        id BIGSERIAL PRIMARY KEY,
+        object_key TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        error TEXT,
+        record JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    cursor.execute(f"""
+    CREATE INDEX IF NOT EXISTS dead_letter_records_reason_idx
+    ON {schema}.dead_letter_records (reason, id)
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.dead_letter_files (
+        object_key TEXT PRIMARY KEY,
+        etag TEXT,
+        stage TEXT NOT NULL,
+        error TEXT,
+        attempts INT NOT NULL DEFAULT 1,
+        first_failed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_failed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        resolved_at TIMESTAMPTZ
+    )
+    """)
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+def _dumps(record):
+    return json.dumps(record, default=_json_default)
+
+def record_rejects(cursor, schema, object_key, rejects, error=None):
+    """Guarda pares (motivo, medición) en dead_letter_records dentro de la transacción actual"""
+    if not rejects:
+        return
+    error = error[:DEAD_LETTER_MAX_ERROR] if error else None
+    execute_values(
+        cursor,
+        f"INSERT INTO {schema}.dead_letter_records (object_key, reason, error, record) VALUES %s",
+        [(object_key, reason, error, _dumps(record)) for reason, record in rejects],
+        template="(%s, %s, %s, %s::jsonb)",
+        page_size=1000,
+    )
+
+def record_failed_file(cursor, schema, object_key, stage, error, etag=None):
+    """Registra (o actualiza) un archivo que no se pudo cargar"""
+    cursor.execute(f"""
+    INSERT INTO {schema}.dead_letter_files (object_key, etag, stage, error)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (object_key) DO UPDATE
+    SET etag = EXCLUDED.etag, stage = EXCLUDED.stage, error = EXCLUDED.error,
+        attempts = {schema}.dead_letter_files.attempts + 1, last_failed_at = now(), resolved_at = NULL
+    """, (object_key, etag, stage, str(error)[:DEAD_LETTER_MAX_ERROR]))
+
+def resolve_file(cursor, schema, object_key):
+    """Marca como resuelto un archivo fallido que finalmente se cargó"""
+    cursor.execute(f"""
+    UPDATE {schema}.dead_letter_files SET resolved_at = now()
+    WHERE object_key = %s AND resolved_at IS NULL
+    """, (object_key,))
+
+def measurement_from_row(row):
+    """Convierte una tupla de sensor_data al formato de medición de los archivos"""
+    sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level = row
+    return {
+        "sensor_id": sensor_id,
+        "timestamp": timestamp,
+        "temperature": temperature,
+        "humidity": humidity,
+        "location": {"latitude": latitude, "longitude": longitude},
+        "battery_level": battery_level,
+    }
+
+def last_record_id(cursor, schema):
+    cursor.execute(f"SELECT coalesce(max(id), 0) FROM {schema}.dead_letter_records")
+    return cursor.fetchone()[0]
+
+def take_records(cursor, schema, limit, max_id, reason=None):
+    """Saca de la cuarentena hasta limit registros con id <= max_id (en la transacción actual).
+
+    max_id evita volver a tomar en la misma reinyección los registros que fallan otra vez.
+    Retorna [(object_key, medición)]. Si la transacción se deshace, los registros vuelven a la tabla.
+    """
+    condition = "AND reason = %s" if reason else ""
+    params = (max_id, reason, limit) if reason else (max_id, limit)
+    cursor.execute(f"""
+    DELETE FROM {schema}.dead_letter_records
+    WHERE id IN (
+        SELECT id FROM {schema}.dead_letter_records WHERE id <= %s {condition}
+        ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, object_key, record
+    """, params)
+    return [(object_key, record) for _, object_key, record in sorted(cursor.fetchall())]
+
+def pending_files(cursor, schema):
+    """Claves de archivos fallidos aún no resueltos"""
+    cursor.execute(f"""
+    SELECT object_key FROM {schema}.dead_letter_files
+    WHERE resolved_at IS NULL ORDER BY first_failed_at
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+def summary(cursor, schema):
+    """Registros por motivo y archivos por etapa pendientes en la cuarentena"""
+    cursor.execute(f"""
+    SELECT reason, count(*) FROM {schema}.dead_letter_records GROUP BY 1 ORDER BY 2 DESC
+    """)
+    records = cursor.fetchall()
+    cursor.execute(f"""
+    SELECT stage, count(*) FROM {schema}.dead_letter_files WHERE resolved_at IS NULL GROUP BY 1 ORDER BY 2 DESC
+    """)
+    return records, cursor.fetchall()
+
+def main():
+    """Consulta la cuarentena o reinyecta su contenido con el cargador"""
+    parser = argparse.ArgumentParser(description="Cuarentena de registros y archivos rechazados")
+    parser.add_argument("command", choices=["summary", "replay"])
+    parser.add_argument("--reason", help="Reinyectar solo registros con este motivo")
+    parser.add_argument("--records-only", action="store_true", help="No volver a cargar archivos fallidos")
+    parser.add_argument("--files-only", action="store_true", help="No reinyectar registros rechazados")
+    args = parser.parse_args()
+
+    # Importación local: s3_to_postgress importa este módulo (el .env ya se cargó al ejecutarlo)
+    import cli
+    cli.configure_logging()
+    import db
+    import s3_to_postgress
+
+    loader = s3_to_postgress.S3ToPostgresLoader()
+    try:
+        if not loader.connect_db() or not loader.prepare():
+            return
+        if args.command == "summary":
+            records, files = summary(loader.cursor, s3_to_postgress.DB_SCHEMA)
+            loader.conn.commit()
+            print("Registros en cuarentena por motivo:")
+            for reason, count in records:
+                print(f"  {reason:32s} {count:10d}")
+            print("Archivos fallidos sin resolver por etapa:")
+            for stage, count in files:
+                print(f"  {stage:32s} {count:10d}")
+            return
+        if not args.files_only:
+            inserted, quarantined = loader.replay_dead_letter_records(args.reason)
+            print(f"Registros reinyectados: {inserted}; siguen en cuarentena: {quarantined}")
+        if not args.records_only:
+            loaded, failed = loader.replay_failed_files()
+            print(f"Archivos recargados: {loaded}; siguen fallando: {failed}")
+    finally:
+        loader.close_connection()
+        db.close_pool()
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,317 @@
-import psycopg2
+import argparse
+import json
+import os
 
-# Configuración de PostgreSQL
-DB_HOST = "34.207.143.199"
-DB_NAME = "postgres"
-DB_USER = "postgres"
-DB_PASSWORD = "YourNewPassword"
-SCHEMA = "sensors"
+if __name__ == "__main__":
+    # Como script, el .env se carga antes de que analytics y los demás módulos lean su configuración
+    import cli
+    cli.load_environment()
+
+import analytics
+import db
+import dimension
+import latest
+import rollups
+
+# Configuración de PostgreSQL (la conexión se toma del pool compartido de db.py)
+SCHEMA = os.getenv("DB_SCHEMA", "sensors")
 
-# Conectar a PostgreSQL
+# Tomar una conexión del pool de PostgreSQL
 def connect_db():
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return conn
+        return db.get_connection()
     except Exception as e:
         print(f"Error conectando a PostgreSQL: {e}")
         return None
 
-# Obtener el promedio de temperatura por dispositivo
-def get_avg_temperature():
+# Verificar si existen las tablas de resumen que mantiene el cargador
+def rollups_available(cursor):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.sensor_rollup",))
+    return cursor.fetchone()[0]
+
+# Obtener la última lectura de los sensores indicados (o de todos) como latest.SensorState
+def get_latest_readings(sensor_ids=None):
     conn = connect_db()
     if conn is None:
-        return
-    
+        return None
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.sensor_latest",))
+        if cursor.fetchone()[0]:
+            # Una fila por sensor mantenida por el cargador: cada sensor es una búsqueda por clave primaria
+            return latest.fetch(cursor, SCHEMA, sensor_ids)
+        # Sin sensor_latest: la fila más reciente de cada sensor desde la tabla base
+        condition = "WHERE sensor_id = ANY(%s)" if sensor_ids is not None else ""
+        cursor.execute(f"""
+            SELECT DISTINCT ON (sensor_id) {", ".join(latest.LATEST_COLUMNS)}
+            FROM {dimension.readings_table(cursor, SCHEMA)}
+            {condition}
+            ORDER BY sensor_id, timestamp DESC, id;
+        """, (list(sensor_ids),) if sensor_ids is not None else None)
+        return [latest.state_from_row(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+# Obtener la última lectura de un sensor (None si no existe)
+def get_latest_reading(sensor_id):
+    readings = get_latest_readings([sensor_id])
+    return readings[0] if readings else None
+
+# Obtener la última lectura de toda la flota
+def get_fleet_snapshot():
+    return get_latest_readings()
+
+# Obtener los sensores dentro de un rectángulo de latitud/longitud (índice GiST de la tabla sensors)
+def get_sensors_in_bbox(min_lat, min_lon, max_lat, max_lon):
+    conn = connect_db()
+    if conn is None:
+        return None
+
     cursor = conn.cursor()
-    query = f"""
-        SELECT sensor_id, AVG(temperature) AS avg_temperature
-        FROM {SCHEMA}.sensor_data
-        GROUP BY sensor_id;
-    """
-    
-    cursor.execute(query)
-    results = cursor.fetchall()
+    try:
+        return dimension.sensors_in_bbox(cursor, SCHEMA, min_lat, min_lon, max_lat, max_lon)
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+# Obtener los sensores a menos de radius_km de un punto, del más cercano al más lejano
+def get_sensors_near(latitude, longitude, radius_km):
+    conn = connect_db()
+    if conn is None:
+        return None
+
+    cursor = conn.cursor()
+    try:
+        return dimension.sensors_within(cursor, SCHEMA, latitude, longitude, radius_km)
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+# Obtener (sensor, total de mediciones, promedio de temperatura) en una sola consulta
+def get_sensor_summary():
+    conn = connect_db()
+    if conn is None:
+        return None
+
+    cursor = conn.cursor()
+    try:
+        if rollups.is_maintained(cursor, SCHEMA):
+            # El resumen por sensor tiene una fila por dispositivo: responde en milisegundos
+            query = f"""
+                SELECT sensor_id, measurement_count, temperature_sum / measurement_count AS avg_temperature
+                FROM {SCHEMA}.sensor_rollup
+                ORDER BY sensor_id;
+            """
+        else:
+            # Sin resúmenes (o desactualizados): un solo recorrido de la tabla base para ambos resultados
+            query = f"""
+                SELECT sensor_id, COUNT(*) AS total_measurements, AVG(temperature) AS avg_temperature
+                FROM {dimension.readings_table(cursor, SCHEMA)}
+                GROUP BY sensor_id
+                ORDER BY sensor_id;
+            """
+
+        cursor.execute(query)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+# Obtener el promedio de temperatura por dispositivo
+def get_avg_temperature(summary=None):
+    summary = get_sensor_summary() if summary is None else summary
+    if summary is None:
+        return
+
     print("Promedio de temperatura por dispositivo:")
-    for row in results:
-        print(f"Sensor: {row[0]}, Promedio de Temperatura: {row[1]:.2f}°C")
-    
-    cursor.close()
-    conn.close()
+    for sensor_id, _, avg_temperature in summary:
+        print(f"Sensor: {sensor_id}, Promedio de Temperatura: {avg_temperature:.2f}°C")
 
 # Obtener el número de mediciones por dispositivo
-def get_measurement_count():
+def get_measurement_count(summary=None):
+    summary = get_sensor_summary() if summary is None else summary
+    if summary is None:
+        return
+
+    print("Número de mediciones por dispositivo:")
+    for sensor_id, total_measurements, _ in summary:
+        print(f"Sensor: {sensor_id}, Total Mediciones: {total_measurements}")
+
+# Comparar las tablas de resumen con la tabla base
+def check_rollups():
+    conn = connect_db()
+    if conn is None:
+        return False
+
+    cursor = conn.cursor()
+    try:
+        if not rollups_available(cursor):
+            print(f"No hay tablas de resumen en {SCHEMA} (el cargador no las mantiene).")
+            return False
+        differences = rollups.check_consistency(cursor, SCHEMA)
+    except Exception as e:
+        print(f"Error comparando los resúmenes: {e}")
+        return False
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+    if not differences:
+        print("Los resúmenes coinciden con la tabla base.")
+        return True
+    print(f"Se encontraron {len(differences)} diferencias entre los resúmenes y la tabla base:")
+    for table, key, detail in differences:
+        print(f"{table} {key}: {detail}")
+    return False
+
+# Reconstruir las tablas de resumen desde la tabla base
+def rebuild_rollups():
     conn = connect_db()
     if conn is None:
         return
-    
+
     cursor = conn.cursor()
-    query = f"""
-        SELECT sensor_id, COUNT(*) AS total_measurements
-        FROM {SCHEMA}.sensor_data
-        GROUP BY sensor_id;
-    """
-    
-    cursor.execute(query)
-    results = cursor.fetchall()
-    print("Número de mediciones por dispositivo:")
-    for row in results:
-        print(f"Sensor: {row[0]}, Total Mediciones: {row[1]}")
-    
-    cursor.close()
-    conn.close()
+    try:
+        rollups.create_tables(cursor, SCHEMA)
+        rollups.rebuild(cursor, SCHEMA)
+        conn.commit()
+        print("Resúmenes reconstruidos desde la tabla base.")
+    except Exception as e:
+        conn.rollback()
+        print(f"Error reconstruyendo resúmenes: {e}")
+    finally:
+        cursor.close()
+        db.release_connection(conn)
+
+def _format_stats(stats, unit):
+    percentiles = " ".join(f"p{p}={value:.1f}" for p, value in stats.percentiles.items())
+    return f"min={stats.min:.2f}{unit} max={stats.max:.2f}{unit} prom={stats.avg:.2f}{unit} {percentiles}".rstrip()
+
+# Estadísticas de la flota y por sensor en una ventana reciente (calculadas de forma incremental)
+def print_window_stats(window="5m", as_json=False):
+    stats = analytics.window_stats(window)
+    if as_json:
+        print(json.dumps(analytics.to_dict(stats), indent=2))
+        return stats
+
+    print(f"Ventana {stats.start:%Y-%m-%d %H:%M} - {stats.end:%H:%M}: {stats.count} mediciones "
+          f"de {len(stats.sensors)} sensores")
+    if not stats.count:
+        return stats
+    print(f"Temperatura: {_format_stats(stats.temperature, '°C')}")
+    print(f"Humedad: {_format_stats(stats.humidity, '%')}")
+    for sensor in stats.sensors.values():
+        print(f"Sensor: {sensor.sensor_id}, Mediciones: {sensor.count}, "
+              f"Temperatura: {sensor.temperature.min:.2f}/{sensor.temperature.avg:.2f}/{sensor.temperature.max:.2f}°C, "
+              f"Humedad: {sensor.humidity.avg:.2f}%, Batería: {sensor.battery_level}%")
+    return stats
+
+# Serie de ventanas consecutivas (por hora o por día) para gráficos
+def print_series(bucket="1h", count=24, as_json=False):
+    windows = analytics.series(bucket, count)
+    if as_json:
+        print(json.dumps(analytics.to_dict(windows), indent=2))
+        return windows
+
+    for stats in windows:
+        if stats.count:
+            print(f"{stats.start:%Y-%m-%d %H:%M}: {stats.count:8d} mediciones, "
+                  f"temperatura prom {stats.temperature.avg:.2f}°C (p95 {stats.temperature.percentiles[95]:.1f}), "
+                  f"humedad prom {stats.humidity.avg:.2f}%")
+        else:
+            print(f"{stats.start:%Y-%m-%d %H:%M}: sin mediciones")
+    return windows
+
+# Sensores cuya última batería reportada está por debajo del umbral
+def print_low_battery(threshold=analytics.LOW_BATTERY_THRESHOLD, window="1h", as_json=False):
+    sensors = analytics.low_battery_sensors(threshold, window)
+    if as_json:
+        print(json.dumps(analytics.to_dict(sensors), indent=2))
+        return sensors
+
+    print(f"Sensores con batería menor a {threshold}% (último reporte en la ventana {window}): {len(sensors)}")
+    for sensor in sensors:
+        print(f"Sensor: {sensor.sensor_id}, Batería: {sensor.battery_level}%, Último reporte: {sensor.last_seen}")
+    return sensors
+
+# Imprimir la última lectura de un sensor o de toda la flota
+def print_latest(sensor_id=None, as_json=False):
+    readings = get_fleet_snapshot() if sensor_id is None else get_latest_readings([sensor_id])
+    if readings is None:
+        return None
+    if as_json:
+        print(json.dumps(analytics.to_dict(readings), indent=2))
+        return readings
+
+    if not readings:
+        print(f"No hay lecturas del sensor {sensor_id}" if sensor_id else "No hay lecturas")
+    for reading in readings:
+        print(f"Sensor: {reading.sensor_id}, {reading.timestamp}: {reading.temperature:.2f}°C, "
+              f"{reading.humidity:.2f}%, Batería: {reading.battery_level}%, "
+              f"Ubicación: ({reading.latitude:.4f}, {reading.longitude:.4f})")
+    return readings
+
+# Imprimir sensores por ubicación: dentro de un rectángulo o alrededor de un punto
+def print_sensor_locations(sensors, as_json=False):
+    if sensors is None:
+        return None
+    if as_json:
+        print(json.dumps(analytics.to_dict(sensors), indent=2))
+        return sensors
+
+    print(f"Sensores encontrados: {len(sensors)}")
+    for sensor in sensors:
+        distance = f", Distancia: {sensor.distance_km:.2f} km" if sensor.distance_km is not None else ""
+        print(f"Sensor: {sensor.sensor_id}, Ubicación: ({sensor.latitude:.4f}, {sensor.longitude:.4f}){distance}")
+    return sensors
+
+def main(argv=None):
+    """Ejecuta una consulta desde la línea de comandos (también como cli.py query)"""
+    parser = argparse.ArgumentParser(description="Consultas sobre los datos de sensores")
+    parser.add_argument("command", nargs="?", default="report",
+                        choices=["report", "check-rollups", "rebuild-rollups", "window", "series", "low-battery", "latest", "bbox", "near"])
+    parser.add_argument("--sensor", help="Sensor a consultar en latest (por defecto toda la flota)")
+    parser.add_argument("--window", default="5m", help=f"Ventana: {', '.join(analytics.WINDOWS)} o segundos")
+    parser.add_argument("--bucket", default="1h", help="Tamaño de cada punto de la serie")
+    parser.add_argument("--count", type=int, default=24, help="Puntos de la serie")
+    parser.add_argument("--threshold", type=int, default=analytics.LOW_BATTERY_THRESHOLD,
+                        help="Umbral de batería baja (%%)")
+    parser.add_argument("--bbox", help="Rectángulo para bbox: lat_min,lon_min,lat_max,lon_max")
+    parser.add_argument("--lat", type=float, help="Latitud del centro para near")
+    parser.add_argument("--lon", type=float, help="Longitud del centro para near")
+    parser.add_argument("--radius-km", type=float, default=1.0, help="Radio para near (km)")
+    parser.add_argument("--json", action="store_true", help="Imprimir el resultado como JSON")
+    args = parser.parse_args(argv)
+    window = int(args.window) if args.window.isdigit() else args.window
+    bucket = int(args.bucket) if args.bucket.isdigit() else args.bucket
+
+    if args.command == "window":
+        print_window_stats(window, args.json)
+    elif args.command == "series":
+        print_series(bucket, args.count, args.json)
+    elif args.command == "bbox":
+        if not args.bbox:
+            parser.error("bbox requiere --bbox lat_min,lon_min,lat_max,lon_max")
+        print_sensor_locations(get_sensors_in_bbox(*(float(value) for value in args.bbox.split(","))), args.json)
+    elif args.command == "near":
+        if args.lat is None or args.lon is None:
+            parser.error("near requiere --lat y --lon")
+        print_sensor_locations(get_sensors_near(args.lat, args.lon, args.radius_km), args.json)
+    elif args.command == "latest":
+        print_latest(args.sensor, args.json)
+    elif args.command == "low-battery":
+        print_low_battery(args.threshold, window, args.json)
+    elif args.command == "check-rollups":
+        check_rollups()
+    elif args.command == "rebuild-rollups":
+        rebuild_rollups()
+    else:
+        summary = get_sensor_summary()
+        get_avg_temperature(summary)
+        get_measurement_count(summary)
+    db.close_pool()
 
 if __name__ == "__main__":
-    get_avg_temperature()
-    get_measurement_count()
+    main()
@@ -0,0 +1,272 @@
+import logging
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+import dimension
+
+logger = logging.getLogger("s3_to_postgres")
+
+# Columnas agregadas comunes a ambas tablas de resumen
+AGGREGATE_COLUMNS = (
+    "measurement_count",
+    "temperature_sum", "temperature_min", "temperature_max",
+    "humidity_sum", "humidity_min", "humidity_max",
+    "battery_sum", "battery_min", "battery_max",
+)
+
+# Cómo se combina el valor existente con el nuevo en ON CONFLICT
+_MERGE = {
+    "measurement_count": "r.measurement_count + EXCLUDED.measurement_count",
+    "temperature_sum": "r.temperature_sum + EXCLUDED.temperature_sum",
+    "temperature_min": "LEAST(r.temperature_min, EXCLUDED.temperature_min)",
+    "temperature_max": "GREATEST(r.temperature_max, EXCLUDED.temperature_max)",
+    "humidity_sum": "r.humidity_sum + EXCLUDED.humidity_sum",
+    "humidity_min": "LEAST(r.humidity_min, EXCLUDED.humidity_min)",
+    "humidity_max": "GREATEST(r.humidity_max, EXCLUDED.humidity_max)",
+    "battery_sum": "r.battery_sum + EXCLUDED.battery_sum",
+    "battery_min": "LEAST(r.battery_min, EXCLUDED.battery_min)",
+    "battery_max": "GREATEST(r.battery_max, EXCLUDED.battery_max)",
+}
+
+# Agregados calculados desde filas de sensor_data (o con su misma forma)
+_AGGREGATES_FROM_ROWS = """
+    count(*), sum(temperature), min(temperature), max(temperature),
+    sum(humidity), min(humidity), max(humidity),
+    sum(battery_level), min(battery_level), max(battery_level)
+"""
+
+# Agregados que combinan resúmenes parciales (lotes ya agregados)
+_AGGREGATES_FROM_PARTIALS = """
+    sum(cnt), sum(tsum), min(tmin), max(tmax),
+    sum(hsum), min(hmin), max(hmax),
+    sum(bsum), min(bmin), max(bmax)
+"""
+
+# Agregados que combinan filas de sensor_rollup_hourly
+_AGGREGATES_FROM_ROLLUPS = """
+    sum(measurement_count), sum(temperature_sum), min(temperature_min), max(temperature_max),
+    sum(humidity_sum), min(humidity_min), max(humidity_max),
+    sum(battery_sum), min(battery_min), max(battery_max)
+"""
+
+# Comentario de sensor_rollup: una carga sin MAINTAIN_ROLLUPS deja los resúmenes desactualizados
+# hasta reconstruirlos, y las consultas no deben usarlos mientras tanto
+MAINTAINED_COMMENT = "rollups=maintained"
+STALE_COMMENT = "rollups=stale"
+
+_VALUES_ALIAS = "v(sensor_id, hour, cnt, tsum, tmin, tmax, hsum, hmin, hmax, bsum, bmin, bmax)"
+_VALUES_TEMPLATE = ("(%s, %s::text, %s::bigint, %s::float8, %s::float8, %s::float8, "
+                    "%s::float8, %s::float8, %s::float8, %s::bigint, %s::int, %s::int)")
+
+def create_tables(cursor, schema):
+    """Crea las tablas de resumen por sensor y por sensor-hora.
+
+    Retorna True si se crearon en esta llamada.
+    """
+    cursor.execute("""
+    SELECT EXISTS (
+        SELECT FROM information_schema.tables
+        WHERE table_schema = %s AND table_name = 'sensor_rollup'
+    )
+    """, (schema,))
+    if cursor.fetchone()[0]:
+        return False
+
+    aggregates = """
+        measurement_count BIGINT NOT NULL,
+        temperature_sum DOUBLE PRECISION NOT NULL,
+        temperature_min DOUBLE PRECISION NOT NULL,
+        temperature_max DOUBLE PRECISION NOT NULL,
+        humidity_sum DOUBLE PRECISION NOT NULL,
+        humidity_min DOUBLE PRECISION NOT NULL,
+        humidity_max DOUBLE PRECISION NOT NULL,
+        battery_sum BIGINT NOT NULL,
+        battery_min INT NOT NULL,
+        battery_max INT NOT NULL
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.sensor_rollup (
+        sensor_id VARCHAR(50) PRIMARY KEY,
+        {aggregates}
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.sensor_rollup_hourly (
+        sensor_id VARCHAR(50) NOT NULL,
+        hour TIMESTAMP NOT NULL,
+        {aggregates},
+        PRIMARY KEY (sensor_id, hour)
+    )
+    """)
+    return True
+
+def _upsert_sql(table, key_columns, source_sql):
+    """INSERT ... ON CONFLICT que suma los agregados nuevos a los existentes"""
+    columns = ", ".join(key_columns + AGGREGATE_COLUMNS)
+    updates = ", ".join(f"{column} = {_MERGE[column]}" for column in AGGREGATE_COLUMNS)
+    return f"""
+    INSERT INTO {table} AS r ({columns})
+    {source_sql}
+    ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET {updates}
+    """
+
+def _hour_key(timestamp):
+    """Clave de hora para agrupar en Python; PostgreSQL aplica date_trunc al final"""
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime("%Y-%m-%d %H:00:00")
+    text = str(timestamp)
+    # Timestamps ISO 8601: basta con los primeros 13 caracteres (fecha y hora)
+    if len(text) >= 13 and text[4] == "-" and text[7] == "-" and text[10] in "T ":
+        return f"{text[:10]} {text[11:13]}:00:00"
+    return text
+
+def aggregate_records(records):
+    """Agrega los registros validados por (sensor_id, hora) en un solo recorrido"""
+    partials = {}
+    for sensor_id, timestamp, temperature, humidity, _, _, battery_level in records:
+        key = (sensor_id, _hour_key(timestamp))
+        p = partials.get(key)
+        if p is None:
+            partials[key] = [1, temperature, temperature, temperature,
+                             humidity, humidity, humidity,
+                             battery_level, battery_level, battery_level]
+            continue
+        p[0] += 1
+        p[1] += temperature
+        if temperature < p[2]:
+            p[2] = temperature
+        if temperature > p[3]:
+            p[3] = temperature
+        p[4] += humidity
+        if humidity < p[5]:
+            p[5] = humidity
+        if humidity > p[6]:
+            p[6] = humidity
+        p[7] += battery_level
+        if battery_level < p[8]:
+            p[8] = battery_level
+        if battery_level > p[9]:
+            p[9] = battery_level
+    # Orden estable de claves para que escritores concurrentes bloqueen filas en el mismo orden
+    return [(sensor_id, hour, *values) for (sensor_id, hour), values in sorted(partials.items())]
+
+def apply_records(cursor, schema, records):
+    """Actualiza los resúmenes con registros recién insertados (en la transacción actual)"""
+    if not records:
+        return
+    partials = aggregate_records(records)
+    hourly_source = f"""
+    SELECT sensor_id, date_trunc('hour', hour::timestamp), {_AGGREGATES_FROM_PARTIALS}
+    FROM (VALUES %s) AS {_VALUES_ALIAS}
+    GROUP BY 1, 2 ORDER BY 1, 2
+    """
+    sensor_source = f"""
+    SELECT sensor_id, {_AGGREGATES_FROM_PARTIALS}
+    FROM (VALUES %s) AS {_VALUES_ALIAS}
+    GROUP BY 1 ORDER BY 1
+    """
+    execute_values(cursor, _upsert_sql(f"{schema}.sensor_rollup_hourly", ("sensor_id", "hour"), hourly_source),
+                   partials, template=_VALUES_TEMPLATE, page_size=len(partials))
+    execute_values(cursor, _upsert_sql(f"{schema}.sensor_rollup", ("sensor_id",), sensor_source),
+                   partials, template=_VALUES_TEMPLATE, page_size=len(partials))
+
+def cte_statements(schema, source):
+    """CTEs que actualizan los resúmenes a partir de una relación con filas de sensor_data.
+
+    Se usan junto a un INSERT ... RETURNING para contar solo las filas realmente insertadas.
+    """
+    hourly = _upsert_sql(
+        f"{schema}.sensor_rollup_hourly", ("sensor_id", "hour"),
+        f"SELECT sensor_id, date_trunc('hour', timestamp), {_AGGREGATES_FROM_ROWS} "
+        f"FROM {source} GROUP BY 1, 2 ORDER BY 1, 2"
+    )
+    per_sensor = _upsert_sql(
+        f"{schema}.sensor_rollup", ("sensor_id",),
+        f"SELECT sensor_id, {_AGGREGATES_FROM_ROWS} FROM {source} GROUP BY 1 ORDER BY 1"
+    )
+    return f"rollup_hourly AS ({hourly}), rollup_sensor AS ({per_sensor})"
+
+def rebuild(cursor, schema):
+    """Reconstruye ambos resúmenes desde la tabla base (en la transacción actual)"""
+    cursor.execute(f"LOCK TABLE {schema}.sensor_data IN SHARE MODE")
+    cursor.execute(f"TRUNCATE {schema}.sensor_rollup, {schema}.sensor_rollup_hourly")
+    cursor.execute(f"""
+    INSERT INTO {schema}.sensor_rollup_hourly (sensor_id, hour, {", ".join(AGGREGATE_COLUMNS)})
+    SELECT sensor_id, date_trunc('hour', timestamp), {_AGGREGATES_FROM_ROWS}
+    FROM {dimension.readings_table(cursor, schema)} GROUP BY 1, 2
+    """)
+    cursor.execute(f"""
+    INSERT INTO {schema}.sensor_rollup (sensor_id, {", ".join(AGGREGATE_COLUMNS)})
+    SELECT sensor_id, {_AGGREGATES_FROM_ROLLUPS}
+    FROM {schema}.sensor_rollup_hourly GROUP BY 1
+    """)
+    cursor.execute(f"COMMENT ON TABLE {schema}.sensor_rollup IS '{MAINTAINED_COMMENT}'")
+
+def is_maintained(cursor, schema):
+    """True si sensor_rollup existe y ninguna carga la dejó desactualizada.
+
+    Las tablas sin comentario (anteriores a la marca) se consideran al día.
+    """
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class')",
+                   (f"{schema}.sensor_rollup", f"{schema}.sensor_rollup"))
+    exists, comment = cursor.fetchone()
+    return exists and comment != STALE_COMMENT
+
+def mark_stale(cursor, schema):
+    """Marca los resúmenes existentes como desactualizados; retorna True si cambió la marca"""
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.sensor_rollup",))
+    if not cursor.fetchone()[0] or not is_maintained(cursor, schema):
+        return False
+    cursor.execute(f"COMMENT ON TABLE {schema}.sensor_rollup IS '{STALE_COMMENT}'")
+    return True
+
+def prune_before(cursor, schema, cutoff):
+    """Descarta los resúmenes por hora anteriores a cutoff y recalcula el resumen por sensor.
+
+    Se usa cuando la retención elimina particiones completas de la tabla base.
+    """
+    cursor.execute(f"LOCK TABLE {schema}.sensor_rollup, {schema}.sensor_rollup_hourly IN EXCLUSIVE MODE")
+    cursor.execute(f"DELETE FROM {schema}.sensor_rollup_hourly WHERE hour < %s", (cutoff,))
+    cursor.execute(f"TRUNCATE {schema}.sensor_rollup")
+    cursor.execute(f"""
+    INSERT INTO {schema}.sensor_rollup (sensor_id, {", ".join(AGGREGATE_COLUMNS)})
+    SELECT sensor_id, {_AGGREGATES_FROM_ROLLUPS}
+    FROM {schema}.sensor_rollup_hourly GROUP BY 1
+    """)
+
+def check_consistency(cursor, schema, tolerance=1e-6):
+    """Compara el resumen por sensor y por hora con la tabla base.
+
+    Retorna una lista de (tabla, clave, detalle) con las diferencias encontradas.
+    """
+    differences = []
+    readings = dimension.readings_table(cursor, schema)
+    comparisons = [
+        ("sensor_rollup", ["sensor_id"], "sensor_id"),
+        ("sensor_rollup_hourly", ["sensor_id", "hour"], "sensor_id, date_trunc('hour', timestamp)"),
+    ]
+    for table, keys, base_keys in comparisons:
+        key_list = ", ".join(keys)
+        base_columns = ", ".join(f"k{i}" for i in range(len(keys)))
+        cursor.execute(f"""
+        WITH base AS (
+            SELECT {base_keys}, {_AGGREGATES_FROM_ROWS}
+            FROM {readings} GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))}
+        )
+        SELECT b.*, r.*
+        FROM base AS b ({base_columns}, {", ".join(AGGREGATE_COLUMNS)})
+        FULL OUTER JOIN (SELECT {key_list}, {", ".join(AGGREGATE_COLUMNS)} FROM {schema}.{table}) AS r
+        ON {" AND ".join(f"b.k{i} = r.{key}" for i, key in enumerate(keys))}
+        """)
+        width = len(keys) + len(AGGREGATE_COLUMNS)
+        for row in cursor.fetchall():
+            base, rollup = row[:width], row[width:]
+            key = base[:len(keys)] if base[0] is not None else rollup[:len(keys)]
+            if base[0] is None or rollup[0] is None:
+                differences.append((table, key, "falta en la tabla base" if base[0] is None else "falta en el resumen"))
+                continue
+            for name, expected, actual in zip(AGGREGATE_COLUMNS, base[len(keys):], rollup[len(keys):]):
+                if abs(float(expected) - float(actual)) > tolerance * max(1.0, abs(float(expected))):
+                    differences.append((table, key, f"{name}: base={expected} resumen={actual}"))
+    return differences
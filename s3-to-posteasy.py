@@ -1,29 +1,29 @@
 import boto3
-import json
-import psycopg2
-from io import BytesIO
+import os
+
+if __name__ == "__main__":
+    # Como script, el .env se carga antes de que db y los demás módulos lean su configuración
+    import cli
+    cli.load_environment()
+
+import codec
+import db
+import dimension
+import latest
+import partitions
+import rollups
 
 # Configuración de AWS S3
 BUCKET_NAME = "awssensorsbucket"
 REGION = "us-east-1"
 
-# Configuración de PostgreSQL
-DB_HOST = "localhost"
-DB_NAME = "postgre"
-DB_USER = "postgres"
-DB_PASSWORD = "YourNewPassword"
-SCHEMA = "sensors"
+# Configuración de PostgreSQL (host, base y credenciales se leen en db.py)
+SCHEMA = os.getenv("DB_SCHEMA", "sensors")
 
-# Conectar a PostgreSQL
+# Tomar una conexión del pool de PostgreSQL
 def connect_db():
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return conn
+        return db.get_connection()
     except Exception as e:
         print(f"Error conectando a PostgreSQL: {e}")
         return None
@@ -36,8 +36,20 @@ def load_data_from_s3():
         return
     
     cursor = conn.cursor()
+    inserted = []
     
     try:
+        # Formato que dejó el cargador principal: compacto (sensor_key) o completo, particionada o no
+        compact = dimension.register(cursor, SCHEMA)
+        partitions.register(cursor, SCHEMA)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.sensors",))
+        sensor_cache = dimension.SensorCache(SCHEMA) if cursor.fetchone()[0] else None
+        conn.commit()
+        if compact and sensor_cache is None:
+            print(f"{SCHEMA}.sensor_data usa el formato compacto pero falta {SCHEMA}.sensors; "
+                  f"ejecute primero s3_to_postgress.py")
+            return
+        
         response = s3.list_objects_v2(Bucket=BUCKET_NAME)
         if 'Contents' not in response:
             print("No hay archivos en el bucket.")
@@ -50,25 +62,43 @@ def load_data_from_s3():
             # Descargar el archivo
             file_obj = s3.get_object(Bucket=BUCKET_NAME, Key=file_name)
             file_content = file_obj['Body'].read()
-            data = json.loads(file_content)
+            data = codec.loads(file_content)
             
-            if "measurements" in data:
-                for record in data["measurements"]:
+            if "measurements" not in data:
+                continue
+            records = [(record["sensor_id"], record["timestamp"], float(record["temperature"]),
+                        float(record["humidity"]), float(record["location"]["latitude"]),
+                        float(record["location"]["longitude"]), int(record["battery_level"]))
+                       for record in data["measurements"]]
+            partitions.ensure_for_records(SCHEMA, records)
+            # La dimensión sensors se mantiene en ambos formatos; el compacto guarda su clave
+            keys = sensor_cache.resolve(records) if sensor_cache is not None else None
+            for record in records:
+                if compact:
+                    cursor.execute(
+                        f"""
+                        INSERT INTO {SCHEMA}.sensor_data (sensor_key, timestamp, temperature, humidity, battery_level)
+                        VALUES (%s, %s, %s, %s, %s)
+                        """,
+                        (keys[record[0]], record[1], record[2], record[3], record[6])
+                    )
+                else:
                     cursor.execute(
                         f"""
                         INSERT INTO {SCHEMA}.sensor_data (sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level)
                         VALUES (%s, %s, %s, %s, %s, %s, %s)
                         """,
-                        (
-                            record["sensor_id"],
-                            record["timestamp"],
-                            record["temperature"],
-                            record["humidity"],
-                            record["location"]["latitude"],
-                            record["location"]["longitude"],
-                            record["battery_level"]
-                        )
+                        record
                     )
+            inserted.extend(records)
+        
+        # Mantener los resúmenes por sensor y la última lectura si el cargador principal ya los creó
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.sensor_rollup",))
+        if cursor.fetchone()[0]:
+            rollups.apply_records(cursor, SCHEMA, inserted)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{SCHEMA}.sensor_latest",))
+        if latest.MAINTAIN_LATEST and cursor.fetchone()[0]:
+            latest.apply(cursor, SCHEMA, latest.reduce_records(inserted))
         
         conn.commit()
         print("Datos cargados exitosamente en la base de datos.")
@@ -76,7 +106,8 @@ def load_data_from_s3():
         print(f"Error cargando datos: {e}")
     finally:
         cursor.close()
-        conn.close()
+        db.release_connection(conn)
 
 if __name__ == "__main__":
-    load_data_from_s3()
\ No newline at end of file
+    load_data_from_s3()
+    db.close_pool()
\ No newline at end of file
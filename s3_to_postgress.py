@@ -1,58 +1,217 @@
-import boto3
-import json
-import psycopg2
 import os
 import logging
+import struct
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from io import BytesIO, StringIO
 from datetime import datetime
-from dotenv import load_dotenv
+from decimal import Decimal
+
+if __name__ == "__main__":
+    # Como script, el .env se carga antes de importar los módulos que leen su configuración
+    # al importarse (partitions, completion, batching...); cli.py solo importa la biblioteca estándar
+    import cli
+    cli.load_environment()
+
 from psycopg2.extras import execute_batch
+from json_stream import PrefixedStream, iter_chunks, iter_measurements
+import db
+import validation
+import codec
+import columnar
+import compressed
+import completion
+import quarantine
+import batching
+import latest
+import dimension
+import rollups
+import partitions
+import metrics
+import analytics
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f"s3_to_postgres_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"),
-        logging.StreamHandler()
-    ]
-)
+# El logging (archivo s3_to_postgres_<fecha>.log) y el .env se configuran en cli.py al ejecutar,
+# no al importar este módulo
 logger = logging.getLogger("s3_to_postgres")
 
-# Cargar variables de entorno (alternativa más segura)
-load_dotenv()
-
 # Configuración desde variables de entorno
 BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "awssensorsbucket")
 REGION = os.getenv("AWS_REGION", "us-east-1")
-DB_HOST = os.getenv("DB_HOST", "34.207.143.199")
-DB_NAME = os.getenv("DB_NAME", "postgres")
-DB_USER = os.getenv("DB_USER", "postgres")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "YourNewPassword")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None  # Opcional: S3 local (MinIO, moto server)
+# DB_HOST, DB_NAME, DB_USER, DB_PASSWORD y DB_POOL_* se leen en db.py al crear el pool
+# (el máximo se amplía a las conexiones que pide required_connections())
 DB_SCHEMA = os.getenv("DB_SCHEMA", "sensors")  # Nuevo: variable para el esquema
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))  # Procesar en lotes para mejor rendimiento
+# "batch" (execute_batch), "copy" (COPY ... FROM STDIN) o "upsert" (COPY a tabla temporal + ON CONFLICT)
+LOAD_MODE = os.getenv("LOAD_MODE", "batch")
+COPY_FORMAT = os.getenv("COPY_FORMAT", "text")  # Formato para LOAD_MODE=copy: "text" o "binary"
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))  # Hilos que descargan y parsean archivos de S3
+DB_WRITERS = int(os.getenv("DB_WRITERS", "1"))  # Hilos que insertan en PostgreSQL (cada uno con su conexión)
+PREFETCH_QUEUE_SIZE = int(os.getenv("PREFETCH_QUEUE_SIZE", "32"))  # Máximo de archivos parseados en espera
+# Mantener sensor_rollup y sensor_rollup_hourly en la misma transacción que cada inserción
+MAINTAIN_ROLLUPS = os.getenv("MAINTAIN_ROLLUPS", "true").lower() == "true"
+STREAM_PARSE = os.getenv("STREAM_PARSE", "false").lower() == "true"  # Parsear el cuerpo de S3 por partes
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "5000"))  # Registros por bloque en modo streaming
+INCREMENTAL = os.getenv("INCREMENTAL", "false").lower() == "true"  # Omitir objetos ya registrados en el manifiesto
+S3_PREFIX = os.getenv("S3_PREFIX", "")  # Prefijo a listar en el bucket
+PROCESSED_PREFIX = "processed/"  # Copias de archivos procesados, nunca se vuelven a cargar
+# Si las claves llegan en orden lexicográfico (p. ej. con fecha en el nombre), listar desde
+# el último cursor con StartAfter. Los objetos modificados por detrás del cursor no se verán.
+S3_KEYS_ORDERED = os.getenv("S3_KEYS_ORDERED", "false").lower() == "true"
+
+# Columnas de sensor_data en el orden en que se construyen los registros
+INSERT_COLUMNS = ("sensor_id", "timestamp", "temperature", "humidity", "latitude", "longitude", "battery_level")
+
+# Constantes del formato binario de COPY de PostgreSQL
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+PG_EPOCH = datetime(2000, 1, 1)
+
+def _copy_text_value(value):
+    """Convierte un valor al formato de texto de COPY, escapando caracteres especiales"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    text = str(value)
+    if "\\" in text or "\t" in text or "\n" in text or "\r" in text:
+        text = (text.replace("\\", "\\\\").replace("\t", "\\t")
+                    .replace("\n", "\\n").replace("\r", "\\r"))
+    return text
+
+def build_copy_text_buffer(records):
+    """Construye un buffer en memoria con los registros en formato de texto de COPY"""
+    buffer = StringIO()
+    buffer.writelines(
+        "\t".join(_copy_text_value(value) for value in record) + "\n"
+        for record in records
+    )
+    buffer.seek(0)
+    return buffer
+
+def _encode_pg_timestamp(value):
+    """Codifica un timestamp como microsegundos desde 2000-01-01 (formato binario de PostgreSQL)"""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    # Igual que el cast de texto a TIMESTAMP, se ignora la zona horaria
+    value = value.replace(tzinfo=None)
+    delta = value - PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack("!iq", 8, micros)
+
+def _encode_pg_numeric(value):
+    """Codifica un número como NUMERIC binario de PostgreSQL (dígitos en base 10000)"""
+    sign, digits, exponent = Decimal(repr(float(value))).as_tuple()
+    dscale = max(0, -exponent)
+    text = "".join(str(d) for d in digits)
+    if exponent > 0:
+        text += "0" * exponent
+    text = text.rjust(dscale + 1, "0")
+    int_part, frac_part = text[:len(text) - dscale], text[len(text) - dscale:]
+    int_part = int_part.rjust(-(-len(int_part) // 4) * 4, "0")
+    frac_part = frac_part.ljust(-(-len(frac_part) // 4) * 4, "0")
+    groups = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(groups) - 1
+    groups += [int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)]
+    # Eliminar grupos de ceros a la izquierda y a la derecha
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight, sign = 0, 0
+    body = struct.pack(f"!hhhh{len(groups)}h", len(groups), weight, 0x4000 if sign else 0, dscale, *groups)
+    return struct.pack("!i", len(body)) + body
+
+def build_copy_binary_compact_buffer(records):
+    """Como build_copy_binary_buffer, para registros compactos (sensor_key, timestamp, temperature, humidity, battery_level)"""
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    row_header = struct.pack("!h", len(dimension.COMPACT_COLUMNS))
+    for sensor_key, timestamp, temperature, humidity, battery_level in records:
+        buffer.write(row_header)
+        buffer.write(struct.pack("!ii", 4, sensor_key))
+        buffer.write(_encode_pg_timestamp(timestamp))
+        buffer.write(struct.pack("!ididii", 8, temperature, 8, humidity, 4, battery_level))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+def insert_columns():
+    """Columnas de sensor_data que escribe el cargador según el formato de la tabla"""
+    return dimension.COMPACT_COLUMNS if dimension.is_compact(DB_SCHEMA) else INSERT_COLUMNS
+
+def build_copy_binary_buffer(records):
+    """Construye un buffer en memoria con los registros en formato binario de COPY"""
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    row_header = struct.pack("!h", len(INSERT_COLUMNS))
+    for sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level in records:
+        sensor_bytes = str(sensor_id).encode("utf-8")
+        buffer.write(row_header)
+        buffer.write(struct.pack("!i", len(sensor_bytes)))
+        buffer.write(sensor_bytes)
+        buffer.write(_encode_pg_timestamp(timestamp))
+        buffer.write(struct.pack("!idid", 8, temperature, 8, humidity))
+        buffer.write(_encode_pg_numeric(latitude))
+        buffer.write(_encode_pg_numeric(longitude))
+        buffer.write(struct.pack("!ii", 4, battery_level))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+def create_s3_client():
+    """Cliente de S3 de la configuración; boto3 se importa aquí porque su importación es lo más lento del arranque"""
+    import boto3
+    return boto3.client('s3', region_name=REGION, endpoint_url=S3_ENDPOINT_URL)
+
+def required_connections():
+    """Conexiones simultáneas de un cargador: la del coordinador, una por escritor y una más
+    que los escritores piden prestada (conservando la suya) para crear particiones y registrar sensores"""
+    return max(1, DB_WRITERS) + 2
+
+# Al importar, por si el pool se crea antes de conectar el cargador; connect_db lo repite
+# por si DB_WRITERS cambió después
+db.reserve(required_connections())
 
 class S3ToPostgresLoader:
-    def __init__(self):
-        self.s3_client = boto3.client('s3', region_name=REGION)
+    def __init__(self, s3_client=None):
+        # El cliente de boto3 es seguro entre hilos, así que los escritores pueden compartirlo
+        self.s3_client = s3_client or create_s3_client()
         self.conn = None
         self.cursor = None
+        self.object_meta = {}  # Clave -> {"ETag", "Size"} del último listado
+        self.completed_keys = set()  # Claves registradas en el manifiesto durante esta ejecución
+        # El daemon lo activa siempre: el manifiesto evita cargas repetidas. También es obligatorio
+        # cuando los objetos procesados siguen en el listado (COMPLETION_MODE tag o manifest).
+        self.incremental = INCREMENTAL or completion.COMPLETION_MODE in completion.MANIFEST_MODES
+        # Compartido con los escritores adicionales para que los borrados se agrupen en un solo lote
+        self.completion = completion.CompletionMarker(self.s3_client, BUCKET_NAME,
+                                                      processed_prefix=PROCESSED_PREFIX)
+        # Última lectura por sensor confirmada; también compartida con los escritores adicionales
+        self.latest = latest.LatestStore()
+        # Claves de la dimensión sensors ya registradas (compartida con los escritores adicionales)
+        self.sensor_cache = dimension.SensorCache(DB_SCHEMA)
+        self.latest_pending = {}  # Lecturas de la transacción en curso, se publican al confirmar
+        self.group = batching.CommitGroup()  # Archivos a confirmar juntos (uno por escritor)
+        # Filas por inserción ajustadas con la latencia observada (compartido con los escritores adicionales)
+        self.batch_size = batching.AdaptiveBatchSize()
     
     def connect_db(self):
         """Establece conexión con la base de datos PostgreSQL"""
         try:
-            self.conn = psycopg2.connect(
-                host=DB_HOST,
-                dbname=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                connect_timeout=10
-            )
+            # Antes de crear el pool: debe alcanzar para todos los hilos del cargador
+            db.reserve(required_connections())
+            # La conexión sale del pool compartido, que crea el esquema una sola vez
+            self.conn = db.get_connection()
             self.cursor = self.conn.cursor()
             
-            # Asegurar que el esquema existe
-            self.cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {DB_SCHEMA}")
-            self.conn.commit()
-            
             logger.info(f"Conexión exitosa a la base de datos. Esquema {DB_SCHEMA} verificado.")
             return True
         except Exception as e:
@@ -72,185 +231,979 @@ class S3ToPostgresLoader:
             
             exists = self.cursor.fetchone()[0]
             
-            if not exists:
+            if not exists and partitions.PARTITION_MODE in ("daily", "monthly"):
+                logger.info(f"La tabla {DB_SCHEMA}.sensor_data no existe. Creándola particionada "
+                            f"({partitions.PARTITION_MODE})...")
+                partitions.create_parent_table(self.cursor, DB_SCHEMA, partitions.PARTITION_MODE,
+                                               compact=dimension.SENSOR_DIMENSION)
+                self.conn.commit()
+                logger.info(f"Tabla {DB_SCHEMA}.sensor_data creada exitosamente.")
+            elif not exists:
                 logger.info(f"La tabla {DB_SCHEMA}.sensor_data no existe. Creándola...")
                 self.cursor.execute(f"""
                 CREATE TABLE {DB_SCHEMA}.sensor_data (
-                    id SERIAL PRIMARY KEY,
-                    sensor_id VARCHAR(50) NOT NULL,
-                    timestamp TIMESTAMP NOT NULL,
-                    temperature FLOAT NOT NULL,
-                    humidity FLOAT NOT NULL,
-                    latitude DECIMAL(9,6) NOT NULL,
-                    longitude DECIMAL(9,6) NOT NULL,
-                    battery_level INT NOT NULL
+                    id SERIAL PRIMARY KEY,{dimension.table_columns_sql(dimension.SENSOR_DIMENSION)}
                 )
                 """)
                 self.conn.commit()
                 logger.info(f"Tabla {DB_SCHEMA}.sensor_data creada exitosamente.")
             else:
                 logger.info(f"Tabla {DB_SCHEMA}.sensor_data ya existe.")
-                
+            
+            mode = partitions.register(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            if mode is None and partitions.PARTITION_MODE != "none":
+                logger.warning(f"{DB_SCHEMA}.sensor_data no está particionada; PARTITION_MODE solo aplica al crearla")
+            
+            if dimension.create_tables(self.cursor, DB_SCHEMA):
+                logger.info(f"Tabla de sensores {DB_SCHEMA}.sensors creada.")
+            compact = dimension.register(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            if compact != dimension.SENSOR_DIMENSION:
+                logger.warning(f"{DB_SCHEMA}.sensor_data {'ya' if compact else 'no'} usa el formato compacto; "
+                               f"SENSOR_DIMENSION solo aplica al crearla")
             return True
         except Exception as e:
+            self.conn.rollback()
             logger.error(f"Error verificando/creando tabla: {e}")
             return False
     
+    def register_table(self):
+        """Detecta el particionado y el formato de una sensor_data ya creada (p. ej. por el coordinador).
+
+        Los registros de partitions y dimension son por proceso: sin esto, un proceso que
+        no llamó a prepare() insertaría con el formato completo y sin crear particiones.
+        """
+        try:
+            partitions.register(self.cursor, DB_SCHEMA)
+            dimension.register(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error detectando el formato de {DB_SCHEMA}.sensor_data: {e}")
+            return False
+    
+    def manage_partitions(self):
+        """Crea las particiones próximas y aplica la política de retención"""
+        try:
+            partitions.ensure_window(DB_SCHEMA)
+            retired = partitions.apply_retention(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            if retired:
+                action = "eliminadas" if partitions.PARTITION_RETENTION_ACTION == "drop" else "separadas"
+                logger.info(f"Particiones {action} por retención: {', '.join(retired)}")
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error administrando particiones: {e}")
+            return False
+    
+    def check_rollup_tables(self):
+        """Crea las tablas de resumen; si la tabla base ya tiene datos, las llena desde ella.
+        
+        También las reconstruye si una carga anterior sin MAINTAIN_ROLLUPS las dejó desactualizadas.
+        """
+        try:
+            if rollups.create_tables(self.cursor, DB_SCHEMA):
+                logger.info("Tablas de resumen creadas. Calculando resúmenes de los datos existentes...")
+                rollups.rebuild(self.cursor, DB_SCHEMA)
+            elif not rollups.is_maintained(self.cursor, DB_SCHEMA):
+                logger.info("Los resúmenes están desactualizados (carga sin MAINTAIN_ROLLUPS). "
+                            "Recalculándolos desde la tabla base...")
+                rollups.rebuild(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error verificando/creando tablas de resumen: {e}")
+            return False
+    
+    def mark_rollups_stale(self):
+        """Sin MAINTAIN_ROLLUPS, marca los resúmenes existentes para que las consultas no los usen"""
+        try:
+            if rollups.mark_stale(self.cursor, DB_SCHEMA):
+                logger.warning("MAINTAIN_ROLLUPS=false: los resúmenes existentes quedan marcados como "
+                               "desactualizados hasta reconstruirlos")
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error marcando los resúmenes como desactualizados: {e}")
+            return False
+    
+    def check_latest_table(self):
+        """Crea sensor_latest (llenándola desde la tabla base) y carga el estado en memoria"""
+        try:
+            if latest.create_table(self.cursor, DB_SCHEMA):
+                logger.info("Tabla sensor_latest creada desde los datos existentes.")
+            self.conn.commit()
+            count = self.latest.load(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            logger.info(f"Última lectura de {count} sensores cargada en memoria.")
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error verificando/creando tabla sensor_latest: {e}")
+            return False
+    
+    def ensure_timestamp_index(self):
+        """Crea el índice BRIN sobre timestamp con que analytics recalcula minutos por rango"""
+        try:
+            analytics.ensure_index(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error creando índice sobre timestamp: {e}")
+            return False
+    
+    def ensure_unique_index(self):
+        """Crea el índice único (sensor_id o sensor_key, timestamp) que necesita LOAD_MODE=upsert.
+        
+        Si la tabla ya tiene duplicados de cargas anteriores, se eliminan antes
+        conservando la fila con menor id.
+        """
+        try:
+            key = insert_columns()[0]
+            self.cursor.execute("""
+            SELECT EXISTS (
+                SELECT FROM pg_indexes
+                WHERE schemaname = %s AND indexname = %s
+            )
+            """, (DB_SCHEMA, f"sensor_data_{key}_timestamp_key"))
+            if self.cursor.fetchone()[0]:
+                return True
+            
+            logger.info(f"Creando índice único ({key}, timestamp) en {DB_SCHEMA}.sensor_data...")
+            self.cursor.execute(f"""
+            DELETE FROM {DB_SCHEMA}.sensor_data a
+            USING {DB_SCHEMA}.sensor_data b
+            WHERE a.{key} = b.{key} AND a.timestamp = b.timestamp AND a.id > b.id
+            """)
+            if self.cursor.rowcount:
+                logger.info(f"Se eliminaron {self.cursor.rowcount} registros duplicados")
+                # Los resúmenes contaban los duplicados eliminados
+                self.cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{DB_SCHEMA}.sensor_rollup",))
+                if self.cursor.fetchone()[0]:
+                    rollups.rebuild(self.cursor, DB_SCHEMA)
+            self.cursor.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS sensor_data_{key}_timestamp_key
+            ON {DB_SCHEMA}.sensor_data ({key}, timestamp)
+            """)
+            # En tablas particionadas el índice único reemplaza al índice simple de la misma clave
+            self.cursor.execute(f"DROP INDEX IF EXISTS {DB_SCHEMA}.sensor_data_{key}_timestamp_idx")
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error creando índice único: {e}")
+            return False
+    
     def close_connection(self):
-        """Cierra la conexión a la base de datos"""
+        """Devuelve la conexión al pool"""
         if self.cursor:
             self.cursor.close()
+            self.cursor = None
         if self.conn:
-            self.conn.close()
-        logger.info("Conexión a la base de datos cerrada")
+            db.release_connection(self.conn)
+            self.conn = None
+        logger.info("Conexión a la base de datos devuelta al pool")
+    
+    def list_s3_objects(self, start_after=None):
+        """Lista los objetos del bucket (clave, ETag y tamaño), excluyendo el prefijo de procesados"""
+        objects = []
+        with metrics.track("list"):
+            for obj in self._iter_listing(start_after):
+                if obj['Key'].startswith(PROCESSED_PREFIX):
+                    continue
+                objects.append({"Key": obj['Key'], "ETag": obj['ETag'].strip('"'), "Size": obj['Size'],
+                                "LastModified": obj['LastModified']})
+        
+        self.object_meta.update((obj["Key"], obj) for obj in objects)
+        return objects
+    
+    def _iter_listing(self, start_after=None):
+        """Itera los objetos bajo S3_PREFIX sin paginar por el prefijo de procesados.
+        
+        Si PROCESSED_PREFIX queda dentro de S3_PREFIX, primero se listan los prefijos de
+        primer nivel con Delimiter y luego cada uno por separado, salvo el de procesados.
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        params = {"Bucket": BUCKET_NAME, "Prefix": S3_PREFIX}
+        if start_after:
+            params["StartAfter"] = start_after
+        if not PROCESSED_PREFIX.startswith(S3_PREFIX) or PROCESSED_PREFIX == S3_PREFIX:
+            for page in paginator.paginate(**params):
+                yield from page.get('Contents', [])
+            return
+        
+        prefixes = []
+        for page in paginator.paginate(Delimiter="/", **params):
+            yield from page.get('Contents', [])
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        for prefix in prefixes:
+            if prefix == PROCESSED_PREFIX:
+                continue
+            for page in paginator.paginate(**{**params, "Prefix": prefix}):
+                yield from page.get('Contents', [])
     
     def get_s3_files(self):
         """Obtiene la lista de archivos en el bucket S3"""
         try:
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            page_iterator = paginator.paginate(Bucket=BUCKET_NAME)
-            
-            files = []
-            for page in page_iterator:
-                if 'Contents' in page:
-                    files.extend([obj['Key'] for obj in page['Contents']])
-            
+            files = [obj['Key'] for obj in self.list_s3_objects()]
             logger.info(f"Se encontraron {len(files)} archivos en el bucket S3")
             return files
         except Exception as e:
             logger.error(f"Error obteniendo archivos de S3: {e}")
             return []
     
-    def download_and_parse_file(self, file_name):
-        """Descarga y parsea un archivo JSON de S3"""
+    def check_manifest_tables(self):
+        """Crea las tablas del manifiesto de objetos procesados y del cursor de listado"""
         try:
-            logger.info(f"Descargando archivo: {file_name}")
-            file_obj = self.s3_client.get_object(Bucket=BUCKET_NAME, Key=file_name)
-            file_content = file_obj['Body'].read()
-            data_dict = json.loads(file_content)
+            self.cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {DB_SCHEMA}.ingest_manifest (
+                object_key TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                size BIGINT NOT NULL,
+                row_count INT NOT NULL,
+                processed_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """)
+            self.cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {DB_SCHEMA}.ingest_cursor (
+                prefix TEXT PRIMARY KEY,
+                last_key TEXT NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """)
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error verificando/creando tablas del manifiesto: {e}")
+            return False
+    
+    def check_dead_letter_tables(self):
+        """Crea las tablas de cuarentena de registros rechazados y archivos fallidos"""
+        try:
+            quarantine.create_tables(self.cursor, DB_SCHEMA)
+            self.conn.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error verificando/creando tablas de cuarentena: {e}")
+            return False
+    
+    def record_failed_file(self, file_name, stage, error):
+        """Registra un archivo fallido en la cuarentena en su propia transacción"""
+        if not quarantine.DEAD_LETTER:
+            return
+        try:
+            meta = self.object_meta.get(file_name) or {}
+            quarantine.record_failed_file(self.cursor, DB_SCHEMA, file_name, stage, error, meta.get("ETag"))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.warning(f"No se pudo registrar {file_name} en la cuarentena: {e}")
+    
+    def get_pending_files(self):
+        """Lista solo los objetos nuevos o modificados según el manifiesto y el cursor"""
+        try:
+            start_after = None
+            if S3_KEYS_ORDERED:
+                self.cursor.execute(f"SELECT last_key FROM {DB_SCHEMA}.ingest_cursor WHERE prefix = %s",
+                                    (S3_PREFIX,))
+                row = self.cursor.fetchone()
+                start_after = row[0] if row else None
             
-            # Verificar si los datos están dentro de una clave "measurements"
-            if "measurements" in data_dict and isinstance(data_dict["measurements"], list):
-                data = data_dict["measurements"]
-                logger.info(f"Archivo {file_name} parseado con {len(data)} registros en formato 'measurements'")
-            elif isinstance(data_dict, list):
-                # Si los datos ya son una lista, usarlos directamente
-                data = data_dict
-                logger.info(f"Archivo {file_name} parseado con {len(data)} registros en formato lista")
-            else:
-                logger.error(f"Formato de archivo {file_name} no reconocido: {data_dict.keys() if isinstance(data_dict, dict) else type(data_dict)}")
-                data = []
+            objects = self.list_s3_objects(start_after)
+            self.cursor.execute(
+                f"SELECT object_key, etag FROM {DB_SCHEMA}.ingest_manifest WHERE object_key = ANY(%s)",
+                ([obj["Key"] for obj in objects],)
+            )
+            known = dict(self.cursor.fetchall())
+            self.conn.commit()
             
-            return data
+            pending = []
+            for obj in objects:
+                if known.get(obj["Key"]) == obj["ETag"]:
+                    self.completed_keys.add(obj["Key"])
+                else:
+                    pending.append(obj["Key"])
+            
+            self.listed_keys = [obj["Key"] for obj in objects]
+            logger.info(f"Se encontraron {len(objects)} archivos en el bucket S3, "
+                        f"{len(pending)} nuevos o modificados")
+            return pending
         except Exception as e:
-            logger.error(f"Error procesando archivo {file_name}: {e}")
+            self.conn.rollback()
+            logger.error(f"Error obteniendo archivos pendientes de S3: {e}")
             return []
     
-    def process_file(self, file_name):
-        """Procesa un archivo y carga sus datos en PostgreSQL"""
-        data = self.download_and_parse_file(file_name)
+    def record_manifest(self, file_name, row_count):
+        """Registra el objeto en el manifiesto dentro de la transacción actual"""
+        meta = self.object_meta.get(file_name)
+        if meta is None:
+            head = self.s3_client.head_object(Bucket=BUCKET_NAME, Key=file_name)
+            meta = {"Key": file_name, "ETag": head['ETag'].strip('"'), "Size": head['ContentLength']}
+        self.cursor.execute(f"""
+        INSERT INTO {DB_SCHEMA}.ingest_manifest (object_key, etag, size, row_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (object_key) DO UPDATE
+        SET etag = EXCLUDED.etag, size = EXCLUDED.size,
+            row_count = EXCLUDED.row_count, processed_at = now()
+        """, (file_name, meta["ETag"], meta["Size"], row_count))
+    
+    def advance_cursor(self):
+        """Avanza el cursor hasta la última clave tal que todas las anteriores están en el manifiesto.
+        
+        Retorna la clave hasta la que avanzó (o None).
+        """
+        if not S3_KEYS_ORDERED or not getattr(self, "listed_keys", None):
+            return None
+        last_key = None
+        for key in sorted(self.listed_keys):
+            if key not in self.completed_keys:
+                break
+            last_key = key
+        if last_key is None:
+            return None
+        try:
+            self.cursor.execute(f"""
+            INSERT INTO {DB_SCHEMA}.ingest_cursor (prefix, last_key) VALUES (%s, %s)
+            ON CONFLICT (prefix) DO UPDATE SET last_key = EXCLUDED.last_key, updated_at = now()
+            WHERE {DB_SCHEMA}.ingest_cursor.last_key < EXCLUDED.last_key
+            """, (S3_PREFIX, last_key))
+            self.conn.commit()
+            logger.info(f"Cursor de listado avanzado hasta {last_key}")
+            return last_key
+        except Exception as e:
+            self.conn.rollback()
+            logger.warning(f"No se pudo avanzar el cursor de listado: {e}")
+            return None
+    
+    def download_and_parse_file(self, file_name):
+        """Descarga y parsea un archivo de S3 (JSON, JSON comprimido, Parquet o Arrow IPC).
+        
+        Si falla retorna quarantine.FailedFile (una lista vacía con la etapa y el error).
+        """
+        stage = "download"
+        try:
+            logger.info(f"Descargando archivo: {file_name}")
+            with metrics.track("download"):
+                file_obj = self.s3_client.get_object(Bucket=BUCKET_NAME, Key=file_name)
+                compression = compressed.detect_compression(file_name, file_obj.get('ContentEncoding'))
+                if compression is None:
+                    file_content = file_obj['Body'].read()
+            stage = "parse"
+            if compression is not None:
+                return self.parse_compressed_file(file_name, file_obj, compression)
+            metrics.inc("s3_loader_bytes_downloaded_total", len(file_content))
+            fmt = columnar.detect_format(file_name, file_obj.get('Metadata'))
+            if fmt is not None:
+                if not columnar.available():
+                    logger.error(f"El archivo {file_name} está en formato {fmt} y pyarrow no está instalado")
+                    return quarantine.FailedFile(stage, f"formato {fmt} sin pyarrow instalado")
+                # Las columnas pasan directamente a la validación vectorizada, sin objetos por registro
+                with metrics.track("parse"):
+                    records = columnar.decode_records(file_content, fmt)
+                logger.info(f"Archivo {file_name} ({fmt}) leído y validado con {len(records)} registros")
+                return records
+            return self.parse_json_content(file_name, file_content)
+        except Exception as e:
+            logger.error(f"Error procesando archivo {file_name}: {e}")
+            return quarantine.FailedFile(stage, e)
+    
+    def parse_json_content(self, file_name, file_content):
+        """Parsea el contenido JSON completo de un archivo"""
+        with metrics.track("parse"):
+            # Camino rápido: decodificación tipada y validación en un solo recorrido
+            records = codec.decode_measurements(file_content)
+            if records is not None:
+                logger.info(f"Archivo {file_name} parseado y validado con {len(records)} registros")
+                return records
+            data_dict = codec.loads(file_content)
+        
+        # Verificar si los datos están dentro de una clave "measurements"
+        if "measurements" in data_dict and isinstance(data_dict["measurements"], list):
+            data = data_dict["measurements"]
+            logger.info(f"Archivo {file_name} parseado con {len(data)} registros en formato 'measurements'")
+        elif isinstance(data_dict, list):
+            # Si los datos ya son una lista, usarlos directamente
+            data = data_dict
+            logger.info(f"Archivo {file_name} parseado con {len(data)} registros en formato lista")
+        else:
+            logger.error(f"Formato de archivo {file_name} no reconocido: {data_dict.keys() if isinstance(data_dict, dict) else type(data_dict)}")
+            data = quarantine.FailedFile("parse", "formato no reconocido: se esperaba una lista o 'measurements'")
+        
+        return data
+    
+    def parse_compressed_file(self, file_name, file_obj, compression):
+        """Descomprime el cuerpo de S3 a medida que llega y lo parsea.
+
+        Si el contenido descomprimido cabe en DECOMPRESS_BUFFER_MB se parsea de una
+        vez con el codec; si no, se parsea en streaming y se valida por bloques, sin
+        guardar nunca el contenido descomprimido completo.
+        """
+        # La descarga del cuerpo se mide junto con la descompresión y el parseo
+        metrics.inc("s3_loader_bytes_downloaded_total", file_obj.get('ContentLength', 0))
+        limit = compressed.DECOMPRESS_BUFFER_MB * 1024 * 1024
+        body = file_obj['Body']
+        try:
+            with compressed.open_stream(body, compression) as stream:
+                with metrics.track("parse"):
+                    head = compressed.read_prefix(stream, limit + 1)
+                if len(head) <= limit:
+                    return self.parse_json_content(file_name, head)
+                
+                records = codec.ValidatedRecords([], Counter())
+                # Los descartados se guardan como en los demás caminos: validate_records los lleva a la cuarentena
+                rejects = records.rejects if quarantine.DEAD_LETTER else None
+                with metrics.track("parse"):
+                    for chunk in iter_chunks(iter_measurements(PrefixedStream(head, stream)), STREAM_CHUNK_ROWS):
+                        valid, rejected = validation.validate_records(chunk, rejects)
+                        records.extend(valid)
+                        records.rejected.update(rejected)
+        finally:
+            body.close()
+        logger.info(f"Archivo {file_name} ({compression}) descomprimido en streaming y validado con "
+                    f"{len(records)} registros")
+        return records
+    
+    def process_file(self, file_name, data=None):
+        """Procesa un archivo y carga sus datos en PostgreSQL.
+        
+        Si ``data`` es None el archivo se descarga aquí (en streaming si STREAM_PARSE
+        está activo); el pipeline concurrente lo pasa ya descargado y parseado.
+        """
+        if data is None:
+            if STREAM_PARSE:
+                return self.load_record_chunks(file_name, self.stream_file_chunks(file_name))
+            data = self.download_and_parse_file(file_name)
+        if isinstance(data, quarantine.FailedFile):
+            self.record_failed_file(file_name, data.stage, data.error)
+            return 0
         if not data:
             return 0
+        return self.load_record_chunks(file_name, [data])
+    
+    def add_file(self, file_name, data):
+        """Agrega un archivo parseado al grupo de commit; retorna los [FileResult] ya resueltos.
         
-        records_to_insert = []
-        for record in data:
-            try:
-                # Validar que los campos obligatorios existan
-                if not all(key in record for key in ["sensor_id", "timestamp", "temperature", "humidity", "location", "battery_level"]):
-                    logger.warning(f"Registro incompleto: {record}")
-                    continue
-                
-                # Validar que location contenga latitude y longitude
-                if not all(key in record["location"] for key in ["latitude", "longitude"]):
-                    logger.warning(f"Datos de ubicación incompletos: {record}")
-                    continue
-                
-                # Convertir datos a los tipos correctos según la definición de la tabla
-                sensor_id = str(record["sensor_id"])
-                
-                # Convertir timestamp a formato PostgreSQL
-                try:
-                    timestamp = record["timestamp"]
-                    # Si es un string, asumimos formato ISO
-                    if isinstance(timestamp, str):
-                        timestamp = timestamp
-                except:
-                    logger.warning(f"Error en formato de timestamp: {record['timestamp']}")
-                    continue
-                
-                # Convertir temperatura y humedad a float
-                try:
-                    temperature = float(record["temperature"])
-                    humidity = float(record["humidity"])
-                except:
-                    logger.warning(f"Error en temperatura/humedad: {record}")
-                    continue
-                
-                # Convertir coordenadas a decimal con precisión correcta
-                try:
-                    latitude = float(record["location"]["latitude"])
-                    longitude = float(record["location"]["longitude"])
-                    # Verificar que estén en rangos válidos
-                    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
-                        logger.warning(f"Coordenadas fuera de rango: {latitude}, {longitude}")
-                        continue
-                except:
-                    logger.warning(f"Error en coordenadas: {record['location']}")
-                    continue
-                
-                # Convertir nivel de batería a entero
-                try:
-                    battery_level = int(record["battery_level"])
-                except:
-                    logger.warning(f"Error en nivel de batería: {record['battery_level']}")
-                    continue
-                
-                records_to_insert.append((
-                    sensor_id,
-                    timestamp,
-                    temperature,
-                    humidity,
-                    latitude,
-                    longitude,
-                    battery_level
-                ))
-            except Exception as e:
-                logger.error(f"Error procesando registro: {e}, registro: {record}")
+        El grupo se confirma al alcanzar sus límites de archivos, filas, bytes o espera.
+        Los archivos en streaming, fallidos o vacíos se procesan aparte, como antes.
+        """
+        if data is None:
+            # En streaming el archivo se inserta por bloques en su propia transacción
+            results = self.flush_group()
+            return results + [self._file_result(file_name, self.process_file(file_name))]
+        if isinstance(data, quarantine.FailedFile) or not data:
+            return [self._file_result(file_name, self.process_file(file_name, data))]
+        size = (self.object_meta.get(file_name) or {}).get("Size", 0)
+        if self.group.add(file_name, data, size):
+            return self.flush_group()
+        return []
+    
+    def _file_result(self, file_name, rows):
+        """Marca un archivo procesado por separado (ya confirmado) y retorna su FileResult"""
+        if rows > 0:
+            self.mark_file_as_processed(file_name)
+        return batching.FileResult(file_name, rows, file_name in self.completed_keys)
+    
+    def flush_group(self):
+        """Valida, inserta y confirma en una sola transacción los archivos del grupo.
         
-        # Insertar en lotes para mejor rendimiento
-        if records_to_insert:
-            try:
-                # Referencia a la tabla con el esquema
-                query = f"""
-                INSERT INTO {DB_SCHEMA}.sensor_data 
-                (sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """
-                execute_batch(self.cursor, query, records_to_insert, page_size=BATCH_SIZE)
+        Los archivos se marcan como procesados solo después del commit. Si el commit
+        falla, ningún archivo queda confirmado y todos se registran como fallidos.
+        Retorna un FileResult por archivo.
+        """
+        items = self.group.take()
+        if not items:
+            return []
+        loaded = []  # (clave, registros recibidos, registros válidos)
+        failed = []  # (clave, error)
+        try:
+            pieces = [(file_name, len(data), self.validate_records(data, file_name)) for file_name, data in items]
+            inserted = self.insert_group(pieces, loaded, failed)
+            for file_name, _, valid in loaded:
+                if self.incremental:
+                    # También se registran archivos sin registros válidos para no descargarlos otra vez
+                    self.record_manifest(file_name, valid)
+                if quarantine.DEAD_LETTER:
+                    quarantine.resolve_file(self.cursor, DB_SCHEMA, file_name)
+            with metrics.track("commit"):
                 self.conn.commit()
-                logger.info(f"Se insertaron {len(records_to_insert)} registros desde {file_name}")
-                return len(records_to_insert)
+            self.publish_latest()
+            self.completed_keys.update(file_name for file_name, _, _ in loaded)
+        except Exception as e:
+            if not self.conn.closed:
+                self.conn.rollback()
+            self.latest_pending.clear()
+            logger.error(f"Error confirmando un grupo de {len(items)} archivos: {e}")
+            loaded = []
+            failed = [(file_name, e) for file_name, _ in items]
+        
+        for file_name, error in failed:
+            metrics.inc("s3_loader_files_total", status="failed")
+            if not self.conn.closed:
+                # record_failed_file hace su propio commit, por eso va después del commit del grupo
+                self.record_failed_file(file_name, "load", error)
+        if loaded:
+            metrics.inc("s3_loader_files_total", len(loaded), status="loaded")
+            received = sum(count for _, count, _ in loaded)
+            valid = sum(count for _, _, count in loaded)
+            metrics.inc("s3_loader_rows_total", received, result="received")
+            metrics.inc("s3_loader_rows_total", valid, result="valid")
+            metrics.inc("s3_loader_rows_total", inserted, result="inserted")
+            logger.info(f"Se insertaron {inserted} registros de {len(loaded)} archivos en un commit")
+            if inserted < valid:
+                logger.info(f"Se omitieron {valid - inserted} registros ya existentes")
+        
+        results = [batching.FileResult(file_name, 0, False) for file_name, _ in failed]
+        for file_name, _, valid in loaded:
+            if valid > 0:
+                self.mark_file_as_processed(file_name)
+            results.append(batching.FileResult(file_name, valid, True))
+        return results
+    
+    def insert_group(self, pieces, loaded, failed):
+        """Inserta los registros de varios archivos [(clave, recibidos, registros)] sin hacer commit.
+        
+        Primero intenta insertar todas las filas juntas. Si falla, deshace el intento,
+        prueba cada archivo en un savepoint que siempre se deshace (escribe sus filas y,
+        en upsert, las fusiona sin tocar los resúmenes, así que no retiene bloqueos) e
+        inserta juntos los que pasaron. Los que fallan se
+        aíslan fila por fila si DEAD_LETTER está activo y si no quedan sin cargar. Agrega
+        los archivos a loaded o a failed y retorna las filas insertadas.
+        """
+        records = [record for _, _, file_records in pieces for record in file_records]
+        try:
+            with self.savepoint("commit_group"):
+                inserted = self.insert_records_adaptive(records) if records else 0
+        except Exception as e:
+            if self.conn.closed:
+                raise
+            # Las lecturas del intento se deshicieron con el savepoint
+            self.latest_pending.clear()
+            logger.warning(f"Falló la inserción conjunta de {len(pieces)} archivos; "
+                           f"se prueban uno por uno: {str(e).strip()}")
+        else:
+            loaded.extend((file_name, received, len(file_records)) for file_name, received, file_records in pieces)
+            return inserted
+        
+        good, bad = [], []
+        target = self.create_staging() if LOAD_MODE == "upsert" else f"{DB_SCHEMA}.sensor_data"
+        for piece in pieces:
+            try:
+                with self.savepoint("probe_file", keep=False):
+                    self.write_rows(self.table_rows(piece[2]), target)
+                    if LOAD_MODE == "upsert":
+                        # La fusión también puede fallar (ON CONFLICT, restricciones de sensor_data)
+                        self.merge_staging(target, f"{DB_SCHEMA}.sensor_data", with_rollups=False)
             except Exception as e:
+                if self.conn.closed:
+                    raise
+                bad.append((piece, e))
+            else:
+                good.append(piece)
+        
+        records = [record for _, _, file_records in good for record in file_records]
+        inserted = self.insert_records_adaptive(records) if records else 0
+        loaded.extend((file_name, received, len(file_records)) for file_name, received, file_records in good)
+        for (file_name, received, file_records), error in bad:
+            if quarantine.DEAD_LETTER:
+                count, isolated = self.insert_records_isolating(file_name, file_records)
+                inserted += count
+                loaded.append((file_name, received, len(file_records) - isolated))
+            else:
+                logger.error(f"Error cargando datos de {file_name}: {error}")
+                failed.append((file_name, error))
+        return inserted
+    
+    @contextmanager
+    def savepoint(self, name, keep=True):
+        """Ejecuta el bloque dentro de un savepoint; lo deshace si falla (o siempre, con keep=False)"""
+        self.cursor.execute(f"SAVEPOINT {name}")
+        try:
+            yield
+        except Exception:
+            if not self.conn.closed:
+                self.cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+                self.cursor.execute(f"RELEASE SAVEPOINT {name}")
+            raise
+        if not keep:
+            self.cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        self.cursor.execute(f"RELEASE SAVEPOINT {name}")
+    
+    def stream_file_chunks(self, file_name):
+        """Descarga el archivo en streaming y produce listas de hasta STREAM_CHUNK_ROWS registros"""
+        logger.info(f"Descargando archivo en streaming: {file_name}")
+        with metrics.track("download"):
+            file_obj = self.s3_client.get_object(Bucket=BUCKET_NAME, Key=file_name)
+        # En streaming la lectura del cuerpo se mide junto con la validación e inserción de cada bloque
+        metrics.inc("s3_loader_bytes_downloaded_total", file_obj.get('ContentLength', 0))
+        body = file_obj['Body']
+        fmt = columnar.detect_format(file_name, file_obj.get('Metadata'))
+        compression = compressed.detect_compression(file_name, file_obj.get('ContentEncoding'))
+        try:
+            if compression is not None:
+                with compressed.open_stream(body, compression) as stream:
+                    yield from iter_chunks(iter_measurements(stream), STREAM_CHUNK_ROWS)
+                return
+            if fmt is not None:
+                if not columnar.available():
+                    raise RuntimeError(f"el archivo está en formato {fmt} y pyarrow no está instalado")
+                yield from columnar.iter_record_chunks(body, fmt, STREAM_CHUNK_ROWS)
+                return
+            yield from iter_chunks(iter_measurements(body), STREAM_CHUNK_ROWS)
+        finally:
+            body.close()
+    
+    def load_record_chunks(self, file_name, chunks):
+        """Valida e inserta cada bloque de registros y hace un único commit por archivo"""
+        received = valid = inserted = 0
+        try:
+            for chunk in chunks:
+                received += len(chunk)
+                records = self.validate_records(chunk, file_name)
+                if records:
+                    count, failed = self.insert_records_isolating(file_name, records)
+                    inserted += count
+                    valid += len(records) - failed
+            if received == 0:
                 self.conn.rollback()
-                logger.error(f"Error insertando datos: {e}")
+                metrics.inc("s3_loader_files_total", status="empty")
                 return 0
-        return 0
+            if self.incremental:
+                # También se registran archivos sin registros válidos para no descargarlos otra vez
+                self.record_manifest(file_name, valid)
+            if quarantine.DEAD_LETTER:
+                quarantine.resolve_file(self.cursor, DB_SCHEMA, file_name)
+            with metrics.track("commit"):
+                self.conn.commit()
+            self.publish_latest()
+            self.completed_keys.add(file_name)
+        except Exception as e:
+            self.conn.rollback()
+            self.latest_pending.clear()
+            metrics.inc("s3_loader_files_total", status="failed")
+            logger.error(f"Error cargando datos de {file_name}: {e}")
+            if not self.conn.closed:
+                self.record_failed_file(file_name, "load", e)
+            return 0
+        
+        metrics.inc("s3_loader_files_total", status="loaded")
+        metrics.inc("s3_loader_rows_total", received, result="received")
+        metrics.inc("s3_loader_rows_total", valid, result="valid")
+        metrics.inc("s3_loader_rows_total", inserted, result="inserted")
+        if valid:
+            logger.info(f"Se insertaron {inserted} registros desde {file_name}")
+            if inserted < valid:
+                logger.info(f"Se omitieron {valid - inserted} registros ya existentes")
+        return valid
     
-    def mark_file_as_processed(self, file_name):
-        """Opcionalmente, mueve o marca el archivo como procesado"""
+    def validate_records(self, data, file_name=None):
+        """Valida los registros y los convierte a tuplas con los tipos de la tabla.
+        
+        Con file_name y DEAD_LETTER activo, los descartados se guardan en la cuarentena
+        dentro de la transacción del archivo.
+        """
+        rejects = [] if quarantine.DEAD_LETTER and file_name is not None else None
+        if isinstance(data, codec.ValidatedRecords):
+            # Ya validados al decodificar con el esquema tipado
+            records, rejected = data, data.rejected
+            if rejects is not None:
+                rejects = data.rejects
+        else:
+            with metrics.track("validate"):
+                records, rejected = validation.validate_records(data, rejects)
+        if rejected:
+            metrics.add_rejected(rejected)
+            # Un solo mensaje agregado por bloque en lugar de uno por registro inválido
+            logger.warning(f"Se descartaron {sum(rejected.values())} registros inválidos: {dict(rejected)}")
+            if rejects:
+                quarantine.record_rejects(self.cursor, DB_SCHEMA, file_name, rejects)
+        return records
+    
+    def insert_records(self, records, table=None):
+        """Inserta los registros usando el modo de carga configurado (sin hacer commit).
+        
+        Retorna el número de filas realmente insertadas.
+        """
+        table = table or f"{DB_SCHEMA}.sensor_data"
+        # Las particiones se crean en otra conexión para que sean visibles a todos los escritores
+        partitions.ensure_for_records(DB_SCHEMA, records)
+        with metrics.track("insert"):
+            rows = self.table_rows(records)
+            if LOAD_MODE == "upsert":
+                inserted = self.upsert_records(rows, table)
+            else:
+                self.write_rows(rows, table)
+                if MAINTAIN_ROLLUPS:
+                    rollups.apply_records(self.cursor, DB_SCHEMA, records)
+                inserted = len(records)
+            if latest.MAINTAIN_LATEST:
+                self.apply_latest(records)
+        return inserted
+    
+    def insert_records_adaptive(self, records):
+        """Inserta los registros en trozos del tamaño adaptativo (sin hacer commit).
+        
+        Cada trozo solo escribe filas (en upsert, a la tabla temporal); los resúmenes,
+        sensor_latest y la fusión del upsert se aplican una sola vez al final con las
+        claves ordenadas. Así la transacción toma esos bloqueos en una sola sentencia
+        por tabla y dos escritores no se bloquean en ciclo. Retorna las filas insertadas.
+        """
+        table = f"{DB_SCHEMA}.sensor_data"
+        partitions.ensure_for_records(DB_SCHEMA, records)
+        with metrics.track("insert"):
+            target = self.create_staging() if LOAD_MODE == "upsert" else table
+            for chunk in self.batch_size.slices(records):
+                start = time.perf_counter()
+                self.write_rows(self.table_rows(chunk), target)
+                self.batch_size.observe(len(chunk), time.perf_counter() - start)
+            if LOAD_MODE == "upsert":
+                inserted = self.merge_staging(target, table)
+            else:
+                if MAINTAIN_ROLLUPS:
+                    rollups.apply_records(self.cursor, DB_SCHEMA, records)
+                inserted = len(records)
+            if latest.MAINTAIN_LATEST:
+                self.apply_latest(records)
+        return inserted
+    
+    def table_rows(self, records):
+        """Registros validados en el formato de sensor_data (compacto o completo)"""
+        if dimension.is_compact(DB_SCHEMA):
+            return self.sensor_cache.compact_records(records)
+        # La tabla guarda la ubicación, pero la dimensión se mantiene para las consultas espaciales
+        self.sensor_cache.resolve(records)
+        return records
+    
+    def write_rows(self, rows, table):
+        """Escribe filas con COPY (también en upsert, hacia la tabla temporal) o con execute_batch"""
+        if LOAD_MODE == "batch":
+            self.execute_batch_records(rows, table)
+        else:
+            self.copy_records(rows, table)
+    
+    def apply_latest(self, records):
+        """Actualiza sensor_latest con la última lectura de cada sensor del lote (sin hacer commit).
+        
+        En upsert los registros repetidos no cambian nada: tienen el mismo timestamp que
+        la fila existente y solo un timestamp mayor reemplaza el estado.
+        """
+        rows = latest.reduce_records(records)
+        latest.apply(self.cursor, DB_SCHEMA, rows)
+        # Se agrega al final: si el lote falla dentro de un savepoint, sus lecturas no se publican
+        latest.merge_latest(self.latest_pending, rows)
+    
+    def publish_latest(self):
+        """Pasa al mapa en memoria las lecturas de la transacción recién confirmada"""
+        if self.latest_pending:
+            self.latest.merge(self.latest_pending)
+            self.latest_pending = {}
+    
+    def insert_records_isolating(self, file_name, records, depth=0):
+        """Inserta los registros aislando las filas que hacen fallar el lote.
+        
+        El lote se inserta dentro de un savepoint; si falla, se deshace solo el savepoint
+        y se divide en mitades hasta aislar las filas problemáticas, que van a la
+        cuarentena. El resto del lote se inserta en la misma transacción.
+        Retorna (filas insertadas, filas aisladas).
+        """
+        if not quarantine.DEAD_LETTER:
+            return self.insert_records(records), 0
+        self.cursor.execute("SAVEPOINT insert_batch")
         try:
-            # Opción 1: Mover a otra carpeta "processed"
-            new_key = f"processed/{file_name.split('/')[-1]}"
-            self.s3_client.copy_object(
-                Bucket=BUCKET_NAME,
-                CopySource={'Bucket': BUCKET_NAME, 'Key': file_name},
-                Key=new_key
-            )
-            # Opcionalmente, borrar el original
-            # self.s3_client.delete_object(Bucket=BUCKET_NAME, Key=file_name)
-            logger.info(f"Archivo {file_name} marcado como procesado")
+            inserted = self.insert_records(records)
+        except Exception as e:
+            if self.conn.closed:
+                raise
+            self.cursor.execute("ROLLBACK TO SAVEPOINT insert_batch")
+            self.cursor.execute("RELEASE SAVEPOINT insert_batch")
+            if len(records) == 1:
+                quarantine.record_rejects(self.cursor, DB_SCHEMA, file_name,
+                                          [("insert_error", quarantine.measurement_from_row(records[0]))],
+                                          error=str(e).strip())
+                metrics.add_rejected({"insert_error": 1})
+                return 0, 1
+            if depth == 0:
+                logger.warning(f"Falló la inserción de un lote de {len(records)} registros de {file_name}; "
+                               f"aislando las filas con error: {str(e).strip()}")
+            middle = len(records) // 2
+            first = self.insert_records_isolating(file_name, records[:middle], depth + 1)
+            second = self.insert_records_isolating(file_name, records[middle:], depth + 1)
+            return first[0] + second[0], first[1] + second[1]
+        self.cursor.execute("RELEASE SAVEPOINT insert_batch")
+        return inserted, 0
+    
+    def execute_batch_records(self, records, table):
+        """Inserta los registros con execute_batch en páginas de BATCH_SIZE"""
+        columns = insert_columns()
+        query = f"""
+        INSERT INTO {table} 
+        ({", ".join(columns)})
+        VALUES ({", ".join(["%s"] * len(columns))})
+        """
+        execute_batch(self.cursor, query, records, page_size=BATCH_SIZE)
+    
+    def copy_records(self, records, table):
+        """Envía los registros con COPY ... FROM STDIN desde un buffer en memoria"""
+        compact = dimension.is_compact(DB_SCHEMA)
+        columns = ", ".join(insert_columns())
+        if COPY_FORMAT == "binary":
+            buffer = build_copy_binary_compact_buffer(records) if compact else build_copy_binary_buffer(records)
+            self.cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)", buffer)
+        else:
+            buffer = build_copy_text_buffer(records)
+            self.cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buffer)
+    
+    def upsert_records(self, records, table):
+        """Carga los registros en una tabla temporal y los fusiona ignorando (sensor_id, timestamp) repetidos"""
+        staging = self.create_staging()
+        self.copy_records(records, staging)
+        return self.merge_staging(staging, table)
+    
+    def create_staging(self):
+        """Crea (si no existe) la tabla temporal del upsert con el formato de sensor_data; retorna su nombre"""
+        compact = dimension.is_compact(DB_SCHEMA)
+        staging = "sensor_data_staging_compact" if compact else "sensor_data_staging"
+        self.cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging} ({dimension.table_columns_sql(compact)}
+        )
+        """)
+        return staging
+    
+    def merge_staging(self, staging, table, with_rollups=True):
+        """Fusiona la tabla temporal en table, actualiza los resúmenes y la vacía; retorna las filas insertadas"""
+        compact = dimension.is_compact(DB_SCHEMA)
+        key = insert_columns()[0]
+        columns = ", ".join(insert_columns())
+        # DISTINCT ON evita el error de ON CONFLICT cuando el mismo lote repite una clave
+        merge = f"""
+        INSERT INTO {table} ({columns})
+        SELECT DISTINCT ON ({key}, timestamp) {columns}
+        FROM {staging}
+        ORDER BY {key}, timestamp
+        ON CONFLICT ({key}, timestamp) DO NOTHING
+        """
+        if MAINTAIN_ROLLUPS and with_rollups:
+            # Los resúmenes se calculan solo con las filas que realmente se insertaron
+            if compact:
+                # Los resúmenes se agrupan por sensor_id: se traduce la clave con la dimensión
+                inserted_rows = f"""
+                merged AS ({merge} RETURNING sensor_key, timestamp, temperature, humidity, battery_level),
+                inserted AS (
+                    SELECT s.sensor_id, m.timestamp, m.temperature, m.humidity, m.battery_level
+                    FROM merged m JOIN {DB_SCHEMA}.sensors s ON s.sensor_key = m.sensor_key
+                )"""
+            else:
+                inserted_rows = f"inserted AS ({merge} RETURNING sensor_id, timestamp, temperature, humidity, battery_level)"
+            self.cursor.execute(f"""
+            WITH {inserted_rows},
+            {rollups.cte_statements(DB_SCHEMA, "inserted")}
+            SELECT count(*) FROM inserted
+            """)
+            inserted = self.cursor.fetchone()[0]
+        else:
+            self.cursor.execute(merge)
+            inserted = self.cursor.rowcount
+        self.cursor.execute(f"TRUNCATE {staging}")
+        return inserted
+    
+    def replay_dead_letter_records(self, reason=None):
+        """Reinyecta los registros en cuarentena en lotes de REPLAY_BATCH_SIZE.
+        
+        Cada lote se saca de la cuarentena, se valida e inserta en la misma transacción;
+        los que vuelven a fallar regresan a la cuarentena con el motivo actual.
+        Retorna (registros insertados, registros que siguen en cuarentena).
+        """
+        inserted = quarantined = 0
+        if not quarantine.DEAD_LETTER:
+            # Sin DEAD_LETTER los registros que vuelven a fallar se perderían
+            logger.error("La reinyección requiere DEAD_LETTER=true")
+            return inserted, quarantined
+        try:
+            max_id = quarantine.last_record_id(self.cursor, DB_SCHEMA)
+            while True:
+                taken = quarantine.take_records(self.cursor, DB_SCHEMA, quarantine.REPLAY_BATCH_SIZE, max_id, reason)
+                if not taken:
+                    self.conn.rollback()
+                    self.latest_pending.clear()
+                    break
+                by_key = {}
+                for object_key, record in taken:
+                    by_key.setdefault(object_key, []).append(record)
+                for object_key, measurements in by_key.items():
+                    records = self.validate_records(measurements, object_key)
+                    quarantined += len(measurements) - len(records)
+                    if records:
+                        count, failed = self.insert_records_isolating(object_key, records)
+                        inserted += count
+                        quarantined += failed
+                self.conn.commit()
+                self.publish_latest()
+                logger.info(f"Reinyectados {len(taken)} registros de la cuarentena")
+        except Exception as e:
+            self.conn.rollback()
+            self.latest_pending.clear()
+            logger.error(f"Error reinyectando registros de la cuarentena: {e}")
+        return inserted, quarantined
+    
+    def replay_failed_files(self):
+        """Vuelve a cargar los archivos fallidos sin resolver; retorna (cargados, que siguen fallando)"""
+        try:
+            keys = quarantine.pending_files(self.cursor, DB_SCHEMA)
+            self.conn.commit()
         except Exception as e:
-            logger.warning(f"No se pudo marcar el archivo como procesado: {e}")
+            self.conn.rollback()
+            logger.error(f"Error consultando archivos fallidos: {e}")
+            return 0, 0
+        loaded = 0
+        for key in keys:
+            # Si vuelve a fallar, process_file incrementa sus intentos en la cuarentena
+            self.process_file(key)
+            if key in self.completed_keys:
+                loaded += 1
+                self.mark_file_as_processed(key)
+        self.completion.flush()
+        return loaded, len(keys) - loaded
+    
+    def mark_file_as_processed(self, file_name):
+        """Marca el archivo como procesado según COMPLETION_MODE (copia, borrado en lote, etiqueta o nada).
+        
+        Solo se llama después del commit; en modo delete el borrado real ocurre al llenarse
+        el lote o en completion.flush().
+        """
+        self.completion.mark(file_name)
+    
+    def prepare(self):
+        """Verifica (y crea) tabla, particiones, índices, resúmenes, manifiesto, cuarentena y última lectura"""
+        if not db.reserve(required_connections()):
+            logger.error(f"El pool de conexiones ya se creó con menos de las {required_connections()} conexiones "
+                         f"que necesitan {max(1, DB_WRITERS)} escritores; aumente DB_POOL_MAX")
+            return False
+        if not self.check_table_exists():
+            return False
+        if not self.manage_partitions():
+            return False
+        if LOAD_MODE == "upsert" and not self.ensure_unique_index():
+            return False
+        if not self.ensure_timestamp_index():
+            return False
+        if MAINTAIN_ROLLUPS and not self.check_rollup_tables():
+            return False
+        if not MAINTAIN_ROLLUPS and not self.mark_rollups_stale():
+            return False
+        if self.incremental and not self.check_manifest_tables():
+            return False
+        if quarantine.DEAD_LETTER and not self.check_dead_letter_tables():
+            return False
+        if latest.MAINTAIN_LATEST and not self.check_latest_table():
+            return False
+        return True
     
     def load_data_from_s3(self):
         """Carga todos los datos desde S3 a PostgreSQL"""
@@ -258,24 +1211,18 @@ class S3ToPostgresLoader:
             return
         
         try:
-            # Verificar y crear tabla si no existe
-            if not self.check_table_exists():
+            if not self.prepare():
                 return
-                
-            total_processed = 0
-            files = self.get_s3_files()
+            
+            files = self.get_pending_files() if self.incremental else self.get_s3_files()
             
             if not files:
                 logger.warning("No se encontraron archivos para procesar")
+                self.advance_cursor()
                 return
             
-            for file_name in files:
-                records_processed = self.process_file(file_name)
-                total_processed += records_processed
-                
-                # Opcionalmente, marcar el archivo como procesado
-                if records_processed > 0:
-                    self.mark_file_as_processed(file_name)
+            total_processed = self.run_pipeline(files)
+            self.advance_cursor()
             
             logger.info(f"Proceso completado. Total de registros procesados: {total_processed}")
         except Exception as e:
@@ -283,15 +1230,141 @@ class S3ToPostgresLoader:
         finally:
             self.close_connection()
 
+    def _download_worker(self, key_queue, result_queue, stop_event):
+        """Descarga y parsea archivos de la cola de claves hasta vaciarla"""
+        while not stop_event.is_set():
+            try:
+                file_name = key_queue.get_nowait()
+            except queue.Empty:
+                return
+            # En modo streaming el escritor descarga el archivo mientras lo inserta
+            data = None if STREAM_PARSE else self.download_and_parse_file(file_name)
+            # put con timeout para poder abandonar si el consumidor se detiene
+            while not stop_event.is_set():
+                try:
+                    result_queue.put((file_name, data), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    
+    def start_downloaders(self, files, consumers=1):
+        """Lanza DOWNLOAD_WORKERS hilos que llenan una cola acotada con (archivo, datos).
+        
+        Cuando todos terminan se encola un None por consumidor para indicar el final.
+        """
+        key_queue = queue.Queue()
+        for file_name in files:
+            key_queue.put(file_name)
+        result_queue = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+        stop_event = threading.Event()
+        
+        workers = [
+            threading.Thread(target=self._download_worker, args=(key_queue, result_queue, stop_event),
+                             name=f"s3-download-{i}", daemon=True)
+            for i in range(max(1, DOWNLOAD_WORKERS))
+        ]
+        for worker in workers:
+            worker.start()
+        
+        def close_when_done():
+            for worker in workers:
+                worker.join()
+            for _ in range(consumers):
+                result_queue.put(None)
+        
+        threading.Thread(target=close_when_done, name="s3-download-closer", daemon=True).start()
+        return result_queue, stop_event
+    
+    def iter_parsed_files(self, files):
+        """Itera (archivo, datos) a medida que se descargan concurrentemente"""
+        result_queue, stop_event = self.start_downloaders(files)
+        try:
+            while True:
+                item = result_queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            stop_event.set()
+    
+    def _writer_loop(self, result_queue, totals):
+        """Consume archivos parseados de la cola y los confirma en grupos con la conexión propia"""
+        processed = 0
+        while True:
+            try:
+                # Con un grupo abierto solo se espera hasta que vence su archivo más antiguo
+                item = result_queue.get(timeout=self.group.remaining())
+            except queue.Empty:
+                processed += sum(result.rows for result in self.flush_group())
+                continue
+            if item is None:
+                break
+            file_name, data = item
+            try:
+                processed += sum(result.rows for result in self.add_file(file_name, data))
+            except Exception as e:
+                logger.error(f"Error procesando archivo {file_name}: {e}")
+        processed += sum(result.rows for result in self.flush_group())
+        totals.append(processed)
+    
+    def run_pipeline(self, files):
+        """Descarga en paralelo y carga con DB_WRITERS escritores; retorna el total de registros"""
+        writers = max(1, DB_WRITERS)
+        result_queue, stop_event = self.start_downloaders(files, consumers=writers)
+        totals = []
+        try:
+            if writers == 1:
+                self._writer_loop(result_queue, totals)
+                return sum(totals)
+            
+            threads = []
+            writer_loaders = []
+            for i in range(writers):
+                writer = S3ToPostgresLoader(s3_client=self.s3_client)
+                writer.object_meta = self.object_meta
+                writer.completed_keys = self.completed_keys
+                writer.incremental = self.incremental
+                writer.completion = self.completion
+                writer.latest = self.latest
+                writer.sensor_cache = self.sensor_cache
+                writer.batch_size = self.batch_size
+                if not writer.connect_db():
+                    # Las marcas de fin sobrantes quedan en la cola sin efecto
+                    continue
+                writer_loaders.append(writer)
+                thread = threading.Thread(target=writer._writer_loop, args=(result_queue, totals),
+                                          name=f"db-writer-{i}")
+                thread.start()
+                threads.append(thread)
+            
+            if not threads:
+                logger.error("No se pudo iniciar ningún escritor de base de datos")
+                return 0
+            for thread in threads:
+                thread.join()
+            for writer in writer_loaders:
+                writer.close_connection()
+            return sum(totals)
+        finally:
+            stop_event.set()
+            self.completion.flush()
+
 def main():
     """Función principal"""
     try:
         logger.info("Iniciando proceso de carga S3 a PostgreSQL")
+        metrics.start()
         loader = S3ToPostgresLoader()
         loader.load_data_from_s3()
         logger.info("Proceso finalizado")
     except Exception as e:
         logger.error(f"Error en la ejecución principal: {e}")
+    finally:
+        metrics.stop()
+        db.close_pool()
 
 if __name__ == "__main__":
-    main()
+    # El CLI carga el .env y configura el logging antes de importar (otra vez) este módulo
+    import sys
+    import cli
+    cli.main(["load", *sys.argv[1:]])
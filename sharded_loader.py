@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cli
+
+if __name__ == "__main__":
+    cli.load_environment()  # Antes de que s3_to_postgress y sus módulos lean la configuración
+
+import db
+import s3_to_postgress
+from s3_to_postgress import S3ToPostgresLoader
+
+logger = logging.getLogger("s3_to_postgres")
+
+SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES", "0")) or os.cpu_count() or 1  # Procesos de carga
+# "hash" reparte por hash de la clave completa; "prefix" mantiene juntas las claves de un mismo prefijo
+SHARD_BY = os.getenv("SHARD_BY", "hash")
+
+def shard_of(key, shards, by=SHARD_BY):
+    """Shard (0..shards-1) de una clave; determinista entre procesos y ejecuciones (crc32, no hash())"""
+    value = key.rsplit("/", 1)[0] if by == "prefix" and "/" in key else key
+    return zlib.crc32(value.encode("utf-8")) % shards
+
+def partition_keys(keys, shards, by=SHARD_BY):
+    """Reparte las claves en shards listas disjuntas: cada archivo pertenece a un solo proceso"""
+    partitions = [[] for _ in range(shards)]
+    for key in keys:
+        partitions[shard_of(key, shards, by)].append(key)
+    return partitions
+
+def _load_shard(shard, files, object_meta, incremental):
+    """Carga un shard en un proceso hijo con su propio cliente de S3 y su propia conexión.
+
+    Retorna (shard, registros, claves confirmadas).
+    """
+    loader = S3ToPostgresLoader()
+    loader.incremental = incremental
+    loader.object_meta.update(object_meta)
+    try:
+        # El coordinador ya preparó la tabla; el hijo solo detecta su formato y particionado
+        if not loader.connect_db() or not loader.register_table():
+            return shard, 0, []
+        rows = loader.run_pipeline(files)
+        return shard, rows, sorted(loader.completed_keys)
+    finally:
+        loader.close_connection()
+        db.close_pool()
+
+class ShardedLoader:
+    """Coordina la carga en varios procesos para usar más de un núcleo en el parseo y la validación"""
+
+    def __init__(self, processes=SHARD_PROCESSES, by=SHARD_BY):
+        self.processes = max(1, processes)
+        self.by = by
+        self.loader = S3ToPostgresLoader()
+
+    def acquire_run_lock(self):
+        """Evita dos coordinadores simultáneos sobre la misma tabla (lock advisory de sesión)"""
+        self.loader.cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))",
+                                   (f"{s3_to_postgress.DB_SCHEMA}.sensor_data:sharded_loader",))
+        locked = self.loader.cursor.fetchone()[0]
+        self.loader.conn.commit()
+        return locked
+
+    def release_run_lock(self):
+        self.loader.cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))",
+                                   (f"{s3_to_postgress.DB_SCHEMA}.sensor_data:sharded_loader",))
+        self.loader.conn.commit()
+
+    def load_data_from_s3(self):
+        """Prepara la base una sola vez, reparte los archivos y espera a todos los procesos"""
+        loader = self.loader
+        if not loader.connect_db():
+            return 0
+        try:
+            # Los DDL se ejecutan aquí para que los procesos hijos no compitan por crear tablas
+            if not loader.prepare():
+                return 0
+            if not self.acquire_run_lock():
+                logger.warning("Otra carga por shards está en curso sobre esta tabla; se omite esta ejecución")
+                return 0
+            try:
+                files = loader.get_pending_files() if loader.incremental else loader.get_s3_files()
+                if not files:
+                    logger.warning("No se encontraron archivos para procesar")
+                    loader.advance_cursor()
+                    return 0
+                total = self.run_shards(files)
+                loader.advance_cursor()
+                return total
+            finally:
+                self.release_run_lock()
+        except Exception as e:
+            logger.error(f"Error en la carga por shards: {e}")
+            return 0
+        finally:
+            loader.close_connection()
+
+    def run_shards(self, files):
+        """Ejecuta un proceso por shard no vacío y retorna el total de registros cargados"""
+        shards = partition_keys(files, self.processes, self.by)
+        start = time.perf_counter()
+        total = 0
+        # spawn: los procesos hijos no heredan conexiones, locks ni hilos del coordinador
+        context = multiprocessing.get_context("spawn")
+        # Los hijos heredan el entorno ya cargado del .env, pero no el logging: solo escriben en consola
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                 initializer=cli.configure_logging, initargs=(False,)) as executor:
+            futures = [
+                executor.submit(_load_shard, shard, shard_files,
+                                {key: self.loader.object_meta[key] for key in shard_files
+                                 if key in self.loader.object_meta},
+                                self.loader.incremental)
+                for shard, shard_files in enumerate(shards) if shard_files
+            ]
+            for future in as_completed(futures):
+                try:
+                    shard, rows, completed = future.result()
+                except Exception as e:
+                    # Los archivos de ese shard sin commit se cargarán en la próxima ejecución
+                    logger.error(f"Falló un proceso de carga: {e}")
+                    continue
+                total += rows
+                self.loader.completed_keys.update(completed)
+                logger.info(f"Shard {shard}: {rows} registros de {len(shards[shard])} archivos")
+        elapsed = time.perf_counter() - start
+        logger.info(f"Carga por shards completada: {total} registros en {elapsed:.2f}s con "
+                    f"{self.processes} procesos ({total / elapsed if elapsed else 0:.0f} registros/seg)")
+        return total
+
+def main():
+    """Función principal"""
+    try:
+        logger.info(f"Iniciando carga S3 a PostgreSQL con {SHARD_PROCESSES} procesos")
+        ShardedLoader().load_data_from_s3()
+        logger.info("Proceso finalizado")
+    except Exception as e:
+        logger.error(f"Error en la ejecución principal: {e}")
+    finally:
+        db.close_pool()
+
+if __name__ == "__main__":
+    import sys
+    cli.main(["load", "--sharded", *sys.argv[1:]])
@@ -0,0 +1,257 @@
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from itertools import compress
+
+try:
+    import numpy as np  # Opcional: validación vectorizada por columnas
+except ImportError:
+    np = None
+
+logger = logging.getLogger("s3_to_postgres")
+
+# "vectorized" usa NumPy si está instalado; "python" valida registro por registro
+VALIDATION_MODE = os.getenv("VALIDATION_MODE", "vectorized")
+
+REQUIRED_FIELDS = frozenset(["sensor_id", "timestamp", "temperature", "humidity", "location", "battery_level"])
+LOCATION_FIELDS = frozenset(["latitude", "longitude"])
+INT_MIN, INT_MAX = -2**31, 2**31 - 1  # Rango de la columna INT battery_level
+
+def validate_records(data, rejects=None):
+    """Valida los registros y los convierte a tuplas con los tipos de la tabla.
+
+    Retorna (registros, rechazados) donde rechazados es un Counter con el número
+    de registros descartados por motivo. Si se pasa una lista en rejects, se le
+    agregan los pares (motivo, registro) descartados.
+    """
+    if VALIDATION_MODE == "vectorized" and np is not None:
+        return validate_records_vectorized(data, rejects)
+    return validate_records_python(data, rejects)
+
+def _convert_record(record):
+    """Convierte un registro a la tupla de la tabla; retorna el motivo (str) si es inválido"""
+    # Validar que los campos obligatorios existan
+    if not isinstance(record, dict) or not all(key in record for key in REQUIRED_FIELDS):
+        return "missing_fields"
+
+    # Validar que location contenga latitude y longitude
+    location = record["location"]
+    if not isinstance(location, dict) or not all(key in location for key in LOCATION_FIELDS):
+        return "missing_location"
+
+    # Convertir datos a los tipos correctos según la definición de la tabla
+    sensor_id = str(record["sensor_id"])
+    timestamp = record["timestamp"]
+
+    # Convertir temperatura y humedad a float
+    try:
+        temperature = float(record["temperature"])
+        humidity = float(record["humidity"])
+    except (TypeError, ValueError, OverflowError):
+        return "invalid_temperature_humidity"
+
+    # Convertir coordenadas y verificar que estén en rangos válidos
+    try:
+        latitude = float(location["latitude"])
+        longitude = float(location["longitude"])
+    except (TypeError, ValueError, OverflowError):
+        return "invalid_coordinates"
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return "coordinates_out_of_range"
+
+    # Convertir nivel de batería a entero
+    try:
+        battery_level = int(record["battery_level"])
+    except (TypeError, ValueError, OverflowError):
+        return "invalid_battery_level"
+    if not INT_MIN <= battery_level <= INT_MAX:
+        return "invalid_battery_level"
+
+    return (sensor_id, timestamp, temperature, humidity, latitude, longitude, battery_level)
+
+def validate_records_python(data, rejects=None):
+    """Validación registro por registro (sin dependencias)"""
+    records_to_insert = []
+    rejected = Counter()
+    for record in data:
+        try:
+            result = _convert_record(record)
+        except Exception as e:
+            logger.debug(f"Error procesando registro: {e}, registro: {record}")
+            result = "invalid_record"
+        if type(result) is str:
+            rejected[result] += 1
+            if rejects is not None:
+                rejects.append((result, record))
+            continue
+        records_to_insert.append(result)
+
+    return records_to_insert, rejected
+
+def parse_timestamp(value):
+    """Timestamp comparable, ignorando la zona horaria igual que el cast a TIMESTAMP de PostgreSQL"""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    return value.replace(tzinfo=None)
+
+def _safe_float(value):
+    try:
+        return float(value), True
+    except (TypeError, ValueError, OverflowError):
+        return np.nan, False
+
+def _safe_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return 0, False
+    if not INT_MIN <= value <= INT_MAX:
+        return 0, False
+    return value, True
+
+def _float_column(values):
+    """Convierte una columna a float64; retorna (arreglo, máscara de conversión correcta)"""
+    # Columnas que ya llegan como arreglos (Parquet/Arrow) no necesitan conversión
+    if isinstance(values, np.ndarray) and values.dtype.kind == "f":
+        return values.astype(np.float64, copy=False), np.ones(len(values), dtype=bool)
+    # NumPy convierte None en NaN, mientras que float(None) falla
+    if None not in values:
+        try:
+            array = np.asarray(values, dtype=np.float64)
+            if array.shape == (len(values),):
+                return array, np.ones(len(values), dtype=bool)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    # Hay valores no numéricos: convertir en bloque los float/int y uno por uno solo el resto
+    is_number = [type(value) is float or type(value) is int for value in values]
+    array = np.full(len(values), np.nan)
+    ok = np.zeros(len(values), dtype=bool)
+    number_idx = np.flatnonzero(is_number)
+    try:
+        array[number_idx] = np.asarray(list(compress(values, is_number)), dtype=np.float64)
+        ok[number_idx] = True
+        other_idx = np.flatnonzero(~np.asarray(is_number, dtype=bool)).tolist()
+    except (OverflowError, ValueError):
+        other_idx = range(len(values))
+    for i in other_idx:
+        array[i], ok[i] = _safe_float(values[i])
+    return array, ok
+
+def _int_column(values):
+    """Convierte una columna con la semántica de int(); retorna (arreglo, máscara)"""
+    try:
+        array = np.asarray(values)
+    except (TypeError, ValueError):
+        array = None
+    if array is not None and array.shape == (len(values),):
+        if array.dtype.kind in "iub":
+            array = array.astype(np.int64)
+            ok = (array >= INT_MIN) & (array <= INT_MAX)
+            return np.where(ok, array, 0), ok
+        if array.dtype.kind == "f":
+            # int() trunca los float y falla con NaN/infinito
+            array = np.trunc(array)
+            ok = np.isfinite(array) & (array >= INT_MIN) & (array <= INT_MAX)
+            return np.where(ok, array, 0).astype(np.int64), ok
+    pairs = [_safe_int(value) for value in values]
+    return (np.fromiter((p[0] for p in pairs), dtype=np.int64, count=len(pairs)),
+            np.fromiter((p[1] for p in pairs), dtype=bool, count=len(pairs)))
+
+def _extract_columns(rows):
+    """Extrae cada campo como lista (una comprensión por columna, sin crear tuplas por fila)"""
+    locations = [r["location"] for r in rows]
+    return {
+        "sensor_id": [r["sensor_id"] for r in rows],
+        "timestamp": [r["timestamp"] for r in rows],
+        "temperature": [r["temperature"] for r in rows],
+        "humidity": [r["humidity"] for r in rows],
+        "latitude": [loc["latitude"] for loc in locations],
+        "longitude": [loc["longitude"] for loc in locations],
+        "battery_level": [r["battery_level"] for r in rows],
+    }
+
+def records_to_columns(data, rejects=None):
+    """Separa los registros en columnas; retorna (columnas, rechazados) con los incompletos ya descartados"""
+    rejected = Counter()
+    # Camino rápido: todos los registros están completos
+    try:
+        return _extract_columns(data), rejected
+    except (KeyError, TypeError):
+        pass
+
+    complete = [isinstance(r, dict) and REQUIRED_FIELDS <= r.keys() for r in data]
+    rows = list(compress(data, complete))
+    rejected["missing_fields"] = len(data) - len(rows)
+    located = [isinstance(r["location"], dict) and LOCATION_FIELDS <= r["location"].keys() for r in rows]
+    located_rows = list(compress(rows, located))
+    rejected["missing_location"] = len(rows) - len(located_rows)
+    if rejects is not None:
+        rejects.extend(("missing_fields", r) for r, ok in zip(data, complete) if not ok)
+        rejects.extend(("missing_location", r) for r, ok in zip(rows, located) if not ok)
+    return _extract_columns(located_rows), rejected
+
+def _column_value(column, index):
+    value = column[index]
+    return value.item() if hasattr(value, "item") else value
+
+def row_from_columns(columns, index):
+    """Reconstruye la medición original (con location anidada) de la fila index de las columnas"""
+    value = {name: _column_value(columns[name], index) for name in columns}
+    value["location"] = {"latitude": value.pop("latitude"), "longitude": value.pop("longitude")}
+    return value
+
+def validate_columns(columns, rejected=None, rejects=None):
+    """Aplica la conversión de tipos y los rangos como máscaras vectorizadas sobre columnas"""
+    rejected = Counter() if rejected is None else rejected
+    temperature, temp_ok = _float_column(columns["temperature"])
+    humidity, hum_ok = _float_column(columns["humidity"])
+    latitude, lat_ok = _float_column(columns["latitude"])
+    longitude, lon_ok = _float_column(columns["longitude"])
+    battery_level, battery_ok = _int_column(columns["battery_level"])
+
+    # Los motivos se asignan en el mismo orden que la validación registro por registro
+    valid = temp_ok & hum_ok
+    rejected["invalid_temperature_humidity"] += int(np.count_nonzero(~valid))
+    coords_ok = lat_ok & lon_ok
+    rejected["invalid_coordinates"] += int(np.count_nonzero(valid & ~coords_ok))
+    valid &= coords_ok
+    in_range = (latitude >= -90) & (latitude <= 90) & (longitude >= -180) & (longitude <= 180)
+    rejected["coordinates_out_of_range"] += int(np.count_nonzero(valid & ~in_range))
+    valid &= in_range
+    rejected["invalid_battery_level"] += int(np.count_nonzero(valid & ~battery_ok))
+    if rejects is not None:
+        reasons = np.select(
+            [~(temp_ok & hum_ok), ~coords_ok, ~in_range, ~battery_ok],
+            ["invalid_temperature_humidity", "invalid_coordinates", "coordinates_out_of_range",
+             "invalid_battery_level"],
+            default="",
+        )
+        rejects.extend((str(reasons[i]), row_from_columns(columns, i))
+                       for i in np.flatnonzero(~(valid & battery_ok)).tolist())
+    valid &= battery_ok
+
+    sensor_ids = columns["sensor_id"]
+    if set(map(type, sensor_ids)) - {str}:
+        sensor_ids = [str(value) for value in sensor_ids]
+    if valid.all():
+        return list(zip(sensor_ids, columns["timestamp"], temperature.tolist(), humidity.tolist(),
+                        latitude.tolist(), longitude.tolist(), battery_level.tolist())), +rejected
+    mask = valid.tolist()
+    records = list(zip(
+        compress(sensor_ids, mask),
+        compress(columns["timestamp"], mask),
+        temperature[valid].tolist(),
+        humidity[valid].tolist(),
+        latitude[valid].tolist(),
+        longitude[valid].tolist(),
+        battery_level[valid].tolist(),
+    ))
+    return records, +rejected
+
+def validate_records_vectorized(data, rejects=None):
+    """Validación por columnas con NumPy"""
+    if not data:
+        return [], Counter()
+    columns, rejected = records_to_columns(data, rejects)
+    return validate_columns(columns, rejected, rejects)